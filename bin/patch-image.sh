@@ -88,6 +88,15 @@ function validate_inputs() {
             echo "default userdata JSON file $userdata_file does not exist"
             badusage
         fi
+        # Validate and pre-parse the userdata when f5_image_prep is
+        # installed; otherwise the VE parses it at boot.
+        if python -c 'import f5_image_prep.userdata' > /dev/null 2>&1; then
+            if ! python -m f5_image_prep.userdata $userdata_file; then
+                echo "default userdata JSON file $userdata_file is invalid"
+                badusage
+            fi
+            compile_userdata=true
+        fi
     fi
 
     if [ -n "$hotfixisofile" -a -z "$baseisofile" ]; then
@@ -118,30 +127,73 @@ function validate_inputs() {
     fi
 }
 
-function get_dev() {
-    ls -l /dev/vg-db-hda | grep $1 | cut -d'>' -f2 | cut -d'/' -f2-
+function lvm_config() {
+    # Only let LVM see the partitions of our own nbd device.  Every copy of
+    # a VE image carries the same VG name and UUIDs, so this is what allows
+    # several images to be patched on the same host at once.
+    echo "devices { filter = [ \"a|^${nbd_dev}p[0-9]+\$|\", \"r|.*|\" ] }" \
+         "global { use_lvmetad = 0 }"
+}
+
+function dm_name() {
+    echo "f5-image-prep-$(basename $nbd_dev)-$(echo $1 | tr '.' '-')"
+}
+
+function map_lv() {
+    # Map a logical volume with a private device-mapper name instead of
+    # activating the VG, whose dm names would clash with other workers.
+    local lv=$1
+    local cfg=$(lvm_config)
+    local vg=$(vgs --noheadings -o vg_name --config "$cfg" | head -1 | tr -d ' ')
+    local extent_size=$(vgs --noheadings --nosuffix --units s \
+        -o vg_extent_size --config "$cfg" $vg | tr -d ' ')
+    lvs --noheadings --nosuffix --units s --separator ' ' \
+        -o seg_start,seg_size,seg_pe_ranges --config "$cfg" $vg/$lv |
+    while read seg_start seg_size pe_range; do
+        local pv=${pe_range%%:*}
+        local first_pe=${pe_range#*:}
+        first_pe=${first_pe%%-*}
+        local pe_start=$(pvs --noheadings --nosuffix --units s \
+            -o pe_start --config "$cfg" $pv | tr -d ' ')
+        echo "${seg_start%.*} ${seg_size%.*} linear $pv" \
+             "$(( ${pe_start%.*} + first_pe * ${extent_size%.*} ))"
+    done | dmsetup create `dm_name $lv`
+    dmsetup mknodes `dm_name $lv`
+}
+
+function unmap_lv() {
+    if [ -e /dev/mapper/`dm_name $1` ]; then
+        dmsetup remove `dm_name $1`
+    fi
 }
 
 function inject_files() {
     if [ -f $startup_pkg ]; then
-        tar -xf $startup_pkg -C /mnt/bigip-config/
+        tar -xf $startup_pkg -C $config_mnt/
     fi
 
     if $firstboot_file; then
-        touch /mnt/bigip-config/firstboot > /dev/null 2>&1
+        touch $config_mnt/firstboot > /dev/null 2>&1
     fi
     if [ -f $userdata_file ]; then
-        cp $userdata_file /mnt/bigip-config
+        cp $userdata_file $config_mnt
+        if $compile_userdata; then
+            python -m f5_image_prep.userdata $userdata_file \
+                -o $config_mnt/$(basename ${userdata_file%.json}).vars
+        fi
+    fi
+
+    if [ -n "$baseisofile" -o -n "$hotfixisofile" ]; then
+        map_lv dat.share
+        mount /dev/mapper/`dm_name dat.share` $shared_mnt
     fi
 
     if [ -n "$baseisofile" ]; then
-        mount /dev/`get_dev dat.share` /mnt/bigip-shared
-        cp $baseisofile /mnt/bigip-shared/images
+        cp $baseisofile $shared_mnt/images
     fi
 
     if [ -n "$hotfixisofile" ]; then
-        mount /dev/`get_dev dat.share` /mnt/bigip-shared
-        cp $hotfixisofile /mnt/bigip-shared/images
+        cp $hotfixisofile $shared_mnt/images
     fi
 }
 
@@ -186,7 +238,7 @@ function check_oldfile_full_path() {
         if [ -z ${newfile} ]; then
             newfile=$(newfilename $ofname $hotfixisofile)
         fi
-        cp $oldfile $temp_dir/$newfile
+        cp --reflink=auto --sparse=always $oldfile $temp_dir/$newfile
     else
         if [ -f "$temp_dir/../added/$oldfile" ]; then
             oldfile="$temp_dir/../added/$oldfile"
@@ -194,7 +246,7 @@ function check_oldfile_full_path() {
             if [ -z ${newfile} ]; then
                 newfile=$(newfilename $ofname $hotfixisofile)
             fi
-            cp $oldfile $temp_dir/$newfile
+            cp --reflink=auto --sparse=always $oldfile $temp_dir/$newfile
         else
             echo "Can't find qcow file $oldfile"
             exit 1
@@ -204,7 +256,10 @@ function check_oldfile_full_path() {
 
 temp_dir="$HOME/.f5-image-prep/tmp"
 userdata_file='none'
+compile_userdata=false
 firstboot_file=false
+nbd_dev=/dev/nbd0
+mount_root=/mnt
 
 function badusage {
     echo "usage: patch-image -s startup_pkg -f -u userdata_file <image.qcow2>"
@@ -217,6 +272,8 @@ function badusage {
     echo "   -o : [patched image name] - name given to the patched image file"
     echo "   -b : [base_iso_name] - base iso to copy to /shared on image"
     echo "   -h : [hotfix_iso_name] - hotfix iso to copy to /shared on image"
+    echo "   -d : [nbd_device] - nbd device to attach the image to (default /dev/nbd0)"
+    echo "   -m : [mount_dir] - directory to create mount points in (default /mnt)"
     echo ""
     echo "The image file name must end with .qcow2"
     echo ""
@@ -249,7 +306,7 @@ else
   fi
 fi
 
-while getopts :s:u:ft:o:b:h: opt "$@"; do
+while getopts :s:u:ft:o:b:h:d:m: opt "$@"; do
   case $opt in
    s)
        startup_pkg=$OPTARG
@@ -272,8 +329,17 @@ while getopts :s:u:ft:o:b:h: opt "$@"; do
    h)
        hotfixisofile=$OPTARG
        ;;
+   d)
+       nbd_dev=$OPTARG
+       ;;
+   m)
+       mount_root=$OPTARG
+       ;;
    esac
 done
+
+config_mnt="$mount_root/bigip-config"
+shared_mnt="$mount_root/bigip-shared"
       
 mkdir -p $temp_dir
 
@@ -309,42 +375,40 @@ fi
 check_oldfile_full_path
 
 sleep 2
-qemu-nbd -d /dev/nbd0
-sleep 2
-qemu-nbd --connect=/dev/nbd0 $temp_dir/$newfile
-sleep 2
-pvscan
+qemu-nbd -d $nbd_dev
 sleep 2
-echo "The following command may cause 'Can't deactivate' messages."
-echo "These do not necessarily indicate a problem."
-vgchange -ay
+qemu-nbd --connect=$nbd_dev $temp_dir/$newfile
 sleep 2
-mkdir -p /mnt/bigip-config
+mkdir -p $config_mnt
 
-if [ -n "$baseisofile" ]; then
-    mkdir -p /mnt/bigip-shared
+if [ -n "$baseisofile" -o -n "$hotfixisofile" ]; then
+    mkdir -p $shared_mnt
 fi
 
 echo "Waiting 15 seconds"
 sleep 15
 
 # Unmount config and shared incase previous attempt to patch failed
-umount /mnt/bigip-config || [ $? -eq 1 ]
-umount /mnt/bigip-shared || [ $? -eq 1 ]
+umount $config_mnt || [ $? -eq 1 ]
+umount $shared_mnt || [ $? -eq 1 ]
+unmap_lv set.1._config
+unmap_lv dat.share
 
-mount /dev/`get_dev set.1._config` /mnt/bigip-config
+map_lv set.1._config
+mount /dev/mapper/`dm_name set.1._config` $config_mnt
 
 inject_files
 
 sleep 2
-umount /mnt/bigip-config
+umount $config_mnt
 sleep 2
-if [ -n "$baseisofile" ]; then
-    umount /mnt/bigip-shared
+if [ -n "$baseisofile" -o -n "$hotfixisofile" ]; then
+    umount $shared_mnt
 fi
 sleep 2
-vgchange -an
+unmap_lv set.1._config
+unmap_lv dat.share
 sleep 2
-qemu-nbd -d /dev/nbd0
+qemu-nbd -d $nbd_dev
 echo "Patched image located at $temp_dir/$newfile"
 set +x
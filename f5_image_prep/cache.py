@@ -0,0 +1,274 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Content-addressed cache of patched VE images.
+
+Patched images are stored under a key derived from the digests of every
+patch input and the version of the patch tool.  The cache is bounded by a
+size budget; the least recently used images are evicted first.  Images
+handed out by lookup() and store() are pinned with a shared flock() until
+release(), so an image being uploaded or backing an overlay, in this or
+another process, is never evicted.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from f5_image_prep.staging import flatten_image
+from f5_image_prep.staging import has_backing_file
+
+
+DEFAULT_CACHE_BYTES = 50 * 1024 ** 3
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+PIN_FILE = '.pin'
+
+
+def cache_dir_for(work_dir):
+    '''Default cache directory under a working directory.'''
+
+    return os.path.join(work_dir, '.f5-image-prep', 'cache')
+
+
+def hash_file(path, algorithm='sha256', block_size=HASH_BLOCK_SIZE):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as input_file:
+        while True:
+            block = input_file.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime * 1000), stat.st_ino]
+
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+def _is_pinned(entry_dir):
+    try:
+        pin_file = open(os.path.join(entry_dir, PIN_FILE), 'a')
+    except IOError:
+        return False
+    try:
+        fcntl.flock(pin_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return True
+    finally:
+        pin_file.close()
+    return False
+
+
+def inputs_fingerprint(tool_version, files, options=None, digest=hash_file):
+    '''Digest identifying a set of patch inputs.
+
+    :param tool_version: str -- identifies the patch tool and version
+    :param files: dict -- input name to file path (or None)
+    :param options: dict -- further inputs that affect the output
+    :param digest: callable -- returns the hex digest of a file
+    :returns: str -- hex digest
+    '''
+
+    inputs = {'tool': tool_version, 'options': options or {}}
+    for name, path in files.items():
+        inputs[name] = digest(path) if path else None
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class PatchCache(object):
+    '''LRU cache of patched images keyed by their patch inputs.'''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        '''Initialize a PatchCache object.
+
+        :param cache_dir: str -- directory holding cached images
+        :param max_bytes: int -- size budget for all cached images
+        '''
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pins = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @contextlib.contextmanager
+    def _index(self):
+        '''Lock and load the index, saving it back on exit.'''
+
+        with self._lock:
+            with open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                index_path = os.path.join(self.cache_dir, INDEX_FILE)
+                try:
+                    with open(index_path) as index_file:
+                        index = json.load(index_file)
+                except (IOError, ValueError):
+                    index = {}
+                index.setdefault('entries', {})
+                index.setdefault('digests', {})
+                yield index
+                tmp_path = index_path + '.tmp'
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(index, index_file, indent=1, sort_keys=True)
+                os.rename(tmp_path, index_path)
+
+    def file_digest(self, path, algorithm='sha256'):
+        '''Digest of a file, memoized by its size, mtime and inode.'''
+
+        path = os.path.realpath(path)
+        signature = _stat_signature(path)
+        with self._index() as index:
+            known = index['digests'].get(path)
+            if known and known['signature'] == signature and \
+                    algorithm in known:
+                return known[algorithm]
+        digest = hash_file(path, algorithm)
+        self._remember_digest(path, signature, algorithm, digest)
+        return digest
+
+    def known_digest(self, path, algorithm='sha256'):
+        '''Memoized digest of an unchanged file, None instead of hashing.'''
+
+        path = os.path.realpath(path)
+        signature = _stat_signature(path)
+        with self._index() as index:
+            known = index['digests'].get(path)
+            if known and known['signature'] == signature:
+                return known.get(algorithm)
+        return None
+
+    def record_digest(self, path, algorithm, digest):
+        '''Memoize a digest computed elsewhere, e.g. while uploading.'''
+
+        path = os.path.realpath(path)
+        self._remember_digest(path, _stat_signature(path), algorithm, digest)
+
+    def _remember_digest(self, path, signature, algorithm, digest):
+        with self._index() as index:
+            known = index['digests'].get(path)
+            if not known or known['signature'] != signature:
+                known = index['digests'][path] = {'signature': signature}
+            known[algorithm] = digest
+
+    def key_for(self, tool_version, files, options=None):
+        '''Compute the cache key for a set of patch inputs.
+
+        :param tool_version: str -- identifies the patch tool and version
+        :param files: dict -- input name to file path (or None)
+        :param options: dict -- further inputs that affect the output
+        :returns: str -- hex digest
+        '''
+
+        return inputs_fingerprint(tool_version, files, options,
+                                  self.file_digest)
+
+    def lookup(self, key):
+        '''Return the cached image for a key, or None.'''
+
+        with self._index() as index:
+            entry = index['entries'].get(key)
+            if entry is None:
+                return None
+            if not os.path.isfile(entry['path']):
+                del index['entries'][key]
+                return None
+            entry['last_used'] = time.time()
+            self._pin(entry['path'])
+            return entry['path']
+
+    def store(self, key, image_path):
+        '''Move a freshly patched image into the cache.
+
+        Overlays are flattened first so that cached images never depend on
+        a download that may be deleted later.
+
+        :returns: str -- path of the cached image
+        '''
+
+        entry_dir = os.path.join(self.cache_dir, key[:2], key)
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        cached_path = os.path.join(entry_dir, os.path.basename(image_path))
+        if has_backing_file(image_path):
+            flatten_image(image_path, cached_path)
+            os.unlink(image_path)
+        else:
+            shutil.move(image_path, cached_path)
+
+        with self._index() as index:
+            index['entries'][key] = {
+                'path': cached_path,
+                'size': _dir_size(entry_dir),
+                'last_used': time.time(),
+            }
+            self._pin(cached_path)
+            self._evict(index, keep=key)
+        return cached_path
+
+    def _pin(self, path):
+        # Called with the index locked, so eviction cannot interleave.
+        pin_file = open(os.path.join(os.path.dirname(path), PIN_FILE), 'a')
+        fcntl.flock(pin_file, fcntl.LOCK_SH)
+        self._pins.setdefault(path, []).append(pin_file)
+
+    def release(self, path):
+        '''Unpin an image returned by lookup() or store().
+
+        Paths that were not handed out by the cache are ignored.
+        '''
+
+        with self._lock:
+            pins = self._pins.get(path)
+            if not pins:
+                return
+            pin_file = pins.pop()
+            if not pins:
+                del self._pins[path]
+        pin_file.close()
+
+    def _evict(self, index, keep):
+        for path in list(index['digests']):
+            if not os.path.exists(path):
+                del index['digests'][path]
+
+        entries = index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            entry_dir = os.path.dirname(entries[key]['path'])
+            if key == keep or _is_pinned(entry_dir):
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= entries[key]['size']
+            del entries[key]
@@ -0,0 +1,242 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Upload one image to several Glance endpoints from a single read.
+
+A producer reads the image once and hands every chunk to a bounded queue
+per target, so memory stays at a few chunks per target and the slowest
+endpoint sets the pace.  A target that fails leaves the shared stream and
+is retried on its own, reading the file again.  Every consumer of a shared
+read has to keep up with it, so at most ``workers`` targets share one read;
+further targets are uploaded from further reads once those are done.
+"""
+
+import errno
+from multiprocessing.pool import ThreadPool
+import os
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import time
+
+from f5_image_prep.upload import DEFAULT_CHUNK_SIZE
+from f5_image_prep.upload import UploadReader
+
+
+DEFAULT_QUEUE_CHUNKS = 4
+DEFAULT_RETRIES = 2
+DEFAULT_WORKERS = 8
+PUT_TIMEOUT = 0.5
+
+TARGET_PENDING = 'pending'
+TARGET_UPLOADING = 'uploading'
+TARGET_UPLOADED = 'uploaded'
+TARGET_REUSED = 'reused'
+TARGET_FAILED = 'failed'
+
+
+class UploadTarget(object):
+    '''A Glance endpoint an image is uploaded to, and how that went.'''
+
+    def __init__(self, name, creds):
+        self.name = name
+        self.creds = creds
+        self.status = TARGET_PENDING
+        self.image = None
+        self.error = None
+        self.attempts = 0
+        self.elapsed = None
+
+    def __repr__(self):
+        return '<UploadTarget %s %s>' % (self.name, self.status)
+
+
+class QueueReader(object):
+    '''File object fed with chunks by the producer of a fan-out upload.'''
+
+    def __init__(self, size, queue_chunks=DEFAULT_QUEUE_CHUNKS):
+        self.size = size
+        self.abandoned = False
+        self._queue = queue.Queue(maxsize=queue_chunks)
+        self._chunk = b''
+        self._chunk_pos = 0
+        self._consumed = 0
+        self._position = 0
+        self._eof = False
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            data = self.read(DEFAULT_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def put(self, chunk):
+        '''Queue a chunk, unless the consumer gave up.  None ends the data.
+
+        :returns: bool -- False once the consumer has abandoned the stream
+        '''
+
+        while not self.abandoned:
+            try:
+                self._queue.put(chunk, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def abandon(self):
+        self.abandoned = True
+
+    def read(self, size=-1):
+        if self._position != self._consumed:
+            raise IOError(errno.ESPIPE, 'Shared upload streams cannot seek')
+        if self._chunk_pos >= len(self._chunk):
+            if self._eof:
+                return b''
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                return b''
+            self._chunk, self._chunk_pos = chunk, 0
+        available = len(self._chunk) - self._chunk_pos
+        if size is None or size < 0 or size > available:
+            size = available
+        data = self._chunk[self._chunk_pos:self._chunk_pos + size]
+        self._chunk_pos += len(data)
+        self._consumed += len(data)
+        self._position = self._consumed
+        return data
+
+    def seekable(self):
+        # Callers pass the size explicitly instead of probing for it.
+        return False
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Only size probes (seek to the end and back) are supported.
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = offset
+
+
+class FanOutUpload(object):
+    '''Upload one file to many targets concurrently.'''
+
+    def __init__(self, path, targets, upload, retries=DEFAULT_RETRIES,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 queue_chunks=DEFAULT_QUEUE_CHUNKS, progress=None,
+                 raw=False, workers=DEFAULT_WORKERS):
+        '''Initialize a FanOutUpload object.
+
+        :param path: str -- file to upload
+        :param targets: list -- UploadTarget objects
+        :param upload: callable -- upload(target, data, reader) uploads the
+            file object data and returns the image; reader is the
+            UploadReader whose digests describe the data
+        :param retries: int -- further attempts for each failed target
+        :param progress: callable -- progress of the shared read
+        :param raw: bool -- send the guest disk of a qcow2 image as raw data
+        :param workers: int -- maximum number of concurrent uploads, which
+            is also the number of targets sharing one read
+        '''
+
+        self.path = path
+        self.targets = list(targets)
+        self.upload = upload
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.queue_chunks = queue_chunks
+        self.progress = progress
+        self.raw = raw
+        self.workers = max(1, workers)
+
+    def run(self):
+        '''Upload to every target and return them with their status.'''
+
+        if not self.targets:
+            return self.targets
+        pool = ThreadPool(min(self.workers, len(self.targets)))
+        try:
+            for start in range(0, len(self.targets), self.workers):
+                self._run_group(pool,
+                                self.targets[start:start + self.workers])
+        finally:
+            pool.close()
+            pool.join()
+        return self.targets
+
+    def _run_group(self, pool, targets):
+        '''Upload to targets that all consume the same read of the file.'''
+
+        with UploadReader(self.path, chunk_size=self.chunk_size,
+                          progress=self.progress, raw=self.raw) as reader:
+            streams = [QueueReader(reader.size, self.queue_chunks)
+                       for _target in targets]
+            results = pool.map_async(
+                lambda args: self._upload_target(reader, *args),
+                zip(targets, streams))
+            self._produce(reader, streams)
+            results.get()
+
+    def _produce(self, reader, streams):
+        try:
+            for chunk in reader:
+                live = [stream.put(chunk) for stream in streams]
+                if not any(live):
+                    break
+        finally:
+            for stream in streams:
+                stream.put(None)
+
+    def _upload_target(self, shared_reader, target, stream):
+        start = time.time()
+        target.status = TARGET_UPLOADING
+        try:
+            target.attempts += 1
+            target.image = self.upload(target, stream, shared_reader)
+        except Exception as err:
+            stream.abandon()
+            target.error = err
+            self._retry(target)
+        else:
+            stream.abandon()
+            target.status = TARGET_UPLOADED
+        target.elapsed = time.time() - start
+
+    def _retry(self, target):
+        while target.attempts <= self.retries:
+            print('%s: upload failed (%s), retrying' % (
+                target.name, target.error))
+            target.attempts += 1
+            try:
+                with UploadReader(self.path, chunk_size=self.chunk_size,
+                                  raw=self.raw) as reader:
+                    target.image = self.upload(target, reader, reader)
+            except Exception as err:
+                target.error = err
+            else:
+                target.error = None
+                target.status = TARGET_UPLOADED
+                return
+        target.status = TARGET_FAILED
@@ -0,0 +1,338 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process injection of files into the filesystems of a VE image.
+
+This is the equivalent of the nbd/LVM/mount sequence in patch-image.sh.
+The logical volume is located from the LVM metadata on the guest disk and
+copied sparsely into a scratch file.  The files are written into that
+filesystem with debugfs, which needs no privileges, and only the clusters
+that changed are written back into the qcow2 image.
+"""
+
+import errno
+import os
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+
+from f5_image_prep.lvm import find_logical_volume
+from f5_image_prep.qcow2 import Qcow2Image
+from f5_image_prep.userdata import compile_userdata_file
+from f5_image_prep.userdata import compiled_name
+
+
+CONFIG_LV = 'set.1._config'
+SHARE_LV = 'dat.share'
+ISO_DIR = '/images'
+FIRSTBOOT_FILE = '/firstboot'
+
+COPY_CHUNK = 1024 * 1024
+COMPARE_CHUNK = 64 * 1024
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_INCOMPAT_RECOVER = 0x0004
+
+SBIN_SEARCH_PATH = ['/sbin', '/usr/sbin', '/bin', '/usr/bin']
+
+
+class InjectionFailed(Exception):
+    pass
+
+
+def find_program(name):
+    '''Find an executable, including sbin dirs missing from PATH.
+
+    :returns: str -- path of the executable, or None
+    '''
+
+    search = os.environ.get('PATH', '').split(os.pathsep)
+    for directory in search + SBIN_SEARCH_PATH:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def find_debugfs():
+    '''Find the debugfs binary, including sbin dirs missing from PATH.'''
+
+    debugfs = find_program('debugfs')
+    if debugfs is None:
+        raise InjectionFailed(
+            'debugfs (e2fsprogs) is required to inject files')
+    return debugfs
+
+
+def _data_ranges(fileobj, size):
+    '''Yield (start, end) ranges of a sparse file that may hold data.'''
+
+    fd = fileobj.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                return
+            # No hole detection on this filesystem: everything is data.
+            yield offset, size
+            return
+        yield start, min(end, size)
+        offset = end
+
+
+def _quote(path):
+    if '"' in path or '\n' in path:
+        raise InjectionFailed('Unsupported character in path %r' % path)
+    return '"%s"' % path if ' ' in path else path
+
+
+class DebugFsScript(object):
+    '''Accumulate debugfs commands that create files in an ext filesystem.'''
+
+    def __init__(self):
+        self.commands = []
+        self._dirs = set(['/'])
+
+    def mkdir(self, path, mode=None, uid=0, gid=0, mtime=None):
+        '''Create a directory and its parents.
+
+        Attributes are only set when a mode is given, so directories that
+        already exist in the image keep theirs.
+        '''
+
+        path = path.rstrip('/') or '/'
+        if path in self._dirs:
+            return
+        self.mkdir(os.path.dirname(path))
+        self._dirs.add(path)
+        self.commands.append('mkdir %s' % _quote(path))
+        if mode is not None:
+            self._set_attrs(path, 0o040000 | mode, uid, gid, mtime)
+
+    def write(self, local_path, path, mode=0o644, uid=0, gid=0, mtime=None):
+        directory, name = os.path.split(path)
+        self.mkdir(directory)
+        self.commands.append('cd %s' % _quote(directory or '/'))
+        self.commands.append('rm %s' % _quote(name))
+        self.commands.append(
+            'write %s %s' % (_quote(local_path), _quote(name)))
+        self._set_attrs(path, 0o100000 | mode, uid, gid, mtime)
+
+    def symlink(self, path, target):
+        directory, name = os.path.split(path)
+        self.mkdir(directory)
+        self.commands.append('cd %s' % _quote(directory or '/'))
+        self.commands.append('rm %s' % _quote(name))
+        self.commands.append('symlink %s %s' % (_quote(name), _quote(target)))
+
+    def _set_attrs(self, path, mode, uid, gid, mtime):
+        path = _quote(path)
+        self.commands.append('sif %s mode 0%o' % (path, mode))
+        self.commands.append('sif %s uid %d' % (path, uid))
+        self.commands.append('sif %s gid %d' % (path, gid))
+        if mtime is not None:
+            self.commands.append('sif %s mtime @%d' % (path, mtime))
+
+    def run(self, fs_image, work_dir):
+        '''Apply the commands to a filesystem image with debugfs -w.'''
+
+        fd, script_path = tempfile.mkstemp(dir=work_dir, suffix='.debugfs')
+        with os.fdopen(fd, 'w') as script:
+            script.write('\n'.join(self.commands) + '\n')
+        try:
+            proc = subprocess.Popen(
+                [find_debugfs(), '-w', '-f', script_path, fs_image],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+        finally:
+            os.unlink(script_path)
+        errors = [line for line in output.splitlines()
+                  if self._is_error(line)]
+        if proc.returncode or errors:
+            raise InjectionFailed(
+                'debugfs failed to update %s: %s' %
+                (fs_image, '; '.join(errors) or output))
+
+    @staticmethod
+    def _is_error(line):
+        line = line.strip()
+        if not line or line.startswith('debugfs') or \
+                line.startswith('Using EXT2FS') or \
+                line.startswith('Allocated inode'):
+            return False
+        # mkdir of an existing directory and rm of a missing file are
+        # expected when overwriting files that ship in the image.
+        if 'mkdir' in line.split(':')[0] and 'already exists' in line:
+            return False
+        if line.startswith('rm:') and 'File not found' in line:
+            return False
+        return True
+
+
+class ImageInjector(object):
+    '''Inject startup scripts, userdata and ISOs into a qcow2 VE image.'''
+
+    def __init__(self, image_path, work_dir=None):
+        '''Initialize an ImageInjector object.
+
+        :param image_path: str -- path to a writable qcow2 VE image
+        :param work_dir: str -- directory for scratch files
+        '''
+
+        self.image_path = image_path
+        self.work_dir = os.path.abspath(
+            work_dir or os.path.dirname(image_path))
+
+    def inject(self, startup_pkg=None, userdata=None, firstboot=False,
+               base_iso=None, hotfix_iso=None):
+        '''Write files into /config and /shared of the image.
+
+        :param startup_pkg: str -- tarball extracted into /config
+        :param userdata: str -- userdata JSON file copied into /config,
+            together with its compiled form
+        :param firstboot: bool -- create /config/firstboot
+        :param base_iso: str -- ISO copied into /shared/images
+        :param hotfix_iso: str -- ISO copied into /shared/images
+        '''
+
+        scratch = tempfile.mkdtemp(prefix='inject-', dir=self.work_dir)
+        try:
+            config = DebugFsScript()
+            if startup_pkg:
+                self._add_tarball(config, startup_pkg, scratch)
+            if firstboot:
+                empty = os.path.join(scratch, 'firstboot')
+                open(empty, 'w').close()
+                config.write(empty, FIRSTBOOT_FILE)
+            if userdata:
+                config.write(os.path.abspath(userdata),
+                             '/' + os.path.basename(userdata),
+                             mode=os.stat(userdata).st_mode & 0o777)
+                compiled = os.path.join(scratch, compiled_name(userdata))
+                compile_userdata_file(userdata, compiled)
+                config.write(compiled, '/' + compiled_name(userdata),
+                             mode=0o600)
+
+            share = DebugFsScript()
+            for iso in (base_iso, hotfix_iso):
+                if iso:
+                    share.write(os.path.abspath(iso), os.path.join(
+                        ISO_DIR, os.path.basename(iso)))
+
+            with Qcow2Image(self.image_path, writable=True) as disk:
+                if config.commands:
+                    self._update_volume(disk, CONFIG_LV, config, scratch)
+                if share.commands:
+                    self._update_volume(disk, SHARE_LV, share, scratch)
+                disk.flush()
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def _add_tarball(self, script, tarball, scratch):
+        extract_dir = os.path.join(scratch, 'startup')
+        archive = tarfile.open(tarball)
+        try:
+            for member in archive.getmembers():
+                path = os.path.normpath('/' + member.name)
+                if path == '/':
+                    continue
+                if member.isdir():
+                    script.mkdir(path, member.mode & 0o7777, member.uid,
+                                 member.gid, member.mtime)
+                elif member.issym():
+                    script.symlink(path, member.linkname)
+                elif member.isfile():
+                    local_path = os.path.join(extract_dir, path.lstrip('/'))
+                    if not os.path.isdir(os.path.dirname(local_path)):
+                        os.makedirs(os.path.dirname(local_path))
+                    source = archive.extractfile(member)
+                    with open(local_path, 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                    script.write(local_path, path, member.mode & 0o7777,
+                                 member.uid, member.gid, member.mtime)
+        finally:
+            archive.close()
+
+    def _update_volume(self, disk, lv_name, script, scratch):
+        volume = find_logical_volume(disk, lv_name)
+        fs_image = os.path.join(scratch, lv_name)
+        with open(fs_image, 'wb') as fs_file:
+            self._extract_volume(disk, volume, fs_file)
+        self._check_filesystem(fs_image)
+        script.run(fs_image, scratch)
+        with open(fs_image, 'rb') as fs_file:
+            self._write_back_volume(disk, volume, fs_file)
+        os.unlink(fs_image)
+
+    @staticmethod
+    def _extract_volume(disk, volume, fs_file):
+        '''Copy the allocated parts of a logical volume into a sparse file.'''
+
+        zeros = b'\0' * COPY_CHUNK
+        for lv_offset in range(0, volume.size, COPY_CHUNK):
+            length = min(COPY_CHUNK, volume.size - lv_offset)
+            for offset, disk_offset, count in volume.disk_ranges(
+                    lv_offset, length):
+                if not disk.is_allocated(disk_offset, count):
+                    continue
+                data = disk.read(disk_offset, count)
+                if data != zeros[:count]:
+                    fs_file.seek(offset)
+                    fs_file.write(data)
+        fs_file.truncate(volume.size)
+
+    @staticmethod
+    def _write_back_volume(disk, volume, fs_file):
+        '''Write the chunks of the filesystem that changed into the image.
+
+        Holes in the scratch file were zero in the image and debugfs never
+        punches holes, so only the data ranges have to be compared.
+        '''
+
+        for start, end in _data_ranges(fs_file, volume.size):
+            start -= start % COMPARE_CHUNK
+            for lv_offset in range(start, end, COMPARE_CHUNK):
+                length = min(COMPARE_CHUNK, volume.size - lv_offset)
+                fs_file.seek(lv_offset)
+                new = fs_file.read(length)
+                position = 0
+                for _offset, disk_offset, count in volume.disk_ranges(
+                        lv_offset, length):
+                    chunk = new[position:position + count]
+                    if disk.read(disk_offset, count) != chunk:
+                        disk.write(disk_offset, chunk)
+                    position += count
+
+    @staticmethod
+    def _check_filesystem(fs_image):
+        with open(fs_image, 'rb') as fs_file:
+            fs_file.seek(EXT_SUPERBLOCK_OFFSET)
+            superblock = fs_file.read(1024)
+        magic = struct.unpack('<H', superblock[56:58])[0]
+        incompat = struct.unpack('<I', superblock[96:100])[0]
+        if magic != EXT_MAGIC:
+            raise InjectionFailed('%s does not hold an ext filesystem' %
+                                  os.path.basename(fs_image))
+        if incompat & EXT_INCOMPAT_RECOVER:
+            raise InjectionFailed('Filesystem %s needs journal recovery' %
+                                  os.path.basename(fs_image))
@@ -0,0 +1,298 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Locate LVM2 logical volumes inside a guest disk without activating them.
+
+The guest disk is any object with ``read(offset, length)`` and ``size``
+attributes, such as :class:`f5_image_prep.qcow2.Qcow2Image`.
+"""
+
+import re
+import struct
+
+
+SECTOR_SIZE = 512
+LABEL_SCAN_SECTORS = 4
+LABEL_ID = b'LABELONE'
+LVM2_TYPE = b'LVM2 001'
+MDA_MAGIC = b' LVM2 x[5A%r0N*>'
+MDA_HEADER_SIZE = 512
+
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_PROTECTIVE_TYPE = 0xee
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+GPT_SIGNATURE = b'EFI PART'
+
+
+class LVMError(Exception):
+    pass
+
+
+class LogicalVolumeNotFound(LVMError):
+    pass
+
+
+def find_partitions(disk):
+    '''Find candidate physical volume locations on a guest disk.
+
+    The whole disk is always a candidate; MBR primary and GPT partitions
+    are added when a partition table is present.
+
+    :param disk: object with read() and size
+    :returns: list of (offset, size) tuples in bytes
+    '''
+
+    candidates = [(0, disk.size)]
+    mbr = disk.read(0, SECTOR_SIZE)
+    if mbr[510:512] != MBR_SIGNATURE:
+        return candidates
+
+    gpt = False
+    for index in range(4):
+        entry = mbr[446 + index * 16:446 + (index + 1) * 16]
+        part_type = bytearray(entry[4:5])[0]
+        start, sectors = struct.unpack('<II', entry[8:16])
+        if part_type == MBR_PROTECTIVE_TYPE:
+            gpt = True
+        elif part_type and part_type not in MBR_EXTENDED_TYPES and sectors:
+            candidates.append((start * SECTOR_SIZE, sectors * SECTOR_SIZE))
+
+    if gpt:
+        header = disk.read(SECTOR_SIZE, SECTOR_SIZE)
+        if header[:8] == GPT_SIGNATURE:
+            entries_lba, nb_entries, entry_size = struct.unpack(
+                '<QII', header[72:88])
+            table = disk.read(entries_lba * SECTOR_SIZE,
+                              nb_entries * entry_size)
+            for index in range(nb_entries):
+                entry = table[index * entry_size:(index + 1) * entry_size]
+                if entry[:16] == b'\0' * 16:
+                    continue
+                first, last = struct.unpack('<QQ', entry[32:48])
+                candidates.append((first * SECTOR_SIZE,
+                                   (last - first + 1) * SECTOR_SIZE))
+    return candidates
+
+
+class PhysicalVolume(object):
+    '''LVM2 label and metadata of a physical volume.'''
+
+    def __init__(self, disk, offset, size):
+        self.disk = disk
+        self.offset = offset
+        self.size = size
+        self.uuid = None
+        self.metadata_areas = []
+        self._read_label()
+
+    def _read_label(self):
+        for sector in range(LABEL_SCAN_SECTORS):
+            label = self.disk.read(self.offset + sector * SECTOR_SIZE,
+                                   SECTOR_SIZE)
+            if label[:8] == LABEL_ID and label[24:32] == LVM2_TYPE:
+                break
+        else:
+            raise LVMError('No LVM2 label at offset %d' % self.offset)
+
+        header_offset = struct.unpack('<I', label[20:24])[0]
+        header = label[header_offset:]
+        self.uuid = header[:32].decode('ascii')
+        position = 40
+        # Skip the data area list, then collect the metadata areas.
+        for areas in (None, self.metadata_areas):
+            while True:
+                area_offset, area_size = struct.unpack(
+                    '<QQ', header[position:position + 16])
+                position += 16
+                if not area_offset:
+                    break
+                if areas is not None:
+                    areas.append((area_offset, area_size))
+
+    def read_metadata(self):
+        '''Return the text of the most recent VG metadata on this PV.'''
+
+        for area_offset, area_size in self.metadata_areas:
+            start = self.offset + area_offset
+            header = self.disk.read(start, MDA_HEADER_SIZE)
+            if header[4:20] != MDA_MAGIC:
+                continue
+            text_offset, text_size = struct.unpack('<QQ', header[40:56])
+            if not text_size:
+                continue
+            if text_offset + text_size > area_size:
+                first = area_size - text_offset
+                text = self.disk.read(start + text_offset, first) + \
+                    self.disk.read(start + MDA_HEADER_SIZE, text_size - first)
+            else:
+                text = self.disk.read(start + text_offset, text_size)
+            return text.rstrip(b'\0').decode('utf-8')
+        raise LVMError('No metadata found on PV %s' % self.uuid)
+
+
+_TOKEN_RE = re.compile(r'''
+    \s+ | \#[^\n]* |
+    (?P<string>"(?:[^"\\]|\\.)*") |
+    (?P<number>-?\d+(?:\.\d+)?) |
+    (?P<punct>[{}\[\]=,]) |
+    (?P<name>[A-Za-z0-9_.+\-/]+)
+''', re.VERBOSE)
+
+
+def _tokenize(text):
+    position = 0
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if not match:
+            raise LVMError('Cannot parse LVM metadata near %r' %
+                           text[position:position + 20])
+        position = match.end()
+        kind = match.lastgroup
+        if kind:
+            yield kind, match.group(kind)
+
+
+def parse_metadata(text):
+    '''Parse LVM2 text metadata into nested dictionaries.
+
+    :param text: str -- metadata as stored in a metadata area
+    :returns: dict
+    '''
+
+    tokens = list(_tokenize(text))
+    position = [0]
+
+    def next_token():
+        token = tokens[position[0]]
+        position[0] += 1
+        return token
+
+    def parse_value():
+        kind, value = next_token()
+        if kind == 'string':
+            return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        if kind == 'number':
+            return float(value) if '.' in value else int(value)
+        if value == '[':
+            items = []
+            while tokens[position[0]][1] != ']':
+                items.append(parse_value())
+                if tokens[position[0]][1] == ',':
+                    next_token()
+            next_token()
+            return items
+        raise LVMError('Unexpected token %r in LVM metadata' % value)
+
+    def parse_section(closing):
+        section = {}
+        while position[0] < len(tokens):
+            kind, value = next_token()
+            if value == '}' and closing:
+                return section
+            marker = next_token()[1]
+            if marker == '{':
+                section[value] = parse_section(True)
+            elif marker == '=':
+                section[value] = parse_value()
+            else:
+                raise LVMError('Unexpected token %r in LVM metadata' % marker)
+        if closing:
+            raise LVMError('Unterminated section in LVM metadata')
+        return section
+
+    return parse_section(False)
+
+
+class LogicalVolume(object):
+    '''Byte-level map of a linear logical volume onto the guest disk.'''
+
+    def __init__(self, name, extents):
+        self.name = name
+        # list of (lv_offset, disk_offset, length) in bytes
+        self.extents = extents
+        self.size = sum(length for _lv, _disk, length in extents)
+
+    def disk_ranges(self, offset, length):
+        '''Translate an LV byte range into guest disk byte ranges.'''
+
+        for lv_offset, disk_offset, extent_length in self.extents:
+            if length <= 0:
+                break
+            if offset >= lv_offset + extent_length:
+                continue
+            skip = offset - lv_offset
+            count = min(length, extent_length - skip)
+            yield offset, disk_offset + skip, count
+            offset += count
+            length -= count
+
+
+def _volume_groups(metadata):
+    for name, value in metadata.items():
+        if isinstance(value, dict) and 'logical_volumes' in value:
+            yield name, value
+
+
+def find_logical_volume(disk, lv_name):
+    '''Locate a logical volume by name on a guest disk.
+
+    :param disk: object with read() and size
+    :param lv_name: str -- name of the logical volume, e.g. set.1._config
+    :returns: LogicalVolume
+    :raises: LogicalVolumeNotFound
+    '''
+
+    pvs = {}
+    metadata = None
+    for offset, size in find_partitions(disk):
+        try:
+            pv = PhysicalVolume(disk, offset, size)
+        except LVMError:
+            continue
+        pvs[pv.uuid] = pv
+        if metadata is None and pv.metadata_areas:
+            metadata = parse_metadata(pv.read_metadata())
+
+    if metadata is None:
+        raise LogicalVolumeNotFound('No LVM physical volume found on disk')
+
+    for _vg_name, vg in _volume_groups(metadata):
+        lv = vg['logical_volumes'].get(lv_name)
+        if lv is None:
+            continue
+        extent_size = vg['extent_size'] * SECTOR_SIZE
+        extents = []
+        for key in sorted(k for k in lv if k.startswith('segment')):
+            segment = lv[key]
+            if not isinstance(segment, dict):
+                continue
+            if segment.get('type') != 'striped' or \
+                    segment.get('stripe_count') != 1:
+                raise LVMError('Only linear logical volumes are supported')
+            pv_name, pv_extent = segment['stripes'][:2]
+            pv_meta = vg['physical_volumes'][pv_name]
+            pv = pvs.get(pv_meta['id'].replace('-', ''))
+            if pv is None:
+                raise LVMError('Physical volume %s for %s is missing' %
+                               (pv_name, lv_name))
+            extents.append((
+                segment['start_extent'] * extent_size,
+                pv.offset + pv_meta['pe_start'] * SECTOR_SIZE +
+                pv_extent * extent_size,
+                segment['extent_count'] * extent_size))
+        extents.sort()
+        return LogicalVolume(lv_name, extents)
+
+    raise LogicalVolumeNotFound('Logical volume %s not found' % lv_name)
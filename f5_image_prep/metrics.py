@@ -0,0 +1,136 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Timed spans of the image prep stages, written as JSON lines.
+
+Every record is one JSON object per line.  Spans carry the slash-separated
+path of the stages they are nested in, so ``sync_image/patch/stage`` is the
+copy of the image inside the patch stage.  A span given a byte count also
+reports its throughput in MB/s.
+"""
+
+import json
+import threading
+import time
+
+
+MB = 1000.0 * 1000.0
+
+
+class _Output(object):
+    '''Destination shared by a Metrics object and the ones bound from it.'''
+
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.out.write(line)
+            self.out.flush()
+
+
+class Span(object):
+    '''A timed stage; use it as a context manager.'''
+
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+        self.start = None
+        self.elapsed = None
+
+    def set(self, **fields):
+        '''Add fields, such as the byte count, once they are known.'''
+
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = self.metrics._output.stack()
+        stack.append(self.name)
+        self.path = '/'.join(stack)
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = self.metrics.clock() - self.start
+        self.metrics._output.stack().pop()
+        record = dict(self.fields, span=self.path,
+                      start=round(self.start, 6),
+                      elapsed=round(self.elapsed, 6),
+                      status='ok' if exc_type is None else 'error')
+        if exc_type is not None:
+            record['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+        if record.get('bytes') and self.elapsed > 0:
+            record['mb_per_s'] = round(
+                record['bytes'] / MB / self.elapsed, 3)
+        self.metrics.emit(record)
+        return False
+
+
+class Metrics(object):
+    '''Emit spans and events as JSON lines; a no-op without an output.'''
+
+    def __init__(self, out=None, clock=time.time, **fields):
+        '''Initialize a Metrics object.
+
+        :param out: file object the JSON lines are written to
+        :param clock: callable -- returns the current time in seconds
+        :param fields: added to every record, e.g. image='BIGIP.qcow2'
+        '''
+
+        self._output = _Output(out)
+        self.clock = clock
+        self.fields = fields
+
+    @property
+    def enabled(self):
+        return self._output.out is not None
+
+    def bind(self, **fields):
+        '''Metrics writing to the same output with further fields.'''
+
+        bound = Metrics.__new__(Metrics)
+        bound._output = self._output
+        bound.clock = self.clock
+        bound.fields = dict(self.fields, **fields)
+        return bound
+
+    def span(self, name, **fields):
+        '''Time a stage, nested inside the spans open in this thread.'''
+
+        return Span(self, name, fields)
+
+    def event(self, name, **fields):
+        '''Record something that has no duration of its own.'''
+
+        self.emit(dict(fields, event=name, time=round(self.clock(), 6)))
+
+    def emit(self, record):
+        if self.enabled:
+            self._output.write(dict(self.fields, **record))
+
+
+def open_metrics(path):
+    '''Metrics appending to a file, so runs can be compared over time.'''
+
+    return Metrics(open(path, 'a'))
@@ -0,0 +1,175 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Hand out nbd devices and mount directories to concurrent patch workers."""
+
+import contextlib
+import fcntl
+import os
+import re
+import tempfile
+import threading
+
+
+SYSFS_BLOCK = '/sys/block'
+DEFAULT_NBDS_MAX = 16
+LOCK_DIR = tempfile.gettempdir()
+
+
+class NbdPoolExhausted(Exception):
+    pass
+
+
+def list_nbd_devices(sysfs=SYSFS_BLOCK):
+    '''List the nbd devices known to the kernel, in numeric order.'''
+
+    try:
+        names = os.listdir(sysfs)
+    except OSError:
+        names = []
+    numbers = sorted(int(match.group(1)) for match in
+                     (re.match(r'^nbd(\d+)$', name) for name in names)
+                     if match)
+    return ['/dev/nbd%d' % number for number in numbers]
+
+
+def nbd_in_use(device, sysfs=SYSFS_BLOCK):
+    '''Report whether a qemu-nbd process is attached to the device.'''
+
+    name = os.path.basename(device)
+    if os.path.exists(os.path.join(sysfs, name, 'pid')):
+        return True
+    try:
+        with open(os.path.join(sysfs, name, 'size')) as size_file:
+            return int(size_file.read().strip() or 0) != 0
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def remove_mount_dir(mount_dir):
+    '''Remove the mount points of a slot, then the slot directory.
+
+    Only empty directories are removed.  A mount point whose umount failed
+    is busy or holds the mounted filesystem, and is left alone.
+    '''
+
+    try:
+        names = os.listdir(mount_dir)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.rmdir(os.path.join(mount_dir, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(mount_dir)
+    except OSError:
+        pass
+
+
+class NbdSlot(object):
+    '''An nbd device and a private mount directory owned by one worker.'''
+
+    def __init__(self, device, mount_dir, lock_file):
+        self.device = device
+        self.mount_dir = mount_dir
+        self._lock_file = lock_file
+
+
+class NbdDevicePool(object):
+    '''Thread-safe pool of nbd devices.
+
+    Every device is also guarded by an flock()ed lock file, so separate
+    processes sharing a host never pick the same device either.
+    '''
+
+    def __init__(self, devices=None, lock_dir=LOCK_DIR, mount_root=None,
+                 sysfs=SYSFS_BLOCK):
+        '''Initialize an NbdDevicePool object.
+
+        :param devices: list -- nbd device paths, discovered if not given
+        :param lock_dir: str -- directory for per-device lock files
+        :param mount_root: str -- parent of the per-slot mount directories
+        '''
+
+        if devices is None:
+            devices = list_nbd_devices(sysfs) or \
+                ['/dev/nbd%d' % number for number in range(DEFAULT_NBDS_MAX)]
+        self.devices = list(devices)
+        self.lock_dir = lock_dir
+        self.mount_root = mount_root
+        self.sysfs = sysfs
+        self._free = list(self.devices)
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def _try_lock(self, device):
+        lock_path = os.path.join(
+            self.lock_dir, 'f5-image-prep-%s.lock' % os.path.basename(device))
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        if nbd_in_use(device, self.sysfs):
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            return None
+        return lock_file
+
+    def acquire(self):
+        '''Reserve a free device and create a mount directory for it.
+
+        :returns: NbdSlot
+        :raises: NbdPoolExhausted -- when no device is free on the host
+        '''
+
+        with self._cond:
+            while not self._free:
+                self._cond.wait()
+            for device in list(self._free):
+                lock_file = self._try_lock(device)
+                if lock_file is not None:
+                    self._free.remove(device)
+                    break
+            else:
+                raise NbdPoolExhausted(
+                    'All nbd devices are in use by other processes')
+        mount_dir = tempfile.mkdtemp(
+            prefix='f5-image-prep-%s-' % os.path.basename(device),
+            dir=self.mount_root)
+        return NbdSlot(device, mount_dir, lock_file)
+
+    def release(self, slot):
+        '''Return a device to the pool and remove its mount directory.'''
+
+        remove_mount_dir(slot.mount_dir)
+        fcntl.flock(slot._lock_file, fcntl.LOCK_UN)
+        slot._lock_file.close()
+        with self._cond:
+            self._free.append(slot.device)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        slot = self.acquire()
+        try:
+            yield slot
+        finally:
+            self.release(slot)
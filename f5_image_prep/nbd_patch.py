@@ -0,0 +1,311 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Patch a VE image through qemu-nbd, device-mapper and mounts.
+
+This is the nbd/LVM/mount sequence of patch-image.sh without its fixed
+sleeps.  Every step waits for the signal it actually depends on: the nbd
+device reporting a size, the kernel listing its partitions, udev settling
+and the device-mapper node existing.  The logical volumes are located from
+the LVM metadata on the guest disk, the same way as the inline engine does,
+and mapped with private device-mapper names, so the volume group is never
+activated and concurrent workers do not clash.  Whatever was set up is torn
+down again in reverse order, also when a step fails.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from f5_image_prep.injector import CONFIG_LV
+from f5_image_prep.injector import find_program
+from f5_image_prep.injector import FIRSTBOOT_FILE
+from f5_image_prep.injector import ISO_DIR
+from f5_image_prep.injector import SHARE_LV
+from f5_image_prep.lvm import find_logical_volume
+from f5_image_prep.lvm import find_partitions
+from f5_image_prep.lvm import SECTOR_SIZE
+from f5_image_prep.metrics import Metrics
+from f5_image_prep.nbd import SYSFS_BLOCK
+from f5_image_prep.qcow2 import open_image
+from f5_image_prep.userdata import compile_userdata_file
+from f5_image_prep.userdata import compiled_name
+
+
+DEVICE_TIMEOUT = 60
+POLL_INITIAL = 0.01
+POLL_MAX = 0.25
+NBD_MAX_PART = 32
+SYSFS_MODULE = '/sys/module'
+DEV_MAPPER = '/dev/mapper'
+
+
+class NbdPatchFailed(Exception):
+    pass
+
+
+class DeviceNotReady(NbdPatchFailed):
+    pass
+
+
+def run_privileged(command, stdin=None):
+    '''Run a command as root, through sudo unless we already are root.
+
+    :param command: list -- command and arguments
+    :param stdin: str -- data written to the command's standard input
+    :returns: str -- combined output of the command
+    :raises: NbdPatchFailed
+    '''
+
+    if os.geteuid() != 0:
+        command = ['sudo', '-n'] + command
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE if stdin is not None else None,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate(stdin)[0]
+    if process.returncode:
+        raise NbdPatchFailed('%s failed with status %d: %s' % (
+            ' '.join(command), process.returncode, output.strip()))
+    return output
+
+
+def load_nbd_module(run=run_privileged):
+    '''Load the nbd module with partition support unless it is loaded.'''
+
+    if not os.path.isdir(os.path.join(SYSFS_MODULE, 'nbd')):
+        run(['modprobe', 'nbd', 'max_part=%d' % NBD_MAX_PART])
+
+
+def wait_until(description, condition, timeout=DEVICE_TIMEOUT,
+               sleep=time.sleep, clock=time.time):
+    '''Poll a condition with a short, growing interval.
+
+    :param description: str -- what is awaited, for the error message
+    :param condition: callable -- returns True once the wait is over
+    :raises: DeviceNotReady
+    '''
+
+    deadline = clock() + timeout
+    delay = POLL_INITIAL
+    while not condition():
+        if clock() >= deadline:
+            raise DeviceNotReady('Timed out after %d seconds waiting for %s'
+                                 % (timeout, description))
+        sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+
+
+def device_size(device, sysfs=SYSFS_BLOCK):
+    '''Size of a block device in bytes, 0 while nothing is attached.'''
+
+    path = os.path.join(sysfs, os.path.basename(device), 'size')
+    try:
+        with open(path) as size_file:
+            return int(size_file.read().strip() or 0) * SECTOR_SIZE
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def device_partitions(device, sysfs=SYSFS_BLOCK):
+    '''Partitions the kernel lists for a block device.'''
+
+    name = os.path.basename(device)
+    try:
+        entries = os.listdir(os.path.join(sysfs, name))
+    except OSError:
+        return []
+    return sorted(entry for entry in entries
+                  if entry.startswith(name + 'p') and entry[len(name) + 1:]
+                  .isdigit())
+
+
+def dm_name(device, lv_name):
+    '''Private device-mapper name of a logical volume on an nbd device.'''
+
+    return 'f5-image-prep-%s-%s' % (os.path.basename(device),
+                                    lv_name.replace('.', '-'))
+
+
+def dm_table(device, volume):
+    '''Linear device-mapper table for a logical volume on a device.'''
+
+    return ''.join(
+        '%d %d linear %s %d\n' % (lv_offset // SECTOR_SIZE,
+                                  length // SECTOR_SIZE, device,
+                                  disk_offset // SECTOR_SIZE)
+        for lv_offset, disk_offset, length in volume.extents)
+
+
+class NbdPatcher(object):
+    '''Inject files into a VE image attached to one nbd device.'''
+
+    def __init__(self, device, mount_dir, run=run_privileged,
+                 timeout=DEVICE_TIMEOUT, sysfs=SYSFS_BLOCK,
+                 dev_mapper=DEV_MAPPER, sleep=time.sleep, metrics=None):
+        '''Initialize an NbdPatcher object.
+
+        :param device: str -- free nbd device, e.g. from an NbdDevicePool
+        :param mount_dir: str -- private directory for the mount points
+        :param run: callable -- runs a command as root
+        :param timeout: int -- seconds to wait for any one device
+        :param metrics: Metrics -- receives a span per step and command
+        '''
+
+        self.device = device
+        self.mount_dir = mount_dir
+        self.run = run
+        self.timeout = timeout
+        self.sysfs = sysfs
+        self.dev_mapper = dev_mapper
+        self.sleep = sleep
+        self.metrics = metrics or Metrics()
+
+    def _run(self, command, stdin=None):
+        with self.metrics.span('command', command=command[0]):
+            if stdin is None:
+                return self.run(command)
+            return self.run(command, stdin=stdin)
+
+    def _wait(self, description, condition):
+        wait_until(description, condition, self.timeout, self.sleep)
+
+    def _settle(self):
+        # Let udev finish probing new devices before we touch them.
+        if find_program('udevadm'):
+            self._run(['udevadm', 'settle', '--timeout=%d' % self.timeout])
+
+    def _load_module(self):
+        load_nbd_module(self._run)
+
+    def _connect(self, image_path, partitions, undo):
+        self._run(['qemu-nbd', '--connect=%s' % self.device, image_path])
+        undo.append((self._disconnect, ()))
+        self._wait('%s to report its size' % self.device,
+                   lambda: device_size(self.device, self.sysfs) > 0)
+        if partitions:
+            self._wait('%d partitions on %s' % (partitions, self.device),
+                       lambda: len(device_partitions(
+                           self.device, self.sysfs)) >= partitions)
+        self._settle()
+
+    def _disconnect(self):
+        self._run(['qemu-nbd', '-d', self.device])
+        self._wait('%s to be released' % self.device,
+                   lambda: device_size(self.device, self.sysfs) == 0)
+
+    def _map(self, volume):
+        name = dm_name(self.device, volume.name)
+        node = os.path.join(self.dev_mapper, name)
+        if os.path.exists(node):
+            # Left behind by an interrupted run on this device.
+            self._unmap(name)
+        self._run(['dmsetup', 'create', name],
+                  stdin=dm_table(self.device, volume))
+        self._run(['dmsetup', 'mknodes', name])
+        self._wait(node, lambda: os.path.exists(node))
+        return name, node
+
+    def _unmap(self, name):
+        self._run(['dmsetup', 'remove', '--retry', name])
+
+    def _mount(self, node, mount_point):
+        if not os.path.isdir(mount_point):
+            os.makedirs(mount_point)
+        self._run(['mount', node, mount_point])
+
+    def _umount(self, mount_point):
+        self._run(['umount', mount_point])
+
+    def _cleanup(self, undo, quiet=False):
+        '''Undo the steps taken so far, most recent first.'''
+
+        error = None
+        while undo:
+            func, args = undo.pop()
+            try:
+                func(*args)
+            except Exception as err:
+                print('Cleanup step failed: %s' % err)
+                error = error or err
+        if error is not None and not quiet:
+            raise error
+
+    def patch(self, image_path, startup_pkg=None, userdata=None,
+              firstboot=False, base_iso=None, hotfix_iso=None):
+        '''Write files into /config and /shared of the image.
+
+        :param image_path: str -- path to a writable qcow2 VE image
+        :param startup_pkg: str -- tarball extracted into /config
+        :param userdata: str -- userdata JSON file copied into /config,
+            together with its compiled form
+        :param firstboot: bool -- create /config/firstboot
+        :param base_iso: str -- ISO copied into /shared/images
+        :param hotfix_iso: str -- ISO copied into /shared/images
+        '''
+
+        isos = [iso for iso in (base_iso, hotfix_iso) if iso]
+        lv_names = [CONFIG_LV] + ([SHARE_LV] if isos else [])
+        with open_image(image_path) as disk:
+            partitions = len(find_partitions(disk)) - 1
+            volumes = [find_logical_volume(disk, lv) for lv in lv_names]
+
+        scratch = tempfile.mkdtemp(prefix='userdata-')
+        try:
+            compiled = None
+            if userdata:
+                # Invalid userdata fails before any device is touched.
+                compiled = os.path.join(scratch, compiled_name(userdata))
+                compile_userdata_file(userdata, compiled)
+            self._patch(image_path, partitions, volumes, startup_pkg,
+                        userdata, compiled, firstboot, isos)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def _patch(self, image_path, partitions, volumes, startup_pkg, userdata,
+               compiled, firstboot, isos):
+        self._load_module()
+        undo = []
+        try:
+            with self.metrics.span('connect'):
+                self._connect(image_path, partitions, undo)
+            mount_points = []
+            for volume in volumes:
+                with self.metrics.span('map', lv=volume.name):
+                    name, node = self._map(volume)
+                    undo.append((self._unmap, (name,)))
+                    mount_point = os.path.join(self.mount_dir, volume.name)
+                    self._mount(node, mount_point)
+                    undo.append((self._umount, (mount_point,)))
+                mount_points.append(mount_point)
+
+            with self.metrics.span('inject'):
+                config = mount_points[0]
+                if startup_pkg:
+                    self._run(['tar', '-xf', startup_pkg, '-C', config])
+                if firstboot:
+                    self._run(['touch', config + FIRSTBOOT_FILE])
+                if userdata:
+                    self._run(['cp', userdata, config])
+                    self._run(['cp', compiled, config])
+                for iso in isos:
+                    self._run(['cp', iso, mount_points[1] + ISO_DIR])
+        except Exception:
+            with self.metrics.span('cleanup'):
+                self._cleanup(undo, quiet=True)
+            raise
+        with self.metrics.span('cleanup'):
+            self._cleanup(undo)
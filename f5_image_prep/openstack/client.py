@@ -13,22 +13,27 @@
 # limitations under the License.
 #
 
+import errno
+import hashlib
+import json
+import os
 import re
+import threading
 
 import glanceclient.v1.client as gclient
+import glanceclient.v2.client as gclient2
 import keystoneclient.v2_0.client as ksclient
 
+# Refresh tokens this many seconds before they expire.
+TOKEN_STALE_SECONDS = 300
 
-class AuthURLNotSet(KeyError):
-    pass
+_sessions = {}
+_sessions_lock = threading.Lock()
+_token_cache = {'path': None}
 
 
-def get_keystone_client(creds):
-    """Create keystone client."""
-    return ksclient.Client(username=creds.username,
-                           password=creds.password,
-                           tenant_name=creds.tenant_name,
-                           auth_url=creds.auth_url)
+class AuthURLNotSet(KeyError):
+    pass
 
 
 def _strip_version(endpoint):
@@ -41,15 +46,163 @@ def _strip_version(endpoint):
     return endpoint
 
 
-def get_glance_client(creds):
+def _creds_key(creds):
+    """Identify creds without including the password"""
+    return '|'.join(str(value) for value in (
+        creds.auth_url, creds.tenant_name, creds.username,
+        getattr(creds, 'region_name', None)))
+
+
+def enable_token_cache(path):
+    """Persist tokens and service catalogs in path between runs.
+
+    Passwords are never written; an expired or missing entry means a normal
+    authentication.
+    """
+    _token_cache['path'] = path
+
+
+def _load_auth_ref(key):
+    path = _token_cache['path']
+    if not path:
+        return None
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file).get(key)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_auth_ref(key, auth_ref):
+    path = _token_cache['path']
+    if not path:
+        return
+    with _sessions_lock:
+        try:
+            with open(path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError):
+            cached = {}
+        cached[key] = dict(auth_ref)
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.rename(tmp_path, path)
+
+
+def clear_sessions():
+    """Forget every cached session, e.g. after credentials changed"""
+    with _sessions_lock:
+        _sessions.clear()
+    path = _token_cache['path']
+    if path:
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+class KeystoneSession(object):
+    """Authenticated keystone client and resolved endpoints for one user.
+
+    The keystone client re-authenticates on its own shortly before the
+    token expires; endpoints and the service clients holding the old token
+    are rebuilt when that happens.  Service clients are reused so their
+    HTTP connection pools stay warm.
+    """
+    def __init__(self, creds):
+        self.creds = creds
+        self.key = _creds_key(creds)
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._clients = {}
+        auth_ref = _load_auth_ref(self.key)
+        kwargs = dict(username=creds.username,
+                      password=creds.password,
+                      tenant_name=creds.tenant_name,
+                      auth_url=creds.auth_url,
+                      region_name=getattr(creds, 'region_name', None),
+                      stale_duration=TOKEN_STALE_SECONDS)
+        self.keystone_client = None
+        if auth_ref:
+            try:
+                self.keystone_client = ksclient.Client(
+                    auth_ref=auth_ref, **kwargs)
+                if self.keystone_client.auth_ref.will_expire_soon(
+                        TOKEN_STALE_SECONDS):
+                    self.keystone_client = None
+            except Exception:
+                self.keystone_client = None
+        if self.keystone_client is None:
+            self.keystone_client = ksclient.Client(**kwargs)
+            _save_auth_ref(self.key, self.keystone_client.auth_ref)
+        self._token = self.keystone_client.auth_ref.auth_token
+
+    @property
+    def token(self):
+        """Current token, refreshed when it is about to expire"""
+        with self._lock:
+            token = self.keystone_client.auth_token
+            if token != self._token:
+                self._token = token
+                self._endpoints.clear()
+                self._clients.clear()
+                _save_auth_ref(self.key, self.keystone_client.auth_ref)
+            return token
+
+    def endpoint(self, service_type, endpoint_type='publicURL'):
+        """Resolve and remember a service endpoint"""
+        self.token
+        with self._lock:
+            key = (service_type, endpoint_type)
+            if key not in self._endpoints:
+                self._endpoints[key] = \
+                    self.keystone_client.service_catalog.url_for(
+                        service_type=service_type,
+                        endpoint_type=endpoint_type,
+                        region_name=getattr(self.creds, 'region_name', None)
+                    )
+            return self._endpoints[key]
+
+    def glance_client(self, api_version=1):
+        """Glance client for the current token"""
+        # If you don't strip the version, the v1 client lists will
+        # try to use /v2/v1/images which is wrong
+        glance_endpoint = _strip_version(self.endpoint('image'))
+        token = self.token
+        with self._lock:
+            if api_version not in self._clients:
+                client_class = gclient2 if api_version == 2 else gclient
+                self._clients[api_version] = client_class.Client(
+                    glance_endpoint, token=token)
+            return self._clients[api_version]
+
+
+def get_session(creds):
+    """Get the process-wide session for creds, authenticating once"""
+    key = (_creds_key(creds),
+           hashlib.sha256(str(creds.password).encode('utf-8')).hexdigest())
+    with _sessions_lock:
+        session = _sessions.get(key)
+    if session is None:
+        session = KeystoneSession(creds)
+        with _sessions_lock:
+            session = _sessions.setdefault(key, session)
+    return session
+
+
+def get_keystone_client(creds):
+    """Create keystone client."""
+    session = get_session(creds)
+    session.token
+    return session.keystone_client
+
+
+def get_glance_client(creds, api_version=1):
     """Create glance client"""
-    keystone_client = get_keystone_client(creds)
-    # If you don't strip the version, the v1 client lists will
-    # try to use /v2/v1/images which is wrong
-    glance_endpoint = _strip_version(
-        keystone_client.service_catalog.url_for(
-            service_type='image',
-            endpoint_type='publicURL'
-        )
-    )
-    return gclient.Client(glance_endpoint, token=keystone_client.auth_token)
+    return get_session(creds).glance_client(api_version)
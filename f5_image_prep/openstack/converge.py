@@ -0,0 +1,124 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Wait for OpenStack resources to appear or disappear."""
+import random
+import time
+
+INITIAL_DELAY = 0.25
+MAX_DELAY = 10.0
+BACKOFF_FACTOR = 2.0
+DEFAULT_TIMEOUT = 120
+# Seconds to wait, by the first word of a check's description.
+RESOURCE_TIMEOUTS = {
+    'image': 900,
+    'tenant': 60,
+    'user': 60,
+}
+
+
+class ConvergenceTimeout(Exception):
+    pending = ()
+
+
+class ObjectCheck(object):
+    """Poll with exponential backoff and jitter until a condition holds"""
+    def __init__(self, timeouts=None, default_timeout=DEFAULT_TIMEOUT,
+                 initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY,
+                 factor=BACKOFF_FACTOR, sleep=time.sleep, clock=time.time):
+        """Initialize an ObjectCheck object.
+
+        :param timeouts: dict -- seconds to wait per resource type, the
+            first word of a check's description
+        :param default_timeout: int -- seconds for any other resource
+        """
+        self.timeouts = dict(RESOURCE_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.default_timeout = default_timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.sleep = sleep
+        self.clock = clock
+
+    def timeout_for(self, description):
+        resource = description.split()[0] if description else ''
+        return self.timeouts.get(resource, self.default_timeout)
+
+    def _poll(self, description, timeout, check):
+        if timeout is None:
+            timeout = self.timeout_for(description)
+        deadline = self.clock() + timeout
+        delay = self.initial_delay
+        while True:
+            done, result = check()
+            if done:
+                return result
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                raise ConvergenceTimeout(
+                    'Timed out after %d seconds waiting for %s' %
+                    (timeout, description))
+            # Full jitter keeps concurrent waiters from polling in step.
+            self.sleep(min(random.uniform(0, delay), remaining))
+            delay = min(delay * self.factor, self.max_delay)
+
+    def openstack(self, description, expected, func, *args, **kwargs):
+        """Wait until bool(func(*args)) equals expected.
+
+        :param description: str -- what is awaited, e.g. 'tenant created'
+        :param expected: bool -- whether func should return a resource
+        :param timeout: int -- overrides the per-resource timeout
+        :returns: the last value returned by func
+        :raises: ConvergenceTimeout
+        """
+        timeout = kwargs.pop('timeout', None)
+
+        def check():
+            result = func(*args)
+            return bool(result) == expected, result
+
+        return self._poll(description, timeout, check)
+
+    def wait_many(self, description, list_resources, names, expected=True,
+                  key=lambda resource: resource.name, timeout=None):
+        """Wait for several resources with one listing per poll.
+
+        :param list_resources: callable -- lists every resource
+        :param names: iterable -- keys of the awaited resources
+        :param expected: bool -- True to wait for all to exist, False for
+            all to be gone
+        :returns: dict -- key to resource, for the resources that exist
+        """
+        pending = set(names)
+        found = {}
+
+        def check():
+            listed = dict((key(resource), resource)
+                          for resource in list_resources())
+            for name in list(pending):
+                if (name in listed) == expected:
+                    pending.discard(name)
+                    if expected:
+                        found[name] = listed[name]
+            return not pending, found
+
+        if not pending:
+            return found
+        try:
+            return self._poll(description, timeout, check)
+        except ConvergenceTimeout as err:
+            err.pending = sorted(pending)
+            raise
@@ -14,23 +14,89 @@
 #
 
 """OpenStack Build-Up Functionality."""
+from glanceclient import exc
+
 from f5_image_prep.openstack.client import get_glance_client
+from f5_image_prep.openstack.index import ResourceIndex
 from f5_image_prep.openstack.openstack import OpenStackLib
 
+MEMBER_ACCEPTED = 'accepted'
+
 
 class GlanceLib(OpenStackLib):
     """Glance library operations"""
-    def __init__(self, creds):
-        OpenStackLib.__init__(self, creds)
-        self.glance_client = get_glance_client(creds)
+    def __init__(self, creds, api_version=1, **kwargs):
+        OpenStackLib.__init__(self, creds, **kwargs)
+        self.api_version = api_version
+        self.glance_client = get_glance_client(creds, api_version)
+        self.images = ResourceIndex(
+            self.glance_client.images.list,
+            lambda name: self.glance_client.images.list(
+                filters={'name': name}))
 
     def get_image(self, name):
         """Get image by name"""
-        images = self.glance_client.images.list()
+        return self.images.by_name(name)
+
+    def find_images(self, disk_format, properties=None):
+        """Find active images by disk format and properties"""
+        filters = {'disk_format': disk_format, 'status': 'active'}
+        if properties and self.api_version == 2:
+            filters.update(properties)
+        elif properties:
+            filters['properties'] = properties
+        images = self.glance_client.images.list(filters=filters)
+        found = []
         for image in images:
-            if image.name == name:
-                return image
-        return None
+            if self.api_version == 2:
+                # v2 images carry their properties as top-level attributes.
+                image_properties = image
+            else:
+                image_properties = getattr(image, 'properties', {}) or {}
+            if all(image_properties.get(key) == value
+                   for key, value in (properties or {}).items()):
+                found.append(image)
+        return found
+
+    def enable_sharing(self, image):
+        """Let an image take members; v1 private images always can"""
+        if self.api_version != 2 or \
+                getattr(image, 'visibility', None) != 'private':
+            return
+        try:
+            self.glance_client.images.update(image.id, visibility='shared')
+        except exc.HTTPBadRequest:
+            # Before Ocata there is no 'shared'; private images take members.
+            pass
+
+    def list_members(self, image_id):
+        """Membership status by tenant id; v1 members are always accepted"""
+        if self.api_version == 2:
+            members = self.glance_client.image_members.list(image_id)
+            return dict((member.member_id, member.status)
+                        for member in members)
+        members = self.glance_client.image_members.list(image=image_id)
+        return dict((member.member_id, MEMBER_ACCEPTED)
+                    for member in members)
+
+    def list_member_ids(self, image_id):
+        """Ids of the tenants an image is shared with"""
+        return set(self.list_members(image_id))
+
+    def add_member(self, image_id, tenant_id):
+        """Share an image with a tenant, accepted so it shows in its list"""
+        self.glance_client.image_members.create(image_id, tenant_id)
+        self.accept_member(image_id, tenant_id)
+
+    def accept_member(self, image_id, tenant_id):
+        """Accept a pending v2 membership on the tenant's behalf (admin)"""
+        if self.api_version == 2:
+            self.glance_client.image_members.update(image_id, tenant_id,
+                                                    MEMBER_ACCEPTED)
+
+    def remove_member(self, image_id, tenant_id):
+        """Stop sharing an image with a tenant"""
+        self.glance_client.image_members.delete(image_id, tenant_id)
 
     def create_image(self, name, path, disk_format, container_format):
         """Upload/Import an image"""
@@ -47,8 +113,10 @@ class GlanceLib(OpenStackLib):
                 disk_format=disk_format,
                 container_format=container_format,
                 data=file_image)
+        self.images.add(image)
 
-        self.obj_check.openstack('image created', True, self.get_image, name)
+        self.obj_check.openstack(
+            'image created', True, self.images.fetch, name)
 
         self.print_context.debug('Created image %s.', name)
         return image
@@ -63,7 +131,9 @@ class GlanceLib(OpenStackLib):
             return image
 
         self.glance_client.images.delete(image.id)
+        self.images.remove(image)
 
-        self.obj_check.openstack('image deleted', False, self.get_image, name)
+        self.obj_check.openstack(
+            'image deleted', False, self.images.fetch, name)
 
         self.print_context.debug('Deleted image %s.', name)
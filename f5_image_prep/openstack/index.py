@@ -0,0 +1,126 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Name and id lookups over a single listing of OpenStack resources."""
+import threading
+
+
+class ResourceIndex(object):
+    """Index of one resource type, keyed by name and by id.
+
+    The listing is fetched on the first lookup, or when load() is called at
+    the start of a batch, and kept up to date with add() and remove() after
+    our own creates and deletes.  Until then, single lookups use the
+    server-side filter when one is given, so they never list everything.
+    fetch() always asks the server for just the one name, so polling for a
+    resource after a create or delete never lists everything either.
+    """
+    def __init__(self, list_resources, find_by_name=None):
+        """Initialize a ResourceIndex object.
+
+        :param list_resources: callable -- returns every resource
+        :param find_by_name: callable -- returns the resources with a name,
+            filtered by the server
+        """
+        self.list_resources = list_resources
+        self.find_by_name = find_by_name
+        self._by_name = None
+        self._by_id = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._by_id is not None
+
+    def load(self):
+        """(Re)fill the index from one listing"""
+        resources = list(self.list_resources())
+        by_name, by_id = {}, {}
+        for resource in resources:
+            by_id[resource.id] = resource
+            # Keep the first of several resources with the same name.
+            by_name.setdefault(resource.name, resource)
+        with self._lock:
+            self._by_name, self._by_id = by_name, by_id
+        return resources
+
+    def invalidate(self):
+        with self._lock:
+            self._by_name = self._by_id = None
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _find(self, name):
+        for resource in self.find_by_name(name):
+            if resource.name == name:
+                return resource
+        return None
+
+    def by_name(self, name):
+        """Get resource by name"""
+        if not self.loaded and self.find_by_name is not None:
+            return self._find(name)
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def by_id(self, resource_id):
+        """Get resource by id"""
+        self._ensure_loaded()
+        return self._by_id.get(resource_id)
+
+    def all(self):
+        """All indexed resources"""
+        self._ensure_loaded()
+        return list(self._by_id.values())
+
+    def fetch(self, name):
+        """Look a resource up on the server, refreshing its index entry"""
+        if self.find_by_name is None:
+            self.load()
+            return self._by_name.get(name)
+        resource = self._find(name)
+        with self._lock:
+            if self._by_id is not None:
+                stale = self._by_name.pop(name, None)
+                if stale is not None:
+                    self._by_id.pop(stale.id, None)
+                if resource is not None:
+                    self._by_id[resource.id] = resource
+                    self._by_name[name] = resource
+        return resource
+
+    def add(self, resource):
+        """Record a resource we created"""
+        with self._lock:
+            if self._by_id is None:
+                return
+            self._by_id[resource.id] = resource
+            self._by_name.setdefault(resource.name, resource)
+
+    def remove(self, resource):
+        """Forget a resource we deleted"""
+        with self._lock:
+            if self._by_id is None:
+                return
+            self._by_id.pop(resource.id, None)
+            named = self._by_name.get(resource.name)
+            if named is not None and named.id == resource.id:
+                del self._by_name[resource.name]
+                for other in self._by_id.values():
+                    if other.name == resource.name:
+                        self._by_name[resource.name] = other
+                        break
@@ -14,24 +14,51 @@
 #
 
 """OpenStack Build-Up Functionality."""
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from keystoneclient import exceptions
+
 from f5_image_prep.openstack.client import get_keystone_client
+from f5_image_prep.openstack.index import ResourceIndex
 from f5_image_prep.openstack.openstack import OpenStackLib
 
 TENANT_MEMBER_ROLE = '_member_'
 
 
+def _name_filter(manager, path, response_key):
+    """Server-side lookup by name of the Keystone v2.0 admin API"""
+    def find_by_name(name):
+        # The client has no call for ?name=, which returns one resource.
+        try:
+            return [manager._get(
+                '%s?%s' % (path, urlencode({'name': name})), response_key)]
+        except exceptions.NotFound:
+            return []
+    return find_by_name
+
+
 class KeystoneLib(OpenStackLib):
     """Keystone library operations"""
-    def __init__(self, creds):
+    def __init__(self, creds, **kwargs):
         if creds and creds.tenant_name != 'admin':
             raise ValueError(
                 'Tenant %s is incorrect. Must be admin' % creds.tenant_name)
-        OpenStackLib.__init__(self, creds)
+        OpenStackLib.__init__(self, creds, **kwargs)
         self.keystone_client = get_keystone_client(creds)
+        self.tenants = ResourceIndex(
+            self.keystone_client.tenants.list,
+            _name_filter(self.keystone_client.tenants, '/tenants', 'tenant'))
+        self.users = ResourceIndex(
+            self.keystone_client.users.list,
+            _name_filter(self.keystone_client.users, '/users', 'user'))
+        self.roles = ResourceIndex(self.keystone_client.roles.list)
 
     def get_all_non_admin_tenants(self):
         """Get all non-admin tenants"""
-        tenants = self.keystone_client.tenants.list()
+        tenants = self.tenants.all()
         return_tenants = []
         for tenant in tenants:
             if tenant.name == 'admin' or tenant.name == 'service':
@@ -41,19 +68,11 @@ class KeystoneLib(OpenStackLib):
 
     def get_tenant(self, name):
         """Get tenant by name"""
-        tenants = self.keystone_client.tenants.list()
-        for tenant in tenants:
-            if tenant.name == name:
-                return tenant
-        return None
+        return self.tenants.by_name(name)
 
     def get_tenant_by_id(self, tenant_id):
         """Get tenant by id"""
-        tenants = self.keystone_client.tenants.list()
-        for tenant in tenants:
-            if tenant.id == tenant_id:
-                return tenant
-        return None
+        return self.tenants.by_id(tenant_id)
 
     def create_tenant(self, name, description):
         """Create a tenant"""
@@ -65,8 +84,10 @@ class KeystoneLib(OpenStackLib):
 
         tenant = self.keystone_client.tenants.create(
             name, description=description, enabled=True)
+        self.tenants.add(tenant)
 
-        self.obj_check.openstack('tenant created', True, self.get_tenant, name)
+        self.obj_check.openstack(
+            'tenant created', True, self.tenants.fetch, name)
 
         self.print_context.debug('Created tenant %s.', name)
         return tenant
@@ -84,19 +105,16 @@ class KeystoneLib(OpenStackLib):
             return
 
         self.keystone_client.tenants.delete(tenant)
+        self.tenants.remove(tenant)
 
         self.obj_check.openstack(
-            'tenant deleted', False, self.get_tenant, name)
+            'tenant deleted', False, self.tenants.fetch, name)
 
         self.print_context.debug('Deleted tenant %s.', name)
 
     def get_user(self, name):
         """Get user by name"""
-        user_list = self.keystone_client.users.list()
-        for user in user_list:
-            if user.name == name:
-                return user
-        return None
+        return self.users.by_name(name)
 
     def create_user(self, tenant, name, password, email):
         """Create a user"""
@@ -109,8 +127,9 @@ class KeystoneLib(OpenStackLib):
 
         user = self.keystone_client.users.create(
             name=name, password=password, tenant_id=tenant.id, email=email)
+        self.users.add(user)
 
-        self.obj_check.openstack('user created', True, self.get_user, name)
+        self.obj_check.openstack('user created', True, self.users.fetch, name)
 
         self.print_context.debug(
             'Created tenant %s user %s.', tenant.name, name)
@@ -132,19 +151,20 @@ class KeystoneLib(OpenStackLib):
             raise Exception('No tenant found for tenant id %s', user.tenantId)
 
         self.keystone_client.users.delete(user)
+        self.users.remove(user)
 
-        self.obj_check.openstack('user deleted', False, self.get_user, name)
+        self.obj_check.openstack(
+            'user deleted', False, self.users.fetch, name)
 
         self.print_context.debug(
             'Deleted tenant %s user %s.', tenant.name, name)
 
     def get_member_role(self):
         """Get member role"""
-        roles = self.keystone_client.roles.list()
-        for role in roles:
-            if role.name == TENANT_MEMBER_ROLE:
-                return role
-        raise Exception('Member role was not found.')
+        role = self.roles.by_name(TENANT_MEMBER_ROLE)
+        if role is None:
+            raise Exception('Member role was not found.')
+        return role
 
     def __check_user_role(self, check_tenant_id, check_user_id, check_role_id):
         """Check if a user has a role"""
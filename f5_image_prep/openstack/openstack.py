@@ -14,26 +14,61 @@
 #
 
 """OpenStack base library class"""
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+import copy
+import logging
 import os
 
+from f5_image_prep.openstack.converge import ObjectCheck
+
+
+CREDS_OPTIONS = ('auth_url', 'tenant_name', 'username', 'password',
+                 'region_name')
+
 
 class OpenStackCreds(object):
     """OpenStack Credentials"""
-    def __init__(self, auth_url, tenant_name, username, password):
+    def __init__(self, auth_url, tenant_name, username, password,
+                 region_name=None):
         self.auth_url = auth_url
         self.tenant_name = tenant_name
         self.username = username
         self.password = password
+        self.region_name = region_name
+
+    def for_region(self, region_name):
+        """Copy of these creds scoped to another region"""
+        creds = copy.copy(self)
+        creds.region_name = region_name
+        return creds
+
+
+class PrintContext(object):
+    """Progress messages of library operations, through logging"""
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('f5_image_prep.openstack')
+
+    def heading(self, msg, *args):
+        self.logger.info(msg, *args)
+
+    def debug(self, msg, *args):
+        self.logger.debug(msg, *args)
 
 
 class OpenStackLib(object):
     """OpenStack Library"""
-    def __init__(self, creds, extensions=None):
+    def __init__(self, creds, extensions=None, obj_check=None,
+                 print_context=None):
         if creds is None:
             raise ValueError('Creds must be supplied')
 
         self.creds = creds
         self.extensions = extensions
+        self.obj_check = obj_check or ObjectCheck()
+        self.print_context = print_context or PrintContext()
 
     def print_creds(self):
         """Print creds for debug purposes"""
@@ -49,6 +84,7 @@ def get_creds():
     os_username = None
     os_password = None
     os_auth_url = None
+    os_region_name = os.environ.get('OS_REGION_NAME')
 
     # Start with environment variables
     try:
@@ -75,5 +111,29 @@ def get_creds():
         os_auth_url,
         os_tenant_name,
         os_username,
-        os_password)
+        os_password,
+        os_region_name)
     return creds
+
+
+def load_creds_profiles(path):
+    """Load named creds from an INI file, one section per profile.
+
+    Every section takes auth_url, tenant_name, username, password and
+    optionally region_name.  Options missing from a section default to the
+    matching OS_* environment variable.
+    """
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise IOError('Cannot read creds file %s' % path)
+    env_creds = get_creds()
+    profiles = {}
+    for section in parser.sections():
+        values = {}
+        for option in CREDS_OPTIONS:
+            if parser.has_option(section, option):
+                values[option] = parser.get(section, option)
+            else:
+                values[option] = getattr(env_creds, option)
+        profiles[section] = OpenStackCreds(**values)
+    return profiles
@@ -0,0 +1,189 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Bulk provisioning of tenants, users and role grants.
+
+The desired state is compared with one snapshot of Keystone and only the
+differences are applied, each phase concurrently with a bounded pool:
+tenants first, then the users that live in them, then role grants.  New
+tenants and users are awaited with one listing per poll, not one per item.
+
+A spec looks like::
+
+    {
+        'tenants': [{'name': 've-test-1', 'description': 'VE tests'}],
+        'users': [{'name': 've-user-1', 'password': 'secret',
+                   'email': 've-user-1@example.com', 'tenant': 've-test-1'}],
+        'roles': [{'user': 've-user-1', 'tenant': 've-test-1',
+                   'role': '_member_'}],
+    }
+"""
+from multiprocessing.pool import ThreadPool
+
+from f5_image_prep.openstack.converge import ConvergenceTimeout
+from f5_image_prep.openstack.keystone import TENANT_MEMBER_ROLE
+
+DEFAULT_WORKERS = 16
+
+ACTION_CREATED = 'created'
+ACTION_GRANTED = 'granted'
+ACTION_EXISTS = 'exists'
+ACTION_FAILED = 'failed'
+
+
+class ProvisionResult(object):
+    """Outcome for one tenant, user or role grant"""
+    def __init__(self, kind, name, action, error=None):
+        self.kind = kind
+        self.name = name
+        self.action = action
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.action != ACTION_FAILED
+
+    def __repr__(self):
+        return '<ProvisionResult %s %s %s>' % (self.kind, self.name,
+                                               self.action)
+
+
+def _grant_name(grant):
+    return '%s/%s/%s' % (grant['tenant'], grant['user'],
+                         grant.get('role', TENANT_MEMBER_ROLE))
+
+
+class Provisioner(object):
+    """Apply a provisioning spec through a KeystoneLib"""
+    def __init__(self, keystone, workers=DEFAULT_WORKERS, wait=True):
+        """Initialize a Provisioner object.
+
+        :param keystone: KeystoneLib
+        :param workers: int -- concurrent requests per phase
+        :param wait: bool -- wait for created tenants and users to be listed
+        """
+        self.keystone = keystone
+        self.client = keystone.keystone_client
+        self.workers = workers
+        self.wait = wait
+
+    def _map(self, func, items):
+        if not items:
+            return []
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def snapshot(self):
+        """Load tenants, users and roles with one listing each"""
+        self._map(lambda index: index.load(),
+                  [self.keystone.tenants, self.keystone.users,
+                   self.keystone.roles])
+
+    def _create_tenant(self, spec):
+        try:
+            tenant = self.client.tenants.create(
+                spec['name'], description=spec.get('description', ''),
+                enabled=True)
+        except Exception as err:
+            return ProvisionResult('tenant', spec['name'], ACTION_FAILED, err)
+        self.keystone.tenants.add(tenant)
+        return ProvisionResult('tenant', spec['name'], ACTION_CREATED)
+
+    def _create_user(self, spec):
+        tenant = self.keystone.tenants.by_name(spec['tenant'])
+        if tenant is None:
+            return ProvisionResult(
+                'user', spec['name'], ACTION_FAILED,
+                'Tenant %s is not available' % spec['tenant'])
+        try:
+            user = self.client.users.create(
+                name=spec['name'], password=spec['password'],
+                tenant_id=tenant.id, email=spec.get('email'))
+        except Exception as err:
+            return ProvisionResult('user', spec['name'], ACTION_FAILED, err)
+        self.keystone.users.add(user)
+        return ProvisionResult('user', spec['name'], ACTION_CREATED)
+
+    def _grant(self, grant):
+        name = _grant_name(grant)
+        tenant = self.keystone.tenants.by_name(grant['tenant'])
+        user = self.keystone.users.by_name(grant['user'])
+        role = self.keystone.roles.by_name(
+            grant.get('role', TENANT_MEMBER_ROLE))
+        if tenant is None or user is None or role is None:
+            return ProvisionResult(
+                'role', name, ACTION_FAILED,
+                'Tenant, user or role of %s is not available' % name)
+        try:
+            held = self.client.roles.roles_for_user(
+                user=user.id, tenant=tenant.id)
+            if any(held_role.id == role.id for held_role in held):
+                return ProvisionResult('role', name, ACTION_EXISTS)
+            self.client.roles.add_user_role(
+                role=role, user=user.id, tenant=tenant.id)
+        except Exception as err:
+            return ProvisionResult('role', name, ACTION_FAILED, err)
+        return ProvisionResult('role', name, ACTION_GRANTED)
+
+    def _wait_listed(self, description, list_resources, results):
+        created = dict((result.name, result) for result in results
+                       if result.action == ACTION_CREATED)
+        if not self.wait or not created:
+            return
+        try:
+            self.keystone.obj_check.wait_many(
+                description, list_resources, created)
+        except ConvergenceTimeout as err:
+            for name in err.pending:
+                created[name].action = ACTION_FAILED
+                created[name].error = err
+
+    def provision(self, spec):
+        """Create whatever in spec is missing.
+
+        :param spec: dict -- 'tenants', 'users' and 'roles' lists
+        :returns: list -- ProvisionResult per item, in spec order
+        """
+        self.snapshot()
+        results = []
+
+        tenants = spec.get('tenants', [])
+        missing = [tenant for tenant in tenants
+                   if self.keystone.tenants.by_name(tenant['name']) is None]
+        created = dict((id(tenant), result) for tenant, result in
+                       zip(missing, self._map(self._create_tenant, missing)))
+        self._wait_listed('tenant created', self.client.tenants.list,
+                          created.values())
+        for tenant in tenants:
+            results.append(created.get(id(tenant)) or ProvisionResult(
+                'tenant', tenant['name'], ACTION_EXISTS))
+
+        users = spec.get('users', [])
+        missing = [user for user in users
+                   if self.keystone.users.by_name(user['name']) is None]
+        created = dict((id(user), result) for user, result in
+                       zip(missing, self._map(self._create_user, missing)))
+        self._wait_listed('user created', self.client.users.list,
+                          created.values())
+        for user in users:
+            results.append(created.get(id(user)) or ProvisionResult(
+                'user', user['name'], ACTION_EXISTS))
+
+        results.extend(self._map(self._grant, spec.get('roles', [])))
+        return results
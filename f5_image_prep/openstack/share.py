@@ -0,0 +1,138 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Share one private Glance image with many tenants through membership.
+
+The wanted tenants are compared with the image's current members and only
+the difference is applied, concurrently with a bounded pool, so a rerun
+only touches the tenants added or dropped since the last one.  Tenants
+sharing an image all boot from the one copy Glance stores.  Glance v2 only
+lists a shared image for tenants whose membership is accepted, so new,
+pending and rejected memberships are accepted with the owner's admin
+session.
+"""
+from multiprocessing.pool import ThreadPool
+
+from f5_image_prep.openstack.glance import MEMBER_ACCEPTED
+from f5_image_prep.openstack.provision import ACTION_EXISTS
+from f5_image_prep.openstack.provision import ACTION_FAILED
+from f5_image_prep.openstack.provision import ACTION_GRANTED
+from f5_image_prep.openstack.provision import ProvisionResult
+
+DEFAULT_WORKERS = 16
+
+ACTION_ACCEPTED = 'accepted'
+ACTION_REVOKED = 'revoked'
+
+
+class ImageSharer(object):
+    """Make the members of Glance images match a set of tenants"""
+    def __init__(self, glance, keystone, workers=DEFAULT_WORKERS):
+        """Initialize an ImageSharer object.
+
+        :param glance: GlanceLib -- of the image owner
+        :param keystone: KeystoneLib -- resolves tenant names
+        :param workers: int -- concurrent membership requests
+        """
+        self.glance = glance
+        self.keystone = keystone
+        self.workers = workers
+
+    def _map(self, func, items):
+        if not items:
+            return []
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _tenant_name(self, tenant_id):
+        tenant = self.keystone.tenants.by_id(tenant_id)
+        return tenant.name if tenant is not None else tenant_id
+
+    def _add(self, image_id, tenant):
+        try:
+            self.glance.add_member(image_id, tenant.id)
+        except Exception as err:
+            return ProvisionResult('member', tenant.name, ACTION_FAILED, err)
+        return ProvisionResult('member', tenant.name, ACTION_GRANTED)
+
+    def _accept(self, image_id, tenant):
+        try:
+            self.glance.accept_member(image_id, tenant.id)
+        except Exception as err:
+            return ProvisionResult('member', tenant.name, ACTION_FAILED, err)
+        return ProvisionResult('member', tenant.name, ACTION_ACCEPTED)
+
+    def _remove(self, image_id, tenant_id):
+        name = self._tenant_name(tenant_id)
+        try:
+            self.glance.remove_member(image_id, tenant_id)
+        except Exception as err:
+            return ProvisionResult('member', name, ACTION_FAILED, err)
+        return ProvisionResult('member', name, ACTION_REVOKED)
+
+    def share(self, image, tenant_names=None, prune=False):
+        """Share an image with tenants, skipping the current members.
+
+        :param image: image model returned by Glance
+        :param tenant_names: list -- tenants to share with, all non-admin
+            tenants when None
+        :param prune: bool -- also remove members that are not wanted
+        :returns: list -- ProvisionResult per tenant
+        """
+        results = []
+        self.keystone.tenants.load()
+        if tenant_names is None:
+            tenants = self.keystone.get_all_non_admin_tenants()
+        else:
+            tenants = []
+            for name in tenant_names:
+                tenant = self.keystone.tenants.by_name(name)
+                if tenant is None:
+                    results.append(ProvisionResult(
+                        'member', name, ACTION_FAILED,
+                        'Tenant %s does not exist' % name))
+                else:
+                    tenants.append(tenant)
+
+        self.glance.enable_sharing(image)
+        current = self.glance.list_members(image.id)
+        missing = []
+        unaccepted = []
+        for tenant in tenants:
+            if tenant in missing or tenant in unaccepted:
+                continue
+            status = current.get(tenant.id)
+            if status is None:
+                missing.append(tenant)
+            elif status != MEMBER_ACCEPTED:
+                unaccepted.append(tenant)
+            else:
+                results.append(
+                    ProvisionResult('member', tenant.name, ACTION_EXISTS))
+        results.extend(self._map(
+            lambda tenant: self._accept(image.id, tenant), unaccepted))
+        results.extend(self._map(
+            lambda tenant: self._add(image.id, tenant), missing))
+        if prune:
+            unwanted = sorted(set(current) -
+                              set(tenant.id for tenant in tenants))
+            results.extend(self._map(
+                lambda tenant_id: self._remove(image.id, tenant_id),
+                unwanted))
+        return results
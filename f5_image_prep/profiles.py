@@ -0,0 +1,172 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Named sets of Glance image properties that tune the VE's virtual hardware.
+
+Nova reads the ``hw_*`` properties of an image when it boots an instance
+from it: the disk bus, NIC model, NIC queues, CPU pinning and huge pages.
+A profile names a set of them.  Profiles are checked against the values
+Nova accepts and against the BIG-IP version of the image, taken from its
+file name, before anything is uploaded.
+"""
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+import os
+import re
+
+
+PROFILES = {
+    'virtio': {
+        'hw_disk_bus': 'virtio',
+        'hw_vif_model': 'virtio',
+    },
+    'virtio-multiqueue': {
+        'hw_disk_bus': 'virtio',
+        'hw_vif_model': 'virtio',
+        'hw_vif_multiqueue_enabled': 'true',
+    },
+    'virtio-scsi': {
+        'hw_disk_bus': 'scsi',
+        'hw_scsi_model': 'virtio-scsi',
+        'hw_vif_model': 'virtio',
+    },
+    'dedicated': {
+        'hw_cpu_policy': 'dedicated',
+        'hw_cpu_thread_policy': 'prefer',
+        'hw_mem_page_size': 'large',
+        'hw_numa_nodes': '1',
+    },
+    'high-performance': {
+        'hw_disk_bus': 'virtio',
+        'hw_vif_model': 'virtio',
+        'hw_vif_multiqueue_enabled': 'true',
+        'hw_cpu_policy': 'dedicated',
+        'hw_cpu_thread_policy': 'prefer',
+        'hw_mem_page_size': 'large',
+        'hw_numa_nodes': '1',
+    },
+}
+
+# Values Nova accepts for the properties profiles may set.  Other hw_*
+# properties are rejected as likely typos.
+PROPERTY_VALUES = {
+    'hw_disk_bus': r'virtio|scsi|ide|sata',
+    'hw_vif_model': r'virtio|e1000|e1000e|rtl8139',
+    'hw_vif_multiqueue_enabled': r'true|false',
+    'hw_scsi_model': r'virtio-scsi',
+    'hw_cpu_policy': r'shared|dedicated',
+    'hw_cpu_thread_policy': r'prefer|isolate|require',
+    'hw_mem_page_size': r'small|large|any|\d+(KB|MB|GB)?',
+    'hw_numa_nodes': r'[1-9]\d*',
+}
+
+# Oldest BIG-IP release supporting a property value; None matches any value.
+MIN_BIGIP_VERSIONS = {
+    ('hw_disk_bus', 'virtio'): (11, 5),
+    ('hw_vif_model', 'virtio'): (11, 5),
+    ('hw_vif_multiqueue_enabled', 'true'): (13, 0),
+    ('hw_disk_bus', 'scsi'): (13, 1),
+    ('hw_scsi_model', 'virtio-scsi'): (13, 1),
+    ('hw_cpu_policy', 'dedicated'): (12, 1),
+    ('hw_mem_page_size', None): (13, 0),
+}
+
+BIGIP_VERSION = re.compile(r'BIGIP-(\d+)\.(\d+)\.(\d+)')
+
+
+class InvalidProfile(Exception):
+    pass
+
+
+def bigip_version(image_file):
+    '''BIG-IP version in an image's file name, e.g. (13, 1, 0), or None.'''
+
+    match = BIGIP_VERSION.search(os.path.basename(image_file))
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups())
+
+
+def _format_version(version):
+    return '.'.join(str(part) for part in version)
+
+
+def validate_properties(properties, version=None):
+    '''Check image properties against Nova's values and a BIG-IP version.
+
+    :param properties: dict -- property name to value
+    :param version: tuple -- BIG-IP version of the image, None skips the
+        version check
+    :raises: InvalidProfile
+    '''
+
+    for name, value in sorted(properties.items()):
+        pattern = PROPERTY_VALUES.get(name)
+        if pattern is None:
+            if name.startswith('hw_'):
+                raise InvalidProfile('Unknown image property %s' % name)
+            continue
+        if not re.match(r'(%s)$' % pattern, value):
+            raise InvalidProfile('Invalid value %r for %s' % (value, name))
+        if version is None:
+            continue
+        for key in ((name, value), (name, None)):
+            minimum = MIN_BIGIP_VERSIONS.get(key)
+            if minimum is not None and version < minimum:
+                raise InvalidProfile(
+                    '%s=%s needs BIG-IP %s or later, the image is %s' % (
+                        name, value, _format_version(minimum),
+                        _format_version(version)))
+
+
+def resolve_properties(names, image_file, profiles=None):
+    '''Merge profiles in order and validate them for an image.
+
+    :param names: list -- profile names, later ones override earlier ones
+    :param image_file: str -- image the properties are for
+    :param profiles: dict -- profile definitions, PROFILES by default
+    :returns: dict -- property name to value
+    :raises: InvalidProfile
+    '''
+
+    profiles = PROFILES if profiles is None else profiles
+    properties = {}
+    for name in names:
+        if name not in profiles:
+            raise InvalidProfile('Unknown property profile %s, choose from '
+                                 '%s' % (name, ', '.join(sorted(profiles))))
+        properties.update(profiles[name])
+    validate_properties(properties, bigip_version(image_file))
+    return properties
+
+
+def load_profiles(path):
+    '''Add the profiles of an INI file, one section each, to PROFILES.
+
+    A section named like a built-in profile replaces it.
+    '''
+
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise IOError('Cannot read property profiles file %s' % path)
+    profiles = dict(PROFILES)
+    for section in parser.sections():
+        properties = dict(parser.items(section))
+        validate_properties(properties)
+        profiles[section] = properties
+    return profiles
@@ -0,0 +1,568 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Minimal qcow2 reader/writer used to patch VE images in-process.
+
+Only the parts of the format needed to rewrite a handful of clusters in a
+pristine VE image are supported: version 2 and 3 images without snapshots,
+encryption or external data files.  Writes never go through the host
+kernel, so no root privileges, nbd module or mounts are required.
+"""
+
+import os
+import struct
+import zlib
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+HEADER_V2_LENGTH = 72
+HEADER_V3_LENGTH = 104
+
+EXT_END = 0x00000000
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+INCOMPAT_DIRTY = 1 << 0
+INCOMPAT_CORRUPT = 1 << 1
+
+L1E_OFFSET_MASK = 0x00fffffffffffe00
+L2E_OFFSET_MASK = 0x00fffffffffffe00
+REFT_OFFSET_MASK = 0xfffffffffffffe00
+QCOW_OFLAG_COPIED = 1 << 63
+QCOW_OFLAG_COMPRESSED = 1 << 62
+QCOW_OFLAG_ZERO = 1 << 0
+
+DEFAULT_CLUSTER_BITS = 16
+COMPRESSION_LEVEL = 6
+
+
+class Qcow2Error(Exception):
+    pass
+
+
+class Qcow2Unsupported(Qcow2Error):
+    pass
+
+
+def _align_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _div_round_up(value, divisor):
+    return (value + divisor - 1) // divisor
+
+
+def compress_cluster(data, level=COMPRESSION_LEVEL):
+    '''Deflate a cluster the way qcow2 stores it, None if it does not pay.
+
+    :param data: bytes -- one full guest cluster
+    :returns: bytes -- raw deflate stream, or None when it would not save
+        at least one sector
+    '''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -12)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) > len(data) - 512:
+        return None
+    return compressed
+
+
+class RawImage(object):
+    '''Read-only raw file exposing the same read interface as Qcow2Image.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+
+    def read(self, offset, length):
+        if offset >= self.size:
+            return b'\0' * length
+        self._file.seek(offset)
+        data = self._file.read(min(length, self.size - offset))
+        return data + b'\0' * (length - len(data))
+
+    def is_allocated(self, offset, length):
+        return offset < self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+
+def open_image(path, writable=False):
+    '''Open a qcow2 or raw image, detecting the format from its magic.
+
+    :param path: str -- path to image file
+    :param writable: bool -- open the image for writing (qcow2 only)
+    :returns: Qcow2Image or RawImage
+    '''
+
+    with open(path, 'rb') as image_file:
+        magic = image_file.read(4)
+    if magic == QCOW2_MAGIC:
+        return Qcow2Image(path, writable=writable)
+    if writable:
+        raise Qcow2Unsupported('Only qcow2 images can be opened for writing')
+    return RawImage(path)
+
+
+class Qcow2Image(object):
+    '''Random access to the guest view of a qcow2 image.'''
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._l2_cache = {}
+        self._compressed_cache = (None, None)
+        self.backing = None
+        try:
+            self._read_header()
+            self._read_l1_table()
+            if writable:
+                self._read_refcount_table()
+            self._open_backing()
+        except Exception:
+            self._file.close()
+            raise
+        self._file.seek(0, os.SEEK_END)
+        self._next_free = _align_up(self._file.tell(), self.cluster_size)
+        # Host cluster being filled with compressed data, and the number of
+        # guest clusters stored in it.
+        self._compressed_cluster = None
+        self._compressed_end = 0
+        self._compressed_refs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.backing is not None:
+            self.backing.close()
+            self.backing = None
+        if not self._file.closed:
+            self._file.close()
+
+    def _pread(self, offset, length):
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if len(data) < length:
+            data += b'\0' * (length - len(data))
+        return data
+
+    def _pwrite(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+
+    def _read_header(self):
+        header = self._pread(0, HEADER_V3_LENGTH)
+        (magic, self.version, backing_offset, backing_size,
+         self.cluster_bits, self.size, crypt_method, self.l1_size,
+         self.l1_table_offset, self.refcount_table_offset,
+         self.refcount_table_clusters, nb_snapshots,
+         _snapshots_offset) = struct.unpack('>4sIQIIQIIQQIIQ', header[:72])
+
+        if magic != QCOW2_MAGIC:
+            raise Qcow2Error('%s is not a qcow2 image' % self.path)
+        if self.version not in (2, 3):
+            raise Qcow2Unsupported(
+                'qcow2 version %d is not supported' % self.version)
+        if crypt_method:
+            raise Qcow2Unsupported('Encrypted qcow2 images are not supported')
+        if nb_snapshots and self.writable:
+            raise Qcow2Unsupported(
+                'Cannot write to qcow2 images that contain snapshots')
+
+        if self.version == 3:
+            (incompatible, _compatible, _autoclear, self.refcount_order,
+             self.header_length) = struct.unpack('>QQQII', header[72:104])
+            if incompatible & ~(INCOMPAT_DIRTY | INCOMPAT_CORRUPT):
+                raise Qcow2Unsupported(
+                    'qcow2 incompatible features 0x%x are not supported' %
+                    incompatible)
+            if incompatible & INCOMPAT_CORRUPT:
+                raise Qcow2Error('%s is marked corrupt' % self.path)
+            if incompatible & INCOMPAT_DIRTY and self.writable:
+                raise Qcow2Error(
+                    '%s has dirty refcounts; run qemu-img check -r all' %
+                    self.path)
+        else:
+            self.refcount_order = 4
+            self.header_length = HEADER_V2_LENGTH
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.refcount_bits = 1 << self.refcount_order
+        if self.refcount_bits != 16 and self.writable:
+            raise Qcow2Unsupported(
+                'Only 16 bit refcounts are supported for writing')
+        self.refblock_entries = self.cluster_size * 8 // self.refcount_bits
+        self._csize_shift = 62 - (self.cluster_bits - 8)
+        self._csize_mask = (1 << (self.cluster_bits - 8)) - 1
+        self._coffset_mask = (1 << self._csize_shift) - 1
+
+        self.backing_format = None
+        self._read_header_extensions()
+        self.backing_file = None
+        if backing_offset:
+            self.backing_file = self._pread(
+                backing_offset, backing_size).decode('utf-8')
+
+    def _read_header_extensions(self):
+        offset = self.header_length
+        while offset + 8 <= self.cluster_size:
+            ext_type, ext_length = struct.unpack(
+                '>II', self._pread(offset, 8))
+            if ext_type == EXT_END:
+                break
+            data = self._pread(offset + 8, ext_length)
+            if ext_type == EXT_BACKING_FORMAT:
+                self.backing_format = data.decode('utf-8')
+            offset += 8 + _align_up(ext_length, 8)
+
+    def _read_l1_table(self):
+        raw = self._pread(self.l1_table_offset, self.l1_size * 8)
+        self.l1_table = list(struct.unpack('>%dQ' % self.l1_size, raw))
+
+    def _read_refcount_table(self):
+        entries = self.refcount_table_clusters * self.cluster_size // 8
+        raw = self._pread(self.refcount_table_offset, entries * 8)
+        self.refcount_table = list(struct.unpack('>%dQ' % entries, raw))
+
+    def _open_backing(self):
+        if not self.backing_file:
+            return
+        backing_path = self.backing_file
+        if not os.path.isabs(backing_path):
+            backing_path = os.path.join(
+                os.path.dirname(os.path.abspath(self.path)), backing_path)
+        if self.backing_format == 'raw':
+            self.backing = RawImage(backing_path)
+        else:
+            self.backing = open_image(backing_path)
+
+    def _l2_table(self, l2_offset):
+        table = self._l2_cache.get(l2_offset)
+        if table is None:
+            raw = self._pread(l2_offset, self.cluster_size)
+            table = list(struct.unpack('>%dQ' % self.l2_entries, raw))
+            if len(self._l2_cache) > 256:
+                self._l2_cache.clear()
+            self._l2_cache[l2_offset] = table
+        return table
+
+    def _l2_entry(self, guest_cluster):
+        l1_index, l2_index = divmod(guest_cluster, self.l2_entries)
+        if l1_index >= self.l1_size:
+            return 0
+        l2_offset = self.l1_table[l1_index] & L1E_OFFSET_MASK
+        if not l2_offset:
+            return 0
+        return self._l2_table(l2_offset)[l2_index]
+
+    def _cluster_state(self, entry):
+        '''Classify an L2 entry as data, compressed, zero or unallocated.'''
+
+        if entry & QCOW_OFLAG_COMPRESSED:
+            return 'compressed'
+        if entry & QCOW_OFLAG_ZERO and self.version == 3:
+            return 'zero'
+        if entry & L2E_OFFSET_MASK:
+            return 'data'
+        return 'unallocated'
+
+    def _read_compressed(self, entry):
+        host_offset = entry & self._coffset_mask
+        if self._compressed_cache[0] == host_offset:
+            return self._compressed_cache[1]
+        nb_sectors = ((entry >> self._csize_shift) & self._csize_mask) + 1
+        length = nb_sectors * 512 - (host_offset & 511)
+        raw = self._pread(host_offset, length)
+        decompressor = zlib.decompressobj(-12)
+        data = decompressor.decompress(raw, self.cluster_size)
+        data += b'\0' * (self.cluster_size - len(data))
+        self._compressed_cache = (host_offset, data)
+        return data
+
+    def _read_cluster(self, guest_cluster):
+        entry = self._l2_entry(guest_cluster)
+        state = self._cluster_state(entry)
+        if state == 'data':
+            return self._pread(entry & L2E_OFFSET_MASK, self.cluster_size)
+        if state == 'compressed':
+            return self._read_compressed(entry)
+        if state == 'unallocated' and self.backing is not None:
+            offset = guest_cluster * self.cluster_size
+            length = max(0, min(self.cluster_size, self.backing.size - offset))
+            return self.backing.read(offset, length) + \
+                b'\0' * (self.cluster_size - length)
+        return b'\0' * self.cluster_size
+
+    def read(self, offset, length):
+        '''Read guest data.
+
+        :param offset: int -- guest byte offset
+        :param length: int -- number of bytes to read
+        :returns: bytes
+        '''
+
+        if offset + length > self.size:
+            raise Qcow2Error('Read beyond end of image')
+        chunks = []
+        while length > 0:
+            guest_cluster, in_cluster = divmod(offset, self.cluster_size)
+            count = min(length, self.cluster_size - in_cluster)
+            cluster = self._read_cluster(guest_cluster)
+            chunks.append(cluster[in_cluster:in_cluster + count])
+            offset += count
+            length -= count
+        return b''.join(chunks)
+
+    def is_allocated(self, offset, length):
+        '''Report whether any cluster in the range may hold non-zero data.
+
+        Looks through the backing chain.  Zero clusters are reported as
+        unallocated so callers can skip them.
+        '''
+
+        end = min(offset + length, self.size)
+        first = offset // self.cluster_size
+        last = _div_round_up(end, self.cluster_size)
+        for guest_cluster in range(first, last):
+            state = self._cluster_state(self._l2_entry(guest_cluster))
+            if state in ('data', 'compressed'):
+                return True
+            if state == 'unallocated' and self.backing is not None:
+                start = guest_cluster * self.cluster_size
+                if self.backing.is_allocated(start, self.cluster_size):
+                    return True
+        return False
+
+    def write(self, offset, data):
+        '''Write guest data, allocating clusters as needed.
+
+        :param offset: int -- guest byte offset
+        :param data: bytes -- data to write
+        '''
+
+        if not self.writable:
+            raise Qcow2Error('Image %s was not opened for writing' % self.path)
+        if offset + len(data) > self.size:
+            raise Qcow2Error('Write beyond end of image')
+        position = 0
+        while position < len(data):
+            guest_cluster, in_cluster = divmod(
+                offset + position, self.cluster_size)
+            count = min(len(data) - position, self.cluster_size - in_cluster)
+            chunk = data[position:position + count]
+            if count != self.cluster_size:
+                cluster = self._read_cluster(guest_cluster)
+                chunk = cluster[:in_cluster] + chunk + \
+                    cluster[in_cluster + count:]
+            self._write_cluster(guest_cluster, chunk)
+            position += count
+
+    def _write_cluster(self, guest_cluster, cluster):
+        l1_index, l2_index = divmod(guest_cluster, self.l2_entries)
+        l2_offset = self.l1_table[l1_index] & L1E_OFFSET_MASK
+        if not l2_offset:
+            l2_offset = self._allocate_cluster()
+            self._pwrite(l2_offset, b'\0' * self.cluster_size)
+            self._l2_cache[l2_offset] = [0] * self.l2_entries
+            self._set_l1_entry(l1_index, l2_offset | QCOW_OFLAG_COPIED)
+
+        table = self._l2_table(l2_offset)
+        entry = table[l2_index]
+        host_offset = entry & L2E_OFFSET_MASK
+        in_place = entry & QCOW_OFLAG_COPIED and host_offset and \
+            not entry & QCOW_OFLAG_COMPRESSED
+        if in_place:
+            self._pwrite(host_offset, cluster)
+            if entry & QCOW_OFLAG_ZERO:
+                self._set_l2_entry(
+                    l2_offset, l2_index, entry & ~QCOW_OFLAG_ZERO)
+            return
+
+        # Shared or compressed clusters are left where they are; only the
+        # new copy is referenced from this image.
+        host_offset = self._allocate_cluster()
+        self._pwrite(host_offset, cluster)
+        self._set_l2_entry(
+            l2_offset, l2_index, host_offset | QCOW_OFLAG_COPIED)
+
+    def write_compressed(self, guest_cluster, compressed):
+        '''Store a cluster compressed with compress_cluster().
+
+        Compressed clusters are packed back to back into host clusters,
+        each host cluster counting one reference per guest cluster in it.
+        The guest cluster must not hold data in this image yet.
+        '''
+
+        if not self.writable:
+            raise Qcow2Error('Image %s was not opened for writing' % self.path)
+        l1_index, l2_index = divmod(guest_cluster, self.l2_entries)
+        l2_offset = self.l1_table[l1_index] & L1E_OFFSET_MASK
+        if not l2_offset:
+            l2_offset = self._allocate_cluster()
+            self._pwrite(l2_offset, b'\0' * self.cluster_size)
+            self._l2_cache[l2_offset] = [0] * self.l2_entries
+            self._set_l1_entry(l1_index, l2_offset | QCOW_OFLAG_COPIED)
+        elif self._l2_table(l2_offset)[l2_index] & ~QCOW_OFLAG_ZERO:
+            raise Qcow2Error('Cluster %d of %s is already allocated' %
+                             (guest_cluster, self.path))
+
+        if self._compressed_cluster is None or self._compressed_end + \
+                len(compressed) > self._compressed_cluster + \
+                self.cluster_size:
+            self._compressed_cluster = self._allocate_cluster()
+            self._pwrite(self._compressed_cluster, b'\0' * self.cluster_size)
+            self._compressed_end = self._compressed_cluster
+            self._compressed_refs = 1
+        else:
+            self._compressed_refs += 1
+            self._set_refcount(self._compressed_cluster,
+                               self._compressed_refs)
+        host_offset = self._compressed_end
+        self._pwrite(host_offset, compressed)
+        self._compressed_end += len(compressed)
+
+        nb_sectors = (host_offset + len(compressed) - 1) // 512 - \
+            host_offset // 512 + 1
+        self._set_l2_entry(
+            l2_offset, l2_index, QCOW_OFLAG_COMPRESSED |
+            (nb_sectors - 1) << self._csize_shift | host_offset)
+
+    def _set_l1_entry(self, l1_index, value):
+        self.l1_table[l1_index] = value
+        self._pwrite(self.l1_table_offset + l1_index * 8,
+                     struct.pack('>Q', value))
+
+    def _set_l2_entry(self, l2_offset, l2_index, value):
+        self._l2_table(l2_offset)[l2_index] = value
+        self._pwrite(l2_offset + l2_index * 8, struct.pack('>Q', value))
+
+    def _allocate_cluster(self):
+        host_offset = self._next_free
+        self._next_free += self.cluster_size
+        self._set_refcount(host_offset, 1)
+        return host_offset
+
+    def _set_refcount(self, host_offset, value):
+        host_cluster = host_offset // self.cluster_size
+        table_index, block_index = divmod(host_cluster, self.refblock_entries)
+        if table_index >= len(self.refcount_table):
+            raise Qcow2Unsupported(
+                'Growing the refcount table of %s is not supported' %
+                self.path)
+        block_offset = self.refcount_table[table_index] & REFT_OFFSET_MASK
+        if not block_offset:
+            block_offset = self._next_free
+            self._next_free += self.cluster_size
+            self._pwrite(block_offset, b'\0' * self.cluster_size)
+            block_cluster = block_offset // self.cluster_size
+            if block_cluster // self.refblock_entries == table_index:
+                # The new refcount block describes itself.
+                self._pwrite(
+                    block_offset +
+                    (block_cluster % self.refblock_entries) * 2,
+                    struct.pack('>H', 1))
+            else:
+                self._set_refcount(block_offset, 1)
+            self.refcount_table[table_index] = block_offset
+            self._pwrite(self.refcount_table_offset + table_index * 8,
+                         struct.pack('>Q', block_offset))
+        self._pwrite(block_offset + block_index * 2, struct.pack('>H', value))
+
+    def flush(self):
+        if self.writable:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+def create(path, size, backing_file=None, backing_format=None,
+           cluster_bits=DEFAULT_CLUSTER_BITS):
+    '''Create an empty qcow2 version 3 image.
+
+    The refcount table is sized up front so that the image can hold every
+    guest cluster plus metadata without ever having to grow it.
+
+    :param path: str -- path of the image to create
+    :param size: int -- virtual size in bytes
+    :param backing_file: str -- optional backing image path
+    :param backing_format: str -- format of the backing image
+    :param cluster_bits: int -- log2 of the cluster size
+    '''
+
+    cluster_size = 1 << cluster_bits
+    l2_entries = cluster_size // 8
+    refblock_entries = cluster_size * 8 // 16
+    guest_clusters = _div_round_up(size, cluster_size)
+    l1_size = max(1, _div_round_up(guest_clusters, l2_entries))
+    l1_clusters = _div_round_up(l1_size * 8, cluster_size)
+
+    # Worst case host size: every guest cluster, every L2 table, the L1 and
+    # the refcount structures themselves, with slack for the latter.
+    max_clusters = guest_clusters + l1_size + l1_clusters + 1
+    max_clusters += _div_round_up(max_clusters, refblock_entries) + 2
+    refcount_table_entries = _div_round_up(max_clusters, refblock_entries) + 1
+    refcount_table_clusters = _div_round_up(
+        refcount_table_entries * 8, cluster_size)
+
+    l1_offset = cluster_size
+    refcount_table_offset = l1_offset + l1_clusters * cluster_size
+    refblock_offset = refcount_table_offset + \
+        refcount_table_clusters * cluster_size
+    used_clusters = refblock_offset // cluster_size + 1
+    if used_clusters > refblock_entries:
+        raise Qcow2Unsupported('Image metadata does not fit one refcount '
+                               'block; use a larger cluster size')
+
+    extensions = b''
+    if backing_format:
+        name = backing_format.encode('utf-8')
+        extensions += struct.pack('>II', EXT_BACKING_FORMAT, len(name))
+        extensions += name + b'\0' * (_align_up(len(name), 8) - len(name))
+    extensions += struct.pack('>II', EXT_END, 0)
+
+    backing_name = backing_file.encode('utf-8') if backing_file else b''
+    backing_offset = HEADER_V3_LENGTH + len(extensions) if backing_file else 0
+    header = struct.pack(
+        '>4sIQIIQIIQQIIQQQQII', QCOW2_MAGIC, 3, backing_offset,
+        len(backing_name), cluster_bits, size, 0, l1_size, l1_offset,
+        refcount_table_offset, refcount_table_clusters, 0, 0, 0, 0, 0, 4,
+        HEADER_V3_LENGTH)
+    header += extensions + backing_name
+    if len(header) > cluster_size:
+        raise Qcow2Error('qcow2 header does not fit into the first cluster')
+
+    with open(path, 'wb') as image_file:
+        image_file.write(header + b'\0' * (cluster_size - len(header)))
+        image_file.write(b'\0' * (l1_clusters * cluster_size))
+        table = [0] * (refcount_table_clusters * cluster_size // 8)
+        table[0] = refblock_offset
+        image_file.write(struct.pack('>%dQ' % len(table), *table))
+        refblock = [0] * refblock_entries
+        for index in range(used_clusters):
+            refblock[index] = 1
+        image_file.write(struct.pack('>%dH' % refblock_entries, *refblock))
@@ -0,0 +1,192 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Glance v2 uploads that survive a failed transfer or a restart.
+
+Glance accepts image data only as one request; there is no way to append
+at an offset.  What can be kept is everything around the data: the queued
+image record is reused instead of creating another one, and where the
+interoperable import API is available, data that reached the staging area
+is imported without being sent again.  The progress of every upload is
+recorded in a small JSON file in the working directory.
+"""
+
+import errno
+import json
+import os
+import time
+
+from glanceclient import exc
+
+
+IMPORT_METHOD = 'glance-direct'
+POLL_INTERVAL = 5
+IMPORT_TIMEOUT = 3600
+
+STEP_CREATED = 'created'
+STEP_STAGED = 'staged'
+STEP_IMPORTING = 'importing'
+
+# Image states a new upload attempt can continue from.
+RESUMABLE_STATUSES = ('queued', 'uploading', 'importing', 'active')
+
+
+class ResumableUploadFailed(Exception):
+    pass
+
+
+def upload_state_dir(work_dir):
+    '''Default directory for upload state under a working directory.'''
+
+    return os.path.join(work_dir, '.f5-image-prep', 'uploads')
+
+
+class UploadState(object):
+    '''Progress of one upload to one Glance endpoint, kept in a file.'''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as state_file:
+                self.values = json.load(state_file)
+        except (IOError, ValueError):
+            self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def update(self, **values):
+        self.values.update(values)
+        state_dir = os.path.dirname(self.path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.values, state_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        self.values = {}
+        try:
+            os.unlink(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+class ResumableUpload(object):
+    '''Create and upload one image through the Glance v2 API.'''
+
+    def __init__(self, glance_client, state_path, image_args,
+                 use_import=None, poll_interval=POLL_INTERVAL,
+                 timeout=IMPORT_TIMEOUT):
+        '''Initialize a ResumableUpload object.
+
+        :param glance_client: glanceclient.v2.client.Client
+        :param state_path: str -- file recording the upload's progress
+        :param image_args: dict -- attributes of the image to create
+        :param use_import: bool -- use stage and import; discovered from
+            the endpoint when None
+        :param timeout: int -- seconds to wait for an import to finish
+        '''
+
+        self.glance_client = glance_client
+        self.state = UploadState(state_path)
+        self.image_args = image_args
+        self.use_import = use_import
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.sent = False
+
+    def _import_supported(self):
+        if self.use_import is None:
+            try:
+                info = self.glance_client.images.get_import_info()
+                methods = info.get('import-methods', {}).get('value', [])
+            except Exception:
+                methods = []
+            self.use_import = IMPORT_METHOD in methods
+        return self.use_import
+
+    def _resume(self):
+        image_id = self.state.get('image_id')
+        if not image_id:
+            return None
+        try:
+            image = self.glance_client.images.get(image_id)
+        except exc.HTTPNotFound:
+            image = None
+        if image is None or image.status not in RESUMABLE_STATUSES:
+            self.state.clear()
+            return None
+        if image.status == 'queued':
+            # Nothing was staged, or the staged data was discarded.
+            self.state.update(step=STEP_CREATED)
+        elif image.status == 'importing':
+            self.state.update(step=STEP_IMPORTING)
+        print('Resuming upload of image %s (%s)' % (image_id, image.status))
+        return image
+
+    def _wait_active(self, image_id):
+        deadline = time.time() + self.timeout
+        while True:
+            image = self.glance_client.images.get(image_id)
+            if image.status == 'active':
+                return image
+            if image.status in ('killed', 'deleted'):
+                self.state.clear()
+                raise ResumableUploadFailed(
+                    'Import of image %s ended in status %s' %
+                    (image_id, image.status))
+            if time.time() > deadline:
+                raise ResumableUploadFailed(
+                    'Import of image %s still %s after %d seconds' %
+                    (image_id, image.status, self.timeout))
+            time.sleep(self.poll_interval)
+
+    def run(self, data, size):
+        '''Upload data, continuing a previous attempt where possible.
+
+        :param data: file object supplying the image data
+        :param size: int -- bytes in data
+        :returns: the active image
+        '''
+
+        image = self._resume()
+        if image is None:
+            image = self.glance_client.images.create(**self.image_args)
+            self.state.update(image_id=image.id, step=STEP_CREATED)
+        if image.status == 'active':
+            return image
+
+        if not self._import_supported():
+            self.sent = True
+            self.glance_client.images.upload(image.id, data, size)
+            return self.glance_client.images.get(image.id)
+
+        if self.state.get('step') == STEP_CREATED:
+            self.sent = True
+            self.glance_client.images.stage(image.id, data, size)
+            self.state.update(step=STEP_STAGED)
+        if self.state.get('step') == STEP_STAGED:
+            self.glance_client.images.image_import(
+                image.id, method=IMPORT_METHOD)
+            self.state.update(step=STEP_IMPORTING)
+        return self._wait_active(image.id)
+
+    def finish(self):
+        '''Forget the upload once its image is active.'''
+
+        self.state.clear()
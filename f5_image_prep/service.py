@@ -0,0 +1,499 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Long-running image prep: a watched inbox, a job queue and a status API.
+
+Images dropped into the inbox become jobs in a SQLite queue that survives
+restarts.  A pool of workers takes the queued jobs by priority and hands
+each to a job runner, which keeps its clients, caches and nbd devices warm
+between jobs.  ``NAME.base.iso`` and ``NAME.hotfix.iso`` next to
+``NAME.qcow2`` are copied into the image with it; dropping one of them
+after the image queues the image again.
+
+The status API answers on localhost:
+
+    GET  /status      queue counts and busy workers
+    GET  /jobs        recent jobs, ``?status=queued`` to filter
+    GET  /jobs/<id>   one job
+    POST /jobs        queue {"path": ..., "priority": ...}
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import re
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlparse
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+IMAGE_SUFFIX = '.qcow2'
+BASE_ISO_SUFFIX = '.base.iso'
+HOTFIX_ISO_SUFFIX = '.hotfix.iso'
+
+DEFAULT_WORKERS = 2
+DEFAULT_STATUS_PORT = 8775
+POLL_INTERVAL = 2.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    base_iso TEXT,
+    hotfix_iso TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    UNIQUE (path, signature)
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, id);
+'''
+
+
+def image_inputs(image_path):
+    '''The ISOs that go with an image in the inbox, None when absent.'''
+
+    stem = image_path[:-len(IMAGE_SUFFIX)]
+    return dict((key, path if os.path.isfile(path) else None)
+                for key, path in (('base_iso', stem + BASE_ISO_SUFFIX),
+                                  ('hotfix_iso', stem + HOTFIX_ISO_SUFFIX)))
+
+
+def image_for(path):
+    '''The image a dropped file belongs to, or None for other files.'''
+
+    if path.endswith(IMAGE_SUFFIX):
+        return path
+    for suffix in (BASE_ISO_SUFFIX, HOTFIX_ISO_SUFFIX):
+        if path.endswith(suffix):
+            return path[:-len(suffix)] + IMAGE_SUFFIX
+    return None
+
+
+def inputs_signature(paths):
+    '''Size and mtime of every input, so changed inputs make a new job.'''
+
+    parts = []
+    for path in paths:
+        if path is None:
+            parts.append('-')
+            continue
+        stat = os.stat(path)
+        parts.append('%d:%d' % (stat.st_size, int(stat.st_mtime)))
+    return '/'.join(parts)
+
+
+class JobQueue(object):
+    '''Persistent, prioritized queue of image prep jobs.'''
+
+    def __init__(self, path):
+        '''Initialize a JobQueue object.
+
+        :param path: str -- SQLite database, created when missing
+        '''
+
+        queue_dir = os.path.dirname(path)
+        if queue_dir and not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def add(self, path, priority=0, base_iso=None, hotfix_iso=None):
+        '''Queue a job unless the same inputs were already queued.
+
+        :returns: int -- job id, None for a duplicate
+        '''
+
+        signature = inputs_signature([path, base_iso, hotfix_iso])
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO jobs (path, signature, priority, '
+                'status, base_iso, hotfix_iso, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, signature, priority, JOB_QUEUED, base_iso,
+                 hotfix_iso, time.time()))
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def take(self):
+        '''Mark the most urgent queued job running and return it.'''
+
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT * FROM jobs WHERE status = ? '
+                'ORDER BY priority DESC, id LIMIT 1',
+                (JOB_QUEUED,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE jobs SET status = ?, started = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (JOB_RUNNING, time.time(), row['id']))
+        return self.get(row['id'])
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, '
+                'finished = ? WHERE id = ?',
+                (JOB_FAILED if error else JOB_DONE, result, error,
+                 time.time(), job_id))
+
+    def requeue_running(self):
+        '''Queue again the jobs a previous process did not finish.'''
+
+        with self._lock, self._db:
+            return self._db.execute(
+                'UPDATE jobs SET status = ? WHERE status = ?',
+                (JOB_QUEUED, JOB_RUNNING)).rowcount
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, status=None, limit=100):
+        query = 'SELECT * FROM jobs'
+        args = ()
+        if status:
+            query += ' WHERE status = ?'
+            args = (status,)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id DESC LIMIT ?',
+                                    args + (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status')
+            return dict((status, count) for status, count in rows)
+
+
+class InotifyWatcher(object):
+    '''Report files written or moved into a directory, through inotify.'''
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_init1  # AttributeError without inotify
+        self.directory = directory
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watch = self._libc.inotify_add_watch(
+            self._fd, directory.encode('utf-8'),
+            IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, 'inotify_add_watch %s failed' % directory)
+
+    def poll(self, timeout):
+        '''Paths that became complete, waiting up to timeout seconds.'''
+
+        readable = select.select([self._fd], [], [], timeout)[0]
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                paths.append(os.path.join(self.directory,
+                                          name.decode('utf-8')))
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    '''Report files whose size and mtime stopped changing between scans.'''
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._seen = {}
+        self._reported = {}
+
+    def _scan(self):
+        found = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (stat.st_size, stat.st_mtime)
+        return found
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        found = self._scan()
+        stable = [path for path, state in found.items()
+                  if self._seen.get(path) == state and
+                  self._reported.get(path) != state]
+        for path in stable:
+            self._reported[path] = found[path]
+        self._seen = found
+        return sorted(stable)
+
+    def close(self):
+        pass
+
+
+def make_watcher(directory):
+    '''inotify where the platform has it, directory scans otherwise.'''
+
+    try:
+        return InotifyWatcher(directory)
+    except (AttributeError, OSError, TypeError):
+        return PollingWatcher(directory)
+
+
+class _StatusServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        if url.path == '/status':
+            return self._send(200, service.status())
+        if url.path == '/jobs':
+            return self._send(200, service.queue.list(query.get('status')))
+        match = re.match(r'^/jobs/(\d+)$', url.path)
+        job = match and service.queue.get(int(match.group(1)))
+        if job:
+            return self._send(200, job)
+        return self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/jobs':
+            return self._send(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job_id = self.server.service.submit(
+                request['path'], int(request.get('priority', 0)))
+        except (ValueError, KeyError, OSError) as err:
+            return self._send(400, {'error': str(err)})
+        return self._send(201, {'id': job_id})
+
+
+class ImagePrepService(object):
+    '''Watch an inbox and prepare every image dropped into it.'''
+
+    def __init__(self, inbox, run_job, queue, workers=DEFAULT_WORKERS,
+                 status_port=DEFAULT_STATUS_PORT, watcher=None):
+        '''Initialize an ImagePrepService object.
+
+        :param inbox: str -- directory that images are dropped into
+        :param run_job: callable -- run_job(path, base_iso, hotfix_iso)
+            prepares one image and returns a short result
+        :param queue: JobQueue
+        :param workers: int -- jobs run at once
+        :param status_port: int -- localhost port of the status API, 0 for
+            any free port, None for no API
+        :param watcher: watcher of the inbox, chosen for the platform if
+            not given
+        '''
+
+        self.inbox = os.path.abspath(inbox)
+        self.run_job = run_job
+        self.queue = queue
+        self.workers = workers
+        self.status_port = status_port
+        self.watcher = watcher
+        self.busy = 0
+        self._stopping = threading.Event()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._status_server = None
+
+    def submit(self, path, priority=0):
+        '''Queue an image, with the ISOs lying next to it.'''
+
+        path = os.path.abspath(path)
+        if not path.endswith(IMAGE_SUFFIX) or not os.path.isfile(path):
+            raise ValueError('%s is not a qcow2 image' % path)
+        job_id = self.queue.add(path, priority, **image_inputs(path))
+        if job_id is not None:
+            with self._wakeup:
+                self._wakeup.notify()
+        return job_id
+
+    def handle_drop(self, path):
+        '''Queue the image a new inbox file belongs to, if any.'''
+
+        image = image_for(path)
+        if image is None or not os.path.isfile(image):
+            return None
+        return self.submit(image)
+
+    def status(self):
+        return {'inbox': self.inbox, 'workers': self.workers,
+                'busy': self.busy, 'jobs': self.queue.counts(),
+                'watcher': type(self.watcher).__name__}
+
+    def _watch(self):
+        while not self._stopping.is_set():
+            for path in self.watcher.poll(1.0):
+                try:
+                    self.handle_drop(path)
+                except (OSError, ValueError) as err:
+                    print('Cannot queue %s: %s' % (path, err))
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self.queue.take()
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(1.0)
+                continue
+            with self._wakeup:
+                self.busy += 1
+            try:
+                result = self.run_job(job['path'], job['base_iso'],
+                                      job['hotfix_iso'])
+            except Exception as err:
+                print('Job %d (%s) failed: %s' % (job['id'], job['path'],
+                                                  err))
+                self.queue.finish(job['id'], error=str(err) or repr(err))
+            else:
+                self.queue.finish(job['id'], result=result)
+            finally:
+                with self._wakeup:
+                    self.busy -= 1
+
+    def _thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    @property
+    def status_url(self):
+        if self._status_server is None:
+            return None
+        return 'http://127.0.0.1:%d' % self._status_server.server_address[1]
+
+    def start(self):
+        '''Pick up earlier jobs and inbox files, then start every thread.'''
+
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print('Queued %d unfinished jobs again' % requeued)
+        if self.watcher is None:
+            self.watcher = make_watcher(self.inbox)
+        for name in sorted(os.listdir(self.inbox)):
+            self.handle_drop(os.path.join(self.inbox, name))
+        if self.status_port is not None:
+            self._status_server = _StatusServer(
+                ('127.0.0.1', self.status_port), _StatusHandler)
+            self._status_server.service = self
+            self._thread(self._status_server.serve_forever)
+        self._thread(self._watch)
+        for _ in range(self.workers):
+            self._thread(self._work)
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if self._status_server is not None:
+            self._status_server.shutdown()
+            self._status_server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self.watcher.close()
+
+    def serve_forever(self):
+        self.start()
+        print('Watching %s, status at %s' % (self.inbox, self.status_url))
+        try:
+            while not self._stopping.is_set():
+                self._stopping.wait(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
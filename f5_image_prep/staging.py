@@ -0,0 +1,191 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Stage writable copies of VE images without copying their data.
+
+A reflink clone shares all extents with the pristine download on
+filesystems that support it (btrfs, xfs, ...).  Elsewhere a thin qcow2
+overlay backed by the download is created instead; it has to be
+flattened before it can leave the host.
+"""
+
+import errno
+import fcntl
+import itertools
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+
+from f5_image_prep.qcow2 import compress_cluster
+from f5_image_prep.qcow2 import create
+from f5_image_prep.qcow2 import open_image
+from f5_image_prep.qcow2 import Qcow2Image
+
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+STAGE_REFLINK = 'reflink'
+STAGE_OVERLAY = 'overlay'
+STAGE_COPY = 'copy'
+
+COMPRESS_BATCH_CLUSTERS = 64
+
+
+class StagingFailed(Exception):
+    pass
+
+
+def reflink_copy(src, dst):
+    '''Clone src to dst sharing all data extents.
+
+    :raises: StagingFailed -- when the filesystem cannot clone the file
+    '''
+
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except (IOError, OSError) as err:
+                failed = err
+            else:
+                return
+    os.unlink(dst)
+    raise StagingFailed('Cannot reflink %s: %s' % (src, failed))
+
+
+def create_overlay(src, dst):
+    '''Create a thin qcow2 overlay at dst backed by the qcow2 image src.'''
+
+    with Qcow2Image(src) as base:
+        size, cluster_bits = base.size, base.cluster_bits
+    create(dst, size, backing_file=os.path.abspath(src),
+           backing_format='qcow2', cluster_bits=cluster_bits)
+
+
+def stage_image(src, dst, allow_overlay=True):
+    '''Stage a writable copy of src at dst in the cheapest way available.
+
+    :param src: str -- pristine qcow2 image, left untouched
+    :param dst: str -- path of the writable copy
+    :param allow_overlay: bool -- fall back to a qcow2 overlay if reflinks
+        are not supported, rather than to a full copy
+    :returns: str -- STAGE_REFLINK, STAGE_OVERLAY or STAGE_COPY
+    '''
+
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        reflink_copy(src, dst)
+        return STAGE_REFLINK
+    except StagingFailed:
+        pass
+    if allow_overlay:
+        create_overlay(src, dst)
+        return STAGE_OVERLAY
+    shutil.copyfile(src, dst)
+    return STAGE_COPY
+
+
+def has_backing_file(path):
+    '''Report whether path is a qcow2 image that depends on another file.'''
+
+    image = open_image(path)
+    try:
+        return bool(getattr(image, 'backing_file', None))
+    finally:
+        image.close()
+
+
+def _data_clusters(image):
+    '''Yield (guest cluster, data) for clusters holding non-zero data.'''
+
+    zeros = b'\0' * image.cluster_size
+    for offset in range(0, image.size, image.cluster_size):
+        length = min(image.cluster_size, image.size - offset)
+        if not image.is_allocated(offset, length):
+            continue
+        data = image.read(offset, length)
+        if data != zeros[:length]:
+            yield offset // image.cluster_size, data
+
+
+def _compress_batch(batch, cluster_size):
+    # A short last cluster is compressed as a full one, zero padded.
+    return [(guest_cluster, data, compress_cluster(
+        data + b'\0' * (cluster_size - len(data))))
+        for guest_cluster, data in batch]
+
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def flatten_image(src, dst, compress=False):
+    '''Write a standalone, sparse qcow2 copy of src and its backing chain.
+
+    Only clusters holding non-zero data anywhere in the chain are copied.
+
+    :param src: str -- qcow2 image, usually an overlay
+    :param dst: str -- path of the flattened image
+    :param compress: bool -- store the clusters deflated, compressing them
+        on all CPUs
+    '''
+
+    with Qcow2Image(src) as image:
+        create(dst, image.size, cluster_bits=image.cluster_bits)
+        pool = None
+        try:
+            with Qcow2Image(dst, writable=True) as flat:
+                if not compress:
+                    for guest_cluster, data in _data_clusters(image):
+                        flat.write(guest_cluster * image.cluster_size, data)
+                else:
+                    workers = cpu_count()
+                    pool = ThreadPool(workers)
+                    # Bounded windows keep memory flat; zlib releases the
+                    # GIL, so the batches of a window compress in parallel.
+                    windows = _batches(_batches(_data_clusters(image),
+                                                COMPRESS_BATCH_CLUSTERS),
+                                       workers * 2)
+                    for window in windows:
+                        for batch in pool.map(
+                                lambda batch: _compress_batch(
+                                    batch, image.cluster_size), window):
+                            for guest_cluster, data, compressed in batch:
+                                if compressed is None:
+                                    flat.write(guest_cluster *
+                                               image.cluster_size, data)
+                                else:
+                                    flat.write_compressed(guest_cluster,
+                                                          compressed)
+                flat.flush()
+        except Exception:
+            try:
+                os.unlink(dst)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
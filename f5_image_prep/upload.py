@@ -0,0 +1,244 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Stream images to Glance while hashing them and reporting progress.
+
+The file is read once, in large aligned chunks, and only one chunk is held
+in memory at a time.  The digests computed along the way are compared with
+the checksum Glance reports, so no second pass over the image is needed.
+A qcow2 image can also be sent as a raw disk, converted while it is read.
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+from f5_image_prep.qcow2 import open_image
+
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_ALGORITHMS = ('md5', 'sha256')
+PROGRESS_INTERVAL = 10
+MB = 1024 * 1024
+
+
+class UploadVerificationFailed(Exception):
+    pass
+
+
+class RawDiskFile(object):
+    '''Read-only file object over the guest disk of a qcow2 image.
+
+    Unallocated and zero clusters read as zeros without touching the disk,
+    and overlays read through their backing chain.
+    '''
+
+    def __init__(self, path):
+        self._image = open_image(path)
+        self.size = self._image.size
+        self._position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        size = max(0, min(size, self.size - self._position))
+        data = self._image.read(self._position, size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._image.close()
+
+
+class UploadReader(object):
+    '''Read-only file object that hashes the data as it is consumed.'''
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE,
+                 algorithms=DEFAULT_ALGORITHMS, progress=None, raw=False):
+        '''Initialize an UploadReader object.
+
+        :param path: str -- file to upload
+        :param chunk_size: int -- bytes read from disk at a time, this is
+            also the memory ceiling of the reader
+        :param algorithms: tuple -- hashlib algorithms computed on the fly
+        :param progress: callable -- called with (bytes read, total bytes)
+        :param raw: bool -- send the guest disk of a qcow2 image as raw data
+        '''
+
+        self.path = path
+        if raw:
+            self._file = RawDiskFile(path)
+            self.size = self._file.size
+        else:
+            self._file = open(path, 'rb', 0)
+            self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.algorithms = tuple(algorithms)
+        self.progress = progress
+        self._position = 0
+        self._reset_hashes()
+        self._discard_buffer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _reset_hashes(self):
+        self._hashes = dict(
+            (algorithm, hashlib.new(algorithm))
+            for algorithm in self.algorithms)
+        self._hashed = 0
+
+    def _discard_buffer(self):
+        self._buffer = b''
+        self._buffer_offset = self._position
+        self._buffer_pos = 0
+
+    def _fill(self):
+        offset = self._position - self._position % self.chunk_size
+        self._file.seek(offset)
+        self._buffer = self._file.read(self.chunk_size)
+        self._buffer_offset = offset
+        self._buffer_pos = self._position - offset
+        if offset == self._hashed and self._buffer:
+            for digest in self._hashes.values():
+                digest.update(self._buffer)
+            self._hashed += len(self._buffer)
+
+    def read(self, size=-1):
+        if self._buffer_pos >= len(self._buffer):
+            if self._position >= self.size:
+                return b''
+            self._fill()
+        available = len(self._buffer) - self._buffer_pos
+        if size is None or size < 0 or size > available:
+            size = available
+        data = self._buffer[self._buffer_pos:self._buffer_pos + size]
+        self._buffer_pos += len(data)
+        self._position += len(data)
+        if self.progress is not None:
+            self.progress(self._position, self.size)
+        return data
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset == self._position:
+            return
+        self._position = max(offset, 0)
+        buffer_pos = self._position - self._buffer_offset
+        if self._position == 0:
+            # A rewind restarts the upload, and the digests with it.
+            self._reset_hashes()
+            self._discard_buffer()
+        elif 0 <= buffer_pos < len(self._buffer):
+            self._buffer_pos = buffer_pos
+        else:
+            self._discard_buffer()
+
+    def hexdigest(self, algorithm):
+        '''Digest of the whole file, once it has been read to the end.'''
+
+        if self._hashed != self.size:
+            raise ValueError('%s was not read to the end in order' %
+                             self.path)
+        return self._hashes[algorithm].hexdigest()
+
+    def close(self):
+        self._file.close()
+        self._buffer = b''
+
+
+class UploadProgress(object):
+    '''Print throughput and time remaining of an upload now and then.'''
+
+    def __init__(self, label, interval=PROGRESS_INTERVAL, out=None):
+        self.label = label
+        self.interval = interval
+        self.out = out or sys.stdout
+        self._start = None
+        self._last = None
+
+    def __call__(self, done, total):
+        now = time.time()
+        if self._start is None:
+            self._start = self._last = now
+        if done < total and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = max(now - self._start, 1e-6)
+        rate = done / elapsed
+        remaining = (total - done) / rate if rate else 0
+        self.out.write(
+            '%s: %.1f of %.1f MiB (%d%%), %.1f MiB/s, ETA %d:%02d:%02d\n' % (
+                self.label, done / float(MB), total / float(MB),
+                100 * done // max(total, 1), rate / MB,
+                remaining // 3600, remaining % 3600 // 60, remaining % 60))
+        self.out.flush()
+
+
+def verify_checksum(image, expected):
+    '''Compare the checksum Glance computed with an expected MD5.
+
+    :raises: UploadVerificationFailed -- on a missing or mismatched checksum
+    '''
+
+    checksum = getattr(image, 'checksum', None)
+    if checksum != expected:
+        raise UploadVerificationFailed(
+            'Glance image %s has checksum %s, but %s was uploaded' %
+            (image.id, checksum, expected))
+
+
+def verify_upload(image, reader, algorithm='md5'):
+    '''Compare the checksum Glance computed with the one read locally.
+
+    :param image: image model returned by Glance
+    :param reader: UploadReader -- the reader that supplied the image data
+    :raises: UploadVerificationFailed -- on a missing or mismatched checksum
+    '''
+
+    verify_checksum(image, reader.hexdigest(algorithm))
@@ -0,0 +1,300 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Validate VE userdata and compile it into shell variables.
+
+The startup scripts on the VE used to start ``perl -MJSON`` and parse the
+whole userdata again for every key they read.  The compiled file assigns
+every scalar in the userdata to a shell variable named after its path, so
+the scripts source it once and read keys without starting a process.
+``openstack-datasource.sh`` builds the same file at boot, with a single perl
+run, for userdata that comes from the config drive or metadata service.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+COMPILED_SUFFIX = '.vars'
+VARIABLE_PREFIX = 'OS_UD'
+
+
+class InvalidUserData(Exception):
+    pass
+
+
+def _string(value):
+    return isinstance(value, string_types)
+
+
+def _boolean(value):
+    return isinstance(value, bool) or value in ('true', 'false')
+
+
+def _integer(value):
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or \
+        _string(value) and value.isdigit()
+
+
+def _level(value):
+    return value in ('dedicated', 'minimum', 'nominal', 'none')
+
+
+def _allow_service(value):
+    return value in ('all', 'default', 'none')
+
+
+TYPE_NAMES = {
+    _string: 'a string',
+    _boolean: 'true or false',
+    _integer: 'an integer',
+    _level: 'dedicated, minimum, nominal or none',
+    _allow_service: 'all, default or none',
+}
+
+INTERFACE_SCHEMA = {
+    'dhcp': _boolean,
+    'address': _string,
+    'netmask': _string,
+    'vlan_name': _string,
+    'vlan_description': _string,
+    'vlan_tag': _integer,
+    'tagged': _boolean,
+    'mtu': _integer,
+    'selfip_name': _string,
+    'selfip_description': _string,
+    'selfip_allow_service': _allow_service,
+    'is_sync': _boolean,
+    'is_failover': _boolean,
+    'is_mirror_primary': _boolean,
+    'is_mirror_secondary': _boolean,
+}
+
+# The keys the startup scripts read.  Other keys are allowed and compiled
+# too; '*' stands for any key.
+SCHEMA = {
+    'bigip': {
+        'ssh_key_inject': _boolean,
+        'change_passwords': _boolean,
+        'admin_password': _string,
+        'root_password': _string,
+        'license': {
+            'host': _string,
+            'basekey': _string,
+            'addkey': _string,
+        },
+        'modules': {
+            'auto_provision': _boolean,
+            '*': _level,
+        },
+        'network': {
+            'dhcp': _boolean,
+            'vlan_prefix': _string,
+            'selfip_prefix': _string,
+            'interfaces': {'*': INTERFACE_SCHEMA},
+            'routes': [{'destination': _string, 'gateway': _string}],
+        },
+        'system_cmds': [_string],
+        'firstboot_cmds': [_string],
+        'continue_on_system_cmd_failure': _boolean,
+        'continue_on_firstboot_cmd_failure': _boolean,
+        'wait_condition_notify': _string,
+    },
+}
+
+
+def _validate(value, schema, path, errors):
+    location = '.'.join(path) or 'userdata'
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append('%s: expected an object' % location)
+            return
+        for key, item in sorted(value.items()):
+            item_schema = schema.get(key, schema.get('*'))
+            if item_schema is not None:
+                _validate(item, item_schema, path + [key], errors)
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            errors.append('%s: expected a list' % location)
+            return
+        for index, item in enumerate(value):
+            _validate(item, schema[0], path + [str(index)], errors)
+    elif not schema(value):
+        errors.append('%s: expected %s, not %s' % (
+            location, TYPE_NAMES[schema], json.dumps(value)))
+
+
+def validate_userdata(data):
+    '''Check parsed userdata against SCHEMA.
+
+    :raises: InvalidUserData -- listing every value of the wrong type
+    '''
+
+    errors = []
+    _validate(data, SCHEMA, [], errors)
+    if errors:
+        raise InvalidUserData('\n'.join(errors))
+
+
+def load_userdata(path):
+    '''Read and validate a userdata JSON file.
+
+    :returns: dict -- the parsed userdata
+    :raises: InvalidUserData
+    '''
+
+    with open(path, 'rb') as userdata_file:
+        content = userdata_file.read()
+    try:
+        data = json.loads(content.decode('utf-8'))
+    except ValueError as err:
+        raise InvalidUserData('%s is not valid JSON: %s' % (path, err))
+    try:
+        validate_userdata(data)
+    except InvalidUserData as err:
+        raise InvalidUserData('%s:\n%s' % (path, err))
+    return data
+
+
+def variable_name(keys):
+    '''Shell variable holding the value at a path of userdata keys.
+
+    Matches get_user_data_value in openstack-datasource.sh, which maps
+    ``{bigip}{license}{host}`` to ``OS_UD_bigip__license__host_``.
+    '''
+
+    path = ''.join('{%s}' % key for key in keys)
+    return VARIABLE_PREFIX + re.sub(r'[^A-Za-z0-9]', '_', path)
+
+
+def _shell_value(value):
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, float):
+        value = '%.15g' % value
+    elif not _string(value):
+        value = str(value)
+    return "'%s'" % value.replace("'", "'\\''")
+
+
+def _scalars(value, keys):
+    if isinstance(value, dict):
+        for key in sorted(value):
+            for item in _scalars(value[key], keys + [key]):
+                yield item
+    elif value is not None and not isinstance(value, list):
+        yield keys, value
+
+
+def compile_userdata(data, source_md5=''):
+    '''Shell assignments of every scalar in parsed userdata.
+
+    Lists are left out, except for the commands and routes, which are
+    joined the way the startup scripts expect them.
+
+    :param source_md5: str -- MD5 of the JSON file, so the VE can tell a
+        stale compiled file from a current one
+    :returns: str
+    :raises: InvalidUserData -- when two keys map to the same variable
+    '''
+
+    lines = ['# Compiled userdata, sourced by openstack-datasource.sh.',
+             'OS_USER_DATA_SOURCE_MD5=%s' % _shell_value(source_md5)]
+    names = {}
+    for keys, value in _scalars(data, []):
+        name = variable_name(keys)
+        if name in names:
+            raise InvalidUserData('%s and %s map to the same variable %s' % (
+                '.'.join(names[name]), '.'.join(keys), name))
+        names[name] = keys
+        lines.append('%s=%s' % (name, _shell_value(value)))
+
+    bigip = data.get('bigip') or {}
+    network = bigip.get('network') or {}
+    routes = ''.join('%s;%s|' % (route.get('destination', ''),
+                                 route.get('gateway', ''))
+                     for route in network.get('routes') or [])
+    lines.extend([
+        'OS_UD_SYSTEM_CMDS=%s' % _shell_value(
+            ';;'.join(bigip.get('system_cmds') or [])),
+        'OS_UD_FIRSTBOOT_CMDS=%s' % _shell_value(
+            ';;'.join(bigip.get('firstboot_cmds') or [])),
+        'OS_UD_NETWORK_ROUTES=%s' % _shell_value(routes),
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def compiled_name(path):
+    '''Name of the compiled file for a userdata file, e.g. user-data.vars.'''
+
+    name = os.path.basename(path)
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    return name + COMPILED_SUFFIX
+
+
+def compile_userdata_file(path, output_path):
+    '''Validate a userdata file and write its compiled form.
+
+    :param path: str -- userdata JSON file
+    :param output_path: str -- compiled file, readable by its owner only
+    :raises: InvalidUserData
+    '''
+
+    data = load_userdata(path)
+    with open(path, 'rb') as userdata_file:
+        source_md5 = hashlib.md5(userdata_file.read()).hexdigest()
+    content = compile_userdata(data, source_md5)
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with io.open(fd, 'w', encoding='utf-8') as output:
+        output.write(content)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Validate VE userdata and compile it for the startup '
+        'scripts.')
+    parser.add_argument('userdata', help='Userdata JSON file.')
+    parser.add_argument(
+        '-o', '--output',
+        help='Write the compiled userdata to this file.')
+    args = parser.parse_args(argv)
+    try:
+        if args.output:
+            compile_userdata_file(args.userdata, args.output)
+        else:
+            load_userdata(args.userdata)
+    except InvalidUserData as err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
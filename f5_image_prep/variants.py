@@ -0,0 +1,88 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tenant- or role-specific variants of one patched VE image.
+
+A variant only differs from the shared base in its userdata and in files
+extracted over the base's startup package.  Those are written into a thin
+qcow2 overlay of the patched base, so a variant costs a few megabytes
+instead of a copy of the whole image.
+"""
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+import os
+import re
+
+
+VARIANT_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+VARIANT_OPTIONS = ('userdata', 'startup_script_package')
+
+
+class InvalidVariant(Exception):
+    pass
+
+
+class ImageVariant(object):
+    '''Files that set one variant apart from the shared base image.'''
+
+    def __init__(self, name, userdata=None, startup_pkg=None):
+        '''Initialize an ImageVariant object.
+
+        :param name: str -- appended to the image name, e.g. 'tenant-a'
+        :param userdata: str -- userdata JSON file copied into /config
+        :param startup_pkg: str -- tarball extracted into /config over the
+            base's startup package
+        :raises: InvalidVariant
+        '''
+
+        if not VARIANT_NAME.match(name):
+            raise InvalidVariant('Variant name %r may only hold letters, '
+                                 'digits, ".", "_" and "-"' % name)
+        for path in (userdata, startup_pkg):
+            if path and not os.path.isfile(path):
+                raise InvalidVariant('%s: %s does not exist' % (name, path))
+        self.name = name
+        self.userdata = userdata
+        self.startup_pkg = startup_pkg
+
+    def __repr__(self):
+        return '<ImageVariant %s>' % self.name
+
+
+def load_variants(path):
+    '''Load variants from an INI file, one section per variant.
+
+    Every section takes userdata and startup_script_package, both
+    optional.  Relative paths are relative to the INI file.
+    '''
+
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise IOError('Cannot read variants file %s' % path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    variants = []
+    for section in parser.sections():
+        values = {}
+        for option in VARIANT_OPTIONS:
+            if parser.has_option(section, option):
+                values[option] = os.path.join(
+                    base_dir, os.path.expanduser(parser.get(section, option)))
+        variants.append(ImageVariant(
+            section, values.get('userdata'),
+            values.get('startup_script_package')))
+    return variants
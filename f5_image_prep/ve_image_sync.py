@@ -14,15 +14,80 @@
 #
 
 import argparse
+import hashlib
+import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
 import subprocess
 
+from f5_image_prep import __version__
+from f5_image_prep.cache import cache_dir_for
+from f5_image_prep.cache import hash_file
+from f5_image_prep.cache import inputs_fingerprint
+from f5_image_prep.cache import PatchCache
+from f5_image_prep.fanout import DEFAULT_WORKERS as UPLOAD_WORKERS
+from f5_image_prep.fanout import FanOutUpload
+from f5_image_prep.fanout import TARGET_FAILED
+from f5_image_prep.fanout import TARGET_REUSED
+from f5_image_prep.fanout import UploadTarget
+from f5_image_prep.injector import ImageInjector
+from f5_image_prep.metrics import Metrics
+from f5_image_prep.metrics import open_metrics
+from f5_image_prep.nbd import NbdDevicePool
+from f5_image_prep.nbd_patch import load_nbd_module
+from f5_image_prep.nbd_patch import NbdPatcher
+from f5_image_prep.openstack.client import enable_token_cache
+from f5_image_prep.openstack.client import get_session
 from f5_image_prep.openstack.glance import GlanceLib
+from f5_image_prep.openstack.keystone import KeystoneLib
 from f5_image_prep.openstack.openstack import get_creds
+from f5_image_prep.openstack.openstack import load_creds_profiles
+from f5_image_prep.openstack.share import ImageSharer
+from f5_image_prep.profiles import InvalidProfile
+from f5_image_prep.profiles import load_profiles
+from f5_image_prep.profiles import PROFILES
+from f5_image_prep.profiles import resolve_properties
+from f5_image_prep.resumable import ResumableUpload
+from f5_image_prep.resumable import upload_state_dir
+from f5_image_prep.service import DEFAULT_STATUS_PORT
+from f5_image_prep.service import DEFAULT_WORKERS
+from f5_image_prep.service import ImagePrepService
+from f5_image_prep.service import JobQueue
+from f5_image_prep.staging import create_overlay
+from f5_image_prep.staging import flatten_image
+from f5_image_prep.staging import STAGE_COPY
+from f5_image_prep.staging import STAGE_OVERLAY
+from f5_image_prep.staging import stage_image
+from f5_image_prep.upload import UploadProgress
+from f5_image_prep.upload import UploadReader
+from f5_image_prep.upload import UploadVerificationFailed
+from f5_image_prep.upload import verify_checksum
+from f5_image_prep.upload import verify_upload
+from f5_image_prep.variants import load_variants
+from f5_image_prep.verify import InputVerifier
 
 
 CONTAINERFORMAT = 'bare'
 DISKFORMAT = 'qcow2'
+PATCH_ENGINE_SCRIPT = 'script'
+PATCH_ENGINE_INLINE = 'inline'
+PATCH_ENGINE_NBD = 'nbd'
+PATCH_ENGINES = (PATCH_ENGINE_SCRIPT, PATCH_ENGINE_INLINE, PATCH_ENGINE_NBD)
+NBD_PATCH_ENGINES = (PATCH_ENGINE_SCRIPT, PATCH_ENGINE_NBD)
+# patch-image.sh stays available as PATCH_ENGINE_SCRIPT, e.g. where sudo
+# needs a password.
+DEFAULT_PATCH_ENGINE = PATCH_ENGINE_NBD
+TARGET_FORMAT_QCOW2 = 'qcow2'
+TARGET_FORMAT_COMPRESSED = 'qcow2-compressed'
+TARGET_FORMAT_RAW = 'raw'
+TARGET_FORMATS = (TARGET_FORMAT_QCOW2, TARGET_FORMAT_COMPRESSED,
+                  TARGET_FORMAT_RAW)
+FINGERPRINT_PROPERTY = 'f5_image_prep_fingerprint'
+# Raised whenever the same inputs start to produce a different image, so
+# that older cache entries and Glance fingerprints no longer match.
+FINGERPRINT_REVISION = 2
+GLANCE_V2_VISIBILITIES = ('public', 'private', 'shared', 'community')
 PATCHTOOL = '/home/imageprep/f5-openstack-image-prep/bin/patch-image.sh'
 STARTUPSCRIPTPKG = \
     '/home/imageprep/f5-openstack-image-prep/lib/f5_image_prep/startup.tar'
@@ -41,6 +106,26 @@ class ImagePatchFailed(Exception):
     pass
 
 
+class ImageUploadFailed(Exception):
+    pass
+
+
+def _image_visibility(image):
+    ''''true' for public images, 'false' otherwise, for both Glance APIs.'''
+
+    visibility = getattr(image, 'visibility', None)
+    if visibility in GLANCE_V2_VISIBILITIES:
+        return 'true' if visibility == 'public' else 'false'
+    return str(image.is_public).lower()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
 class VEImageSync(object):
     '''Handle synchronization of VE glance images.'''
 
@@ -50,18 +135,80 @@ class VEImageSync(object):
             imgfile,
             startup_script_pkg,
             public_image=False,
-            workdir=WORKDIR
+            workdir=WORKDIR,
+            userdata=None,
+            base_iso=None,
+            hotfix_iso=None,
+            patch_engine=DEFAULT_PATCH_ENGINE,
+            cache=None,
+            reuse_existing=False,
+            targets=None,
+            glance_api_version=1,
+            upload_retries=0,
+            metrics=None,
+            verify_inputs=True,
+            target_format=TARGET_FORMAT_QCOW2,
+            property_profiles=None,
+            profile_definitions=None,
+            upload_workers=UPLOAD_WORKERS
     ):
         '''Initialize a VEImageSync object.
 
         :param img_location: str -- path to a VE image
         :param userdata_location: str -- path to userdata to configure VE
+        :param base_iso: str -- base ISO to copy to /shared/images
+        :param hotfix_iso: str -- hotfix ISO to copy to /shared/images
+        :param patch_engine: str -- 'script' runs patch-image.sh with sudo,
+            'inline' patches the qcow2 file in-process without root, 'nbd'
+            drives qemu-nbd and the mounts from Python
+        :param cache: PatchCache -- reuse images patched from identical inputs
+        :param reuse_existing: bool -- skip the upload when Glance already
+            holds an image with the same checksum and prep inputs
+        :param targets: list -- (name, creds) of several Glance endpoints
+            to upload to at once, instead of the one behind creds
+        :param glance_api_version: int -- 2 uploads through the Glance v2
+            API and resumes interrupted uploads
+        :param upload_retries: int -- further attempts after an upload fails
+        :param metrics: Metrics -- receives timed spans of every stage
+        :param verify_inputs: bool -- check the image and ISOs against the
+            .md5/.sha256 files published next to them
+        :param target_format: str -- 'qcow2' uploads the image as is,
+            'qcow2-compressed' uploads a compressed copy, 'raw' streams the
+            guest disk as a raw image, e.g. for Ceph-backed Glance
+        :param property_profiles: list -- names of image property profiles
+            set on the image when it is created
+        :param profile_definitions: dict -- profiles to choose from,
+            profiles.PROFILES by default
+        :param upload_workers: int -- maximum number of targets looked up
+            or uploaded to at once
+        :raises: InvalidProfile -- when a profile does not suit the image
         '''
 
         self.os_creds = creds
         self.img_file = imgfile
         self.startup_script_pkg = startup_script_pkg
         self.public_image = 'true' if public_image else 'false'
+        self.userdata = userdata
+        self.base_iso = base_iso
+        self.hotfix_iso = hotfix_iso
+        if patch_engine not in PATCH_ENGINES:
+            raise ValueError('Unknown patch engine %s' % patch_engine)
+        self.patch_engine = patch_engine
+        self.cache = cache
+        self.reuse_existing = reuse_existing
+        self.targets = targets
+        self.glance_api_version = glance_api_version
+        self.upload_retries = upload_retries
+        self.upload_workers = upload_workers
+        self.verify_inputs = verify_inputs
+        self.verifier = None
+        if target_format not in TARGET_FORMATS:
+            raise ValueError('Unknown target format %s' % target_format)
+        self.target_format = target_format
+        self.raw = target_format == TARGET_FORMAT_RAW
+        self.disk_format = 'raw' if self.raw else DISKFORMAT
+        self.image_properties = resolve_properties(
+            property_profiles or (), imgfile, profile_definitions)
 
         if not os.path.isfile(self.img_file):
             msg = 'Local file {} does not exist'.format(self.img_file)
@@ -71,31 +218,349 @@ class VEImageSync(object):
             raise ImageFileNotQcow2(msg)
 
         self.filename = self.img_file.split('/')[-1]
+        self.metrics = (metrics or Metrics()).bind(image=self.filename)
+        self.staging = None
         self.work_dir = workdir
         if not self.work_dir.endswith('/'):
             self.work_dir += '/'
 
-    def _patch_image(self):
+    def _patch_image(self, nbd_device=None, mount_dir=None):
         '''Patch image with patch-image-tool
 
+        :param nbd_device: str -- nbd device for the script or nbd engine
+        :param mount_dir: str -- directory for their mount points
         :returns: str -- local of patched image file
         '''
 
+        self._start_verifier()
+        cache_key = None
+        if self.cache is not None:
+            with self.metrics.span('cache_lookup') as span:
+                cache_key = self._prep_fingerprint()
+                cached_image = self.cache.lookup(cache_key)
+                span.set(hit=bool(cached_image))
+            if cached_image:
+                self._check_inputs()
+                print('\n\nUsing cached patched image %s\n\n' % cached_image)
+                return cached_image
+
         print('\n\nPatching image...\n\n')
         patched_img_name = 'os_ready-' + self.filename
-        patch_call = ['sudo', '/bin/bash', PATCHTOOL, '-f',
-                      '-s', self.startup_script_pkg,
-                      '-t', self.work_dir[:-1],
-                      '-o', patched_img_name,
-                      self.img_file]
-        subprocess.check_output(patch_call)
+        try:
+            with self.metrics.span('patch', engine=self.patch_engine):
+                if self.patch_engine == PATCH_ENGINE_INLINE:
+                    self._patch_image_inline(self.work_dir + patched_img_name)
+                elif self.patch_engine == PATCH_ENGINE_NBD:
+                    self._patch_image_nbd(self.work_dir + patched_img_name,
+                                          nbd_device, mount_dir)
+                else:
+                    self._patch_image_script(patched_img_name, nbd_device,
+                                             mount_dir)
+        except Exception:
+            # A corrupt input explains a failed patch better than the
+            # error of the failed step.
+            self._check_inputs()
+            raise
+        self._check_inputs()
 
         if not os.path.isfile(self.work_dir + patched_img_name):
             msg = 'Something went terribly wrong. The rc on the image patch ' \
                 'command was 0, but no output image was created.'
             raise ImagePatchFailed(msg)
 
-        return self.work_dir + patched_img_name
+        patched_img = self.work_dir + patched_img_name
+        if cache_key is not None:
+            # Cached images are always standalone, never overlays.
+            self.staging = None
+            with self.metrics.span('cache_store'):
+                patched_img = self.cache.store(cache_key, patched_img)
+        return patched_img
+
+    def _release_image(self, prepped_image):
+        '''Let the cache evict a patched image once it is no longer used.'''
+
+        if self.cache is not None:
+            self.cache.release(prepped_image)
+
+    def _patch_tool_version(self):
+        '''Identify the patch tool, so a tool upgrade invalidates the cache.'''
+
+        version = '%s-%s-%d' % (self.patch_engine, __version__,
+                                FINGERPRINT_REVISION)
+        if self.patch_engine == PATCH_ENGINE_SCRIPT and \
+                os.path.isfile(PATCHTOOL):
+            version += '-' + self._file_digest(PATCHTOOL)
+        return version
+
+    def _start_verifier(self):
+        '''Read the inputs in the background, verifying them as they go.'''
+
+        self.verifier = None
+        if not self.verify_inputs:
+            return
+        self.verifier = InputVerifier(
+            [self.img_file, self.base_iso, self.hotfix_iso],
+            algorithms=('sha256',) if self.cache is not None else (),
+            cache=self.cache, metrics=self.metrics
+        ).start()
+
+    def _check_inputs(self):
+        if self.verifier is not None:
+            with self.metrics.span('verify_inputs'):
+                self.verifier.check()
+
+    def _file_digest(self, path, algorithm='sha256'):
+        if self.verifier is not None:
+            # Shares the read of an input that is being verified.
+            digest = self.verifier.digest(path, algorithm)
+            if digest is not None:
+                return digest
+        if self.cache is not None:
+            return self.cache.file_digest(path, algorithm)
+        return hash_file(path, algorithm)
+
+    def _input_names(self, *names):
+        '''File names the inputs are copied to the image under.
+
+        The userdata and ISOs keep their names inside the image, and the VE
+        only reads user-data.json, so the names are part of the image.
+        '''
+
+        return dict(
+            (name + '_name', os.path.basename(getattr(self, name)))
+            for name in names if getattr(self, name))
+
+    def _prep_fingerprint(self):
+        '''Digest of every patch input, used as cache key and in Glance.'''
+
+        options = {'firstboot': True}
+        options.update(self._input_names('userdata', 'base_iso',
+                                         'hotfix_iso'))
+        return inputs_fingerprint(
+            self._patch_tool_version(),
+            {
+                'image': self.img_file,
+                'startup_script_pkg': self.startup_script_pkg,
+                'userdata': self.userdata,
+                'base_iso': self.base_iso,
+                'hotfix_iso': self.hotfix_iso,
+            },
+            options,
+            self._file_digest
+        )
+
+    def _find_existing_image(self, glance, upload_location, fingerprint):
+        '''Find an identical image already held by Glance.'''
+
+        candidates = [
+            image for image in glance.find_images(
+                self.disk_format,
+                dict(self.image_properties,
+                     **{FINGERPRINT_PROPERTY: fingerprint}))
+            if _image_visibility(image) == self.public_image
+        ]
+        if not candidates:
+            return None
+        # Only hash the image when Glance holds a candidate at all.
+        checksum = self._upload_digest(upload_location)
+        for image in candidates:
+            if image.checksum == checksum:
+                return image
+        return None
+
+    def _patch_image_script(self, patched_img_name, nbd_device=None,
+                            mount_dir=None):
+        '''Patch a copy of the image with patch-image.sh under sudo.'''
+
+        patch_call = ['sudo', '/bin/bash', PATCHTOOL, '-f',
+                      '-s', self.startup_script_pkg,
+                      '-t', self.work_dir[:-1],
+                      '-o', patched_img_name]
+        if self.userdata:
+            patch_call += ['-u', self.userdata]
+        if self.base_iso:
+            patch_call += ['-b', self.base_iso]
+        if self.hotfix_iso:
+            patch_call += ['-h', self.hotfix_iso]
+        if nbd_device:
+            patch_call += ['-d', nbd_device]
+        if mount_dir:
+            patch_call += ['-m', mount_dir]
+        patch_call.append(self.img_file)
+        with self.metrics.span('command', command='patch-image.sh'):
+            subprocess.check_output(patch_call)
+
+    def _stage(self, patched_img_path):
+        '''Make the writable copy of the image that gets patched.'''
+
+        with self.metrics.span('stage') as span:
+            self.staging = stage_image(self.img_file, patched_img_path)
+            span.set(method=self.staging)
+            if self.staging == STAGE_COPY:
+                span.set(bytes=_file_size(self.img_file))
+
+    def _patch_image_inline(self, patched_img_path):
+        '''Patch a copy of the image in-process, without nbd or mounts.
+
+        The copy is a reflink clone or a thin overlay of the original, so
+        only the clusters the injector touches are ever written.
+        '''
+
+        self._stage(patched_img_path)
+        with self.metrics.span('inject'):
+            ImageInjector(patched_img_path, self.work_dir).inject(
+                startup_pkg=self.startup_script_pkg,
+                userdata=self.userdata,
+                firstboot=True,
+                base_iso=self.base_iso,
+                hotfix_iso=self.hotfix_iso
+            )
+
+    def _patch_image_nbd(self, patched_img_path, nbd_device=None,
+                         mount_dir=None):
+        '''Patch a copy of the image through an nbd device and mounts.'''
+
+        if nbd_device is None:
+            with NbdDevicePool().slot() as slot:
+                return self._patch_image_nbd(patched_img_path, slot.device,
+                                             slot.mount_dir)
+        self._stage(patched_img_path)
+        NbdPatcher(nbd_device, mount_dir, metrics=self.metrics).patch(
+            patched_img_path,
+            startup_pkg=self.startup_script_pkg,
+            userdata=self.userdata,
+            firstboot=True,
+            base_iso=self.base_iso,
+            hotfix_iso=self.hotfix_iso
+        )
+
+    def _upload_digest(self, upload_location, algorithm='md5'):
+        '''Digest of the data uploaded from a file, memoized if possible.'''
+
+        if not self.raw:
+            return self._file_digest(upload_location, algorithm)
+        key = 'raw-' + algorithm
+        if self.cache is not None:
+            known = self.cache.known_digest(upload_location, key)
+            if known:
+                return known
+        with UploadReader(upload_location, algorithms=(algorithm,),
+                          raw=True) as reader:
+            for _chunk in reader:
+                pass
+            digest = reader.hexdigest(algorithm)
+        if self.cache is not None:
+            self.cache.record_digest(upload_location, key, digest)
+        return digest
+
+    def _upload_file(self, patch_image_location):
+        '''File to upload for a patched image, flattening overlays.
+
+        Raw images are converted while they are uploaded, straight from the
+        overlay and its backing chain.
+        '''
+
+        if self.raw:
+            return patch_image_location
+        if self.target_format == TARGET_FORMAT_COMPRESSED:
+            upload_location = self.work_dir + 'compressed-' + \
+                os.path.basename(patch_image_location)
+            with self.metrics.span('compress') as span:
+                flatten_image(patch_image_location, upload_location,
+                              compress=True)
+                span.set(bytes=_file_size(upload_location))
+            return upload_location
+        if self.staging != STAGE_OVERLAY:
+            return patch_image_location
+        # Glance cannot follow the overlay's backing file.
+        upload_location = self.work_dir + 'flat-' + \
+            os.path.basename(patch_image_location)
+        with self.metrics.span('flatten') as span:
+            flatten_image(patch_image_location, upload_location)
+            span.set(bytes=_file_size(upload_location))
+        return upload_location
+
+    def _create_image(self, glance, data, reader, fingerprint=None):
+        '''Create a Glance image from data and check what Glance stored.
+
+        :param data: file object the image is read from
+        :param reader: UploadReader -- holds the digests of data
+        :param fingerprint: str -- prep fingerprint to record on the image
+        '''
+
+        if glance.api_version == 2:
+            return self._create_image_v2(glance, data, reader, fingerprint)
+        gc = glance.glance_client
+        create_args = {}
+        properties = dict(self.image_properties)
+        if fingerprint:
+            properties[FINGERPRINT_PROPERTY] = fingerprint
+        if properties:
+            create_args['properties'] = properties
+        img_model = gc.images.create(
+            name=self.filename.replace('.qcow2', ''),
+            disk_format=self.disk_format,
+            container_format=CONTAINERFORMAT,
+            is_public=self.public_image,
+            size=len(reader),
+            data=data,
+            **create_args
+        )
+        if not getattr(img_model, 'checksum', None):
+            img_model = gc.images.get(img_model.id)
+        try:
+            with self.metrics.span('verify'):
+                verify_upload(img_model, reader)
+        except UploadVerificationFailed:
+            # Never leave a corrupt image around for tenants to boot.
+            gc.images.delete(img_model.id)
+            raise
+        return img_model
+
+    def _upload_state_path(self, creds):
+        key = hashlib.sha256(json.dumps([
+            creds.auth_url,
+            getattr(creds, 'region_name', None),
+            creds.tenant_name,
+            self.filename,
+            self.public_image,
+            self.target_format,
+            sorted(self.image_properties.items()),
+            self._prep_fingerprint(),
+        ]).encode('utf-8')).hexdigest()
+        return os.path.join(upload_state_dir(self.work_dir), key + '.json')
+
+    def _create_image_v2(self, glance, data, reader, fingerprint=None):
+        '''Create an image through Glance v2, resuming an earlier attempt.'''
+
+        image_args = dict(
+            name=self.filename.replace('.qcow2', ''),
+            disk_format=self.disk_format,
+            container_format=CONTAINERFORMAT,
+            visibility='public' if self.public_image == 'true' else 'private'
+        )
+        image_args.update(self.image_properties)
+        if fingerprint:
+            image_args[FINGERPRINT_PROPERTY] = fingerprint
+        upload = ResumableUpload(
+            glance.glance_client, self._upload_state_path(glance.creds),
+            image_args)
+        img_model = upload.run(data, len(reader))
+        try:
+            with self.metrics.span('verify', resumed=not upload.sent):
+                if upload.sent:
+                    verify_upload(img_model, reader)
+                else:
+                    # The data went up in an earlier attempt.
+                    verify_checksum(
+                        img_model, self._upload_digest(reader.path))
+        except UploadVerificationFailed:
+            # Never leave a corrupt image around for tenants to boot.
+            glance.glance_client.images.delete(img_model.id)
+            raise
+        finally:
+            upload.finish()
+        return img_model
 
     def _upload_image_to_glance(self, patch_image_location):
         '''Patch image, then upload it to Glance.
@@ -105,35 +570,496 @@ class VEImageSync(object):
         '''
 
         print('\n\nUploading patched image to glance...\n\n')
-        gc = GlanceLib(self.os_creds).glance_client
+        glance = GlanceLib(self.os_creds, api_version=self.glance_api_version)
         img_name = self.filename.replace('.qcow2', '')
-        img_model = gc.images.create(
-            name=img_name,
-            disk_format=DISKFORMAT,
-            container_format=CONTAINERFORMAT,
-            is_public=self.public_image,
-            data=open(patch_image_location, 'rb')
-        )
-        imgs = [img.id for img in gc.images.list()]
-        assert img_model.id in imgs
+        upload_location = self._upload_file(patch_image_location)
+        try:
+            fingerprint = None
+            if self.reuse_existing:
+                with self.metrics.span('find_existing') as span:
+                    fingerprint = self._prep_fingerprint()
+                    existing = self._find_existing_image(
+                        glance, upload_location, fingerprint)
+                    span.set(found=existing is not None)
+                if existing is not None:
+                    print('\n\nGlance already holds an identical image %s, '
+                          'skipping upload.\n\n' % existing.id)
+                    return existing
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    with self.metrics.span('upload', attempt=attempt,
+                                           bytes=_file_size(upload_location)):
+                        with UploadReader(
+                                upload_location,
+                                progress=UploadProgress(img_name),
+                                raw=self.raw) as reader:
+                            img_model = self._create_image(
+                                glance, reader, reader, fingerprint)
+                    break
+                except UploadVerificationFailed:
+                    raise
+                except Exception as ex:
+                    if attempt > self.upload_retries:
+                        raise
+                    print('\n\nUpload failed (%s), retrying...\n\n' % ex)
+        finally:
+            if upload_location != patch_image_location:
+                os.unlink(upload_location)
+        if self.cache is not None and \
+                upload_location == patch_image_location:
+            prefix = 'raw-' if self.raw else ''
+            for algorithm in reader.algorithms:
+                self.cache.record_digest(
+                    patch_image_location, prefix + algorithm,
+                    reader.hexdigest(algorithm))
         return img_model
 
+    def _find_existing_images(self, upload_location, targets, fingerprint):
+        '''Mark the targets that already hold an identical image.'''
+
+        def find(target):
+            try:
+                image = self._find_existing_image(
+                    GlanceLib(target.creds,
+                              api_version=self.glance_api_version),
+                    upload_location, fingerprint)
+            except Exception as ex:
+                print('%s: cannot look for an identical image: %s' % (
+                    target.name, ex))
+                return
+            if image is not None:
+                target.image = image
+                target.status = TARGET_REUSED
+
+        pool = ThreadPool(max(1, min(self.upload_workers, len(targets))))
+        try:
+            pool.map(find, targets)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _upload_image_to_targets(self, patch_image_location):
+        '''Upload the patched image to every target from a single read.
+
+        :returns: list -- UploadTarget per Glance endpoint
+        '''
+
+        targets = [UploadTarget(name, creds) for name, creds in self.targets]
+        print('\n\nUploading patched image to %d glance endpoints...\n\n' %
+              len(targets))
+        img_name = self.filename.replace('.qcow2', '')
+        upload_location = self._upload_file(patch_image_location)
+        try:
+            fingerprint = None
+            if self.reuse_existing:
+                with self.metrics.span('find_existing'):
+                    fingerprint = self._prep_fingerprint()
+                    self._find_existing_images(
+                        upload_location, targets, fingerprint)
+            pending = [target for target in targets
+                       if target.status != TARGET_REUSED]
+            with self.metrics.span('upload', targets=len(pending),
+                                   bytes=_file_size(upload_location)):
+                FanOutUpload(
+                    upload_location,
+                    pending,
+                    lambda target, data, reader: self._create_image(
+                        GlanceLib(target.creds,
+                                  api_version=self.glance_api_version),
+                        data, reader, fingerprint),
+                    retries=self.upload_retries,
+                    progress=UploadProgress(img_name),
+                    raw=self.raw,
+                    workers=self.upload_workers
+                ).run()
+        finally:
+            if upload_location != patch_image_location:
+                os.unlink(upload_location)
+        for target in targets:
+            self.metrics.event('upload_target', target=target.name,
+                               status=target.status, attempts=target.attempts,
+                               elapsed=target.elapsed)
+        return targets
+
+    def _upload(self, patch_image_location):
+        if self.targets:
+            return self._upload_image_to_targets(patch_image_location)
+        return self._upload_image_to_glance(patch_image_location)
+
     def sync_image(self):
         '''Entry into syncing VE image to glance.'''
 
-        prepped_image = self._patch_image()
-        img_model = self._upload_image_to_glance(prepped_image)
+        with self.metrics.span('sync_image'):
+            prepped_image = self._patch_image()
+            try:
+                img_model = self._upload(prepped_image)
+            finally:
+                self._release_image(prepped_image)
         print('\n\nImage Model:\n')
         print(img_model)
         return img_model
 
 
+class VEImageJobRunner(object):
+    '''Patch and upload one image per call, for a long-running service.
+
+    Keystone sessions, Glance clients, the patch cache and the nbd devices
+    are shared by every call, so only the first job pays for them.
+    '''
+
+    def __init__(self, creds, startup_script_pkg, nbd_pool=None, **kwargs):
+        '''Initialize a VEImageJobRunner object.
+
+        :param nbd_pool: NbdDevicePool -- nbd devices for the script and
+            nbd engines
+        :param kwargs: further VEImageSync arguments shared by all images
+        '''
+
+        self.creds = creds
+        self.startup_script_pkg = startup_script_pkg
+        self.kwargs = kwargs
+        self.patch_engine = kwargs.get('patch_engine', DEFAULT_PATCH_ENGINE)
+        self.nbd_pool = nbd_pool
+        if self.nbd_pool is None and self.patch_engine in NBD_PATCH_ENGINES:
+            self.nbd_pool = NbdDevicePool()
+
+    def warm_up(self):
+        '''Authenticate and load the nbd module before the first job.'''
+
+        targets = self.kwargs.get('targets') or [('default', self.creds)]
+        for _name, creds in targets:
+            get_session(creds).endpoint('image')
+        if self.patch_engine in NBD_PATCH_ENGINES:
+            load_nbd_module()
+
+    def __call__(self, imgfile, base_iso=None, hotfix_iso=None):
+        '''Prepare one image.
+
+        :param base_iso: str -- overrides the runner's base ISO
+        :param hotfix_iso: str -- overrides the runner's hotfix ISO
+        :returns: str -- id of the Glance image, per target if several
+        '''
+
+        kwargs = dict(self.kwargs)
+        if base_iso:
+            kwargs['base_iso'] = base_iso
+        if hotfix_iso:
+            kwargs['hotfix_iso'] = hotfix_iso
+        image_sync = VEImageSync(self.creds, imgfile, self.startup_script_pkg,
+                                 **kwargs)
+        with image_sync.metrics.span('sync_image'):
+            prepped_image = _patch_in_slot(image_sync, self.nbd_pool)
+            try:
+                result = image_sync._upload(prepped_image)
+            finally:
+                image_sync._release_image(prepped_image)
+        if not image_sync.targets:
+            return result.id
+        failed = [target for target in result
+                  if target.status == TARGET_FAILED]
+        if failed:
+            raise ImageUploadFailed('Upload failed for %s' % ', '.join(
+                '%s (%s)' % (target.name, target.error) for target in failed))
+        return ', '.join('%s=%s' % (target.name, target.image.id)
+                         for target in result)
+
+
+def upload_targets(creds, profiles=None, regions=None):
+    '''List the Glance endpoints to upload to.
+
+    :param creds: OpenStackCreds -- used when no profiles are given
+    :param profiles: dict -- profile name to OpenStackCreds
+    :param regions: list -- region names, applied to every profile
+    :returns: list -- (name, creds) pairs
+    '''
+
+    named = sorted(profiles.items()) if profiles else [('default', creds)]
+    if not regions:
+        return named
+    return [(region if len(named) == 1 else '%s/%s' % (name, region),
+             profile_creds.for_region(region))
+            for name, profile_creds in named for region in regions]
+
+
+def report_targets(imgfile, targets):
+    '''Print the outcome of a multi-target upload.
+
+    :returns: bool -- True if every target holds the image
+    '''
+
+    for target in targets:
+        if target.status == TARGET_FAILED:
+            print('%s: %s: FAILED after %d attempts: %s' % (
+                imgfile, target.name, target.attempts, target.error))
+        else:
+            print('%s: %s: %s %s' % (
+                imgfile, target.name, target.status, target.image.id))
+    return all(target.status != TARGET_FAILED for target in targets)
+
+
+def share_image(creds, result, tenant_names=None, prune=False,
+                glance_api_version=1, label=None):
+    '''Share an uploaded image with tenants and print the outcome.
+
+    :param creds: OpenStackCreds -- admin creds the image was uploaded with
+    :param result: image model, or a list of UploadTarget
+    :param tenant_names: list -- tenants to share with, all non-admin
+        tenants when None
+    :param prune: bool -- also remove members that are not wanted
+    :returns: bool -- True if every tenant has access
+    '''
+
+    if isinstance(result, list):
+        uploads = [('%s: %s' % (label, target.name), target.creds,
+                    target.image)
+                   for target in result if target.image is not None]
+    else:
+        uploads = [(label, creds, result)]
+    shared = True
+    for upload_label, upload_creds, image in uploads:
+        sharer = ImageSharer(
+            GlanceLib(upload_creds, api_version=glance_api_version),
+            KeystoneLib(upload_creds))
+        for member in sharer.share(image, tenant_names, prune):
+            if member.ok:
+                print('%s: member %s: %s' % (upload_label, member.name,
+                                             member.action))
+            else:
+                shared = False
+                print('%s: member %s: FAILED: %s' % (
+                    upload_label, member.name, member.error))
+    return shared
+
+
+def _patch_in_slot(image_sync, nbd_pool):
+    '''Patch an image, on an nbd device of the pool if its engine needs one.'''
+
+    if image_sync.patch_engine not in NBD_PATCH_ENGINES:
+        return image_sync._patch_image()
+    with nbd_pool.slot() as slot:
+        return image_sync._patch_image(
+            nbd_device=slot.device, mount_dir=slot.mount_dir)
+
+
+class VEImageBatchSync(object):
+    '''Patch and upload several VE images concurrently.'''
+
+    def __init__(
+            self,
+            creds,
+            imgfiles,
+            startup_script_pkg,
+            workers=None,
+            nbd_pool=None,
+            **kwargs
+    ):
+        '''Initialize a VEImageBatchSync object.
+
+        :param imgfiles: list -- paths to VE images
+        :param workers: int -- maximum number of images patched at once,
+            defaults to the number of CPUs
+        :param nbd_pool: NbdDevicePool -- nbd devices for the script and
+            nbd engines
+        :param kwargs: further VEImageSync arguments shared by all images
+        '''
+
+        self.image_syncs = [
+            VEImageSync(creds, imgfile, startup_script_pkg, **kwargs)
+            for imgfile in imgfiles
+        ]
+        self.workers = workers or cpu_count()
+        self.nbd_pool = nbd_pool
+        if any(ve.patch_engine in NBD_PATCH_ENGINES
+               for ve in self.image_syncs):
+            if self.nbd_pool is None:
+                self.nbd_pool = NbdDevicePool()
+            self.workers = min(self.workers, len(self.nbd_pool))
+
+    def _patch_image(self, image_sync):
+        return _patch_in_slot(image_sync, self.nbd_pool)
+
+    def _sync_image(self, image_sync):
+        try:
+            with image_sync.metrics.span('sync_image'):
+                prepped_image = self._patch_image(image_sync)
+                try:
+                    img_model = image_sync._upload(prepped_image)
+                finally:
+                    image_sync._release_image(prepped_image)
+        except Exception as ex:
+            return image_sync.img_file, None, ex
+        return image_sync.img_file, img_model, None
+
+    def sync_images(self):
+        '''Patch and upload all images with a bounded worker pool.
+
+        :returns: list -- (image file, image model, exception) per image;
+            with several targets, a list of UploadTarget replaces the model
+        '''
+
+        pool = ThreadPool(max(1, min(self.workers, len(self.image_syncs))))
+        try:
+            return pool.map(self._sync_image, self.image_syncs)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class VEImageVariant(VEImageSync):
+    '''A variant of a patched image, built as a thin overlay of it.'''
+
+    def __init__(self, creds, imgfile, startup_script_pkg, variant,
+                 **kwargs):
+        '''Initialize a VEImageVariant object.
+
+        :param variant: ImageVariant -- files that set the variant apart
+        :param kwargs: further VEImageSync arguments; userdata is used for
+            variants without userdata of their own
+        '''
+
+        if variant.userdata:
+            kwargs['userdata'] = variant.userdata
+        VEImageSync.__init__(self, creds, imgfile, startup_script_pkg,
+                             **kwargs)
+        self.variant = variant
+        self.filename = '%s-%s.qcow2' % (
+            self.filename.replace('.qcow2', ''), variant.name)
+        self.metrics = self.metrics.bind(image=self.filename,
+                                         variant=variant.name)
+        self.base_fingerprint = None
+
+    def _build(self, base_image):
+        '''Write the variant's files into an overlay of the patched base.
+
+        :param base_image: str -- patched base image, left untouched
+        :returns: str -- path of the overlay
+        '''
+
+        variant_path = self.work_dir + 'os_ready-' + self.filename
+        with self.metrics.span('stage') as span:
+            if os.path.exists(variant_path):
+                os.unlink(variant_path)
+            create_overlay(base_image, variant_path)
+            span.set(method=STAGE_OVERLAY)
+        # Flattened by _upload_file, only once the variant is uploaded.
+        self.staging = STAGE_OVERLAY
+        with self.metrics.span('inject'):
+            ImageInjector(variant_path, self.work_dir).inject(
+                startup_pkg=self.variant.startup_pkg,
+                userdata=self.userdata
+            )
+        return variant_path
+
+    def _prep_fingerprint(self):
+        '''Digest of the base's patch inputs and the variant's own files.'''
+
+        options = {'base': self.base_fingerprint,
+                   'variant': self.variant.name}
+        options.update(self._input_names('userdata'))
+        return inputs_fingerprint(
+            'variant-%s-%d' % (__version__, FINGERPRINT_REVISION),
+            {
+                'userdata': self.userdata,
+                'startup_script_overrides': self.variant.startup_pkg,
+            },
+            options,
+            self._file_digest
+        )
+
+
+class VEImageVariantSync(object):
+    '''Patch a VE image once and upload thin variants of it concurrently.'''
+
+    def __init__(
+            self,
+            creds,
+            imgfile,
+            startup_script_pkg,
+            variants,
+            workers=None,
+            nbd_pool=None,
+            **kwargs
+    ):
+        '''Initialize a VEImageVariantSync object.
+
+        :param variants: list -- ImageVariant per image to upload
+        :param workers: int -- maximum number of variants built at once,
+            defaults to the number of CPUs
+        :param nbd_pool: NbdDevicePool -- nbd devices for the script and
+            nbd engines, which only patch the base
+        :param kwargs: further VEImageSync arguments; userdata only goes
+            into the variants
+        '''
+
+        self.base = VEImageSync(creds, imgfile, startup_script_pkg,
+                                **dict(kwargs, userdata=None))
+        self.variant_syncs = [
+            VEImageVariant(creds, imgfile, startup_script_pkg, variant,
+                           **kwargs)
+            for variant in variants
+        ]
+        self.workers = workers or cpu_count()
+        self.nbd_pool = nbd_pool
+        if self.nbd_pool is None and \
+                self.base.patch_engine in NBD_PATCH_ENGINES:
+            self.nbd_pool = NbdDevicePool()
+
+    def _sync_variant(self, variant_sync, base_image):
+        try:
+            with variant_sync.metrics.span('sync_image'):
+                variant_image = variant_sync._build(base_image)
+                try:
+                    img_model = variant_sync._upload(variant_image)
+                finally:
+                    os.unlink(variant_image)
+        except Exception as ex:
+            return variant_sync.variant.name, None, ex
+        return variant_sync.variant.name, img_model, None
+
+    def sync_images(self):
+        '''Patch the base once, then build and upload every variant.
+
+        :returns: list -- (variant name, image model, exception) per
+            variant; with several targets, a list of UploadTarget replaces
+            the model
+        '''
+
+        with self.base.metrics.span('patch_base'):
+            base_image = _patch_in_slot(self.base, self.nbd_pool)
+        # Part of the variants' Glance fingerprints and upload state keys.
+        base_fingerprint = self.base._prep_fingerprint()
+        for variant_sync in self.variant_syncs:
+            variant_sync.base_fingerprint = base_fingerprint
+        pool = ThreadPool(max(1, min(self.workers, len(self.variant_syncs))))
+        try:
+            return pool.map(
+                lambda variant_sync: self._sync_variant(variant_sync,
+                                                        base_image),
+                self.variant_syncs)
+        finally:
+            pool.close()
+            pool.join()
+            # The variants' overlays are gone, the base can be evicted.
+            self.base._release_image(base_image)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '-i', '--imagefile',
-        help='Location (local or otherwise) to VE image file.',
-        required=True
+        '-i', '--imagefile', nargs='+',
+        help='Location (local or otherwise) to VE image file. Several '
+        'images are patched and uploaded concurrently.'
+    )
+    parser.add_argument(
+        '--watch', metavar='INBOX',
+        help='Run as a service: prepare every image dropped into INBOX, '
+        'with NAME.base.iso and NAME.hotfix.iso next to NAME.qcow2.'
+    )
+    parser.add_argument(
+        '--status-port', type=int, default=DEFAULT_STATUS_PORT,
+        help='Localhost port of the service\'s job status API.'
     )
     parser.add_argument(
         '-w', '--working-directory',
@@ -149,14 +1075,246 @@ if __name__ == "__main__":
         '-p', '--public-image', dest='public_image', action='store_true',
         help='Glance image can be public or non-public.'
     )
+    parser.add_argument(
+        '-u', '--userdata',
+        help='Default userdata JSON file which will be injected into the VE.'
+    )
+    parser.add_argument(
+        '-b', '--base-iso',
+        help='Base ISO to copy to /shared/images on the VE.'
+    )
+    parser.add_argument(
+        '--hotfix-iso',
+        help='Hotfix ISO to copy to /shared/images on the VE.'
+    )
+    parser.add_argument(
+        '-e', '--patch-engine', choices=PATCH_ENGINES,
+        default=DEFAULT_PATCH_ENGINE,
+        help='Patch with nbd (qemu-nbd and mounts driven from Python, '
+        'needs passwordless sudo; the default), inline (in-process, no '
+        'root needed) or script (patch-image.sh under sudo).'
+    )
+    parser.add_argument(
+        '--target-format', choices=TARGET_FORMATS,
+        default=TARGET_FORMAT_QCOW2,
+        help='Upload the image as qcow2, as a compressed qcow2 (smaller '
+        'uploads for file or Swift backed Glance) or as raw, converted '
+        'while uploading (for Ceph RBD backed Glance, which can only clone '
+        'raw images).'
+    )
+    parser.add_argument(
+        '--property-profile', nargs='+', metavar='PROFILE',
+        help='Image property profiles set on the image when it is created, '
+        'e.g. virtio-multiqueue or high-performance; later profiles '
+        'override earlier ones. Built in: %s.' % ', '.join(sorted(PROFILES))
+    )
+    parser.add_argument(
+        '--property-profiles-file',
+        help='INI file of further property profiles, one section per '
+        'profile with one image property per option.'
+    )
+    parser.add_argument(
+        '--variants',
+        help='INI file of image variants, one section per variant with '
+        'userdata and startup_script_package. The image is patched once '
+        'and every variant is uploaded as NAME-VARIANT.'
+    )
+    parser.add_argument(
+        '--share-with', nargs='+', metavar='TENANT',
+        help='Share the private image with these tenants through Glance '
+        'image membership instead of uploading a copy per tenant.'
+    )
+    parser.add_argument(
+        '--share-with-all-tenants', action='store_true',
+        help='Share the private image with every non-admin tenant.'
+    )
+    parser.add_argument(
+        '--prune-members', action='store_true',
+        help='Stop sharing the image with tenants no longer listed.'
+    )
+    parser.add_argument(
+        '--workers', type=int,
+        help='Maximum number of images patched at once (default: CPUs).'
+    )
+    parser.add_argument(
+        '--force-upload', dest='reuse_existing', action='store_false',
+        help='Upload even if Glance already holds an identical image.'
+    )
+    parser.add_argument(
+        '--glance-api-version', type=int, choices=(1, 2), default=1,
+        help='Glance API used for uploads; version 2 resumes interrupted '
+        'uploads and stages them through the import API where available.'
+    )
+    parser.add_argument(
+        '--upload-retries', type=int, default=2,
+        help='Further attempts after an upload fails.'
+    )
+    parser.add_argument(
+        '--token-cache', action='store_true',
+        help='Keep keystone tokens in the working directory so that '
+        'back-to-back runs do not authenticate again.'
+    )
+    parser.add_argument(
+        '--creds-file',
+        help='INI file of credential profiles, one section per profile '
+        'with auth_url, tenant_name, username, password and region_name.'
+    )
+    parser.add_argument(
+        '--profile', nargs='+',
+        help='Profiles from --creds-file to upload to (default: all).'
+    )
+    parser.add_argument(
+        '--region', nargs='+',
+        help='Regions to upload to, for every profile.'
+    )
+    parser.add_argument(
+        '--cache-size', type=float, default=0,
+        help='Cache patched images in the working directory, within this '
+        'size budget in GB, e.g. 50; off by default.'
+    )
+    parser.add_argument(
+        '--skip-verify', dest='verify_inputs', action='store_false',
+        help='Do not check the image and ISOs against the .md5/.sha256 '
+        'files published next to them.'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Append timed spans of every stage to this file, as JSON lines.'
+    )
     args = parser.parse_args()
+    if not args.imagefile and not args.watch:
+        parser.error('one of -i/--imagefile or --watch is required')
+    if args.variants and (args.watch or len(args.imagefile) != 1):
+        parser.error('--variants takes exactly one -i/--imagefile')
+    sharing = args.share_with or args.share_with_all_tenants
+    if sharing and (args.public_image or args.watch):
+        parser.error('only private images uploaded with -i can be shared')
+    if args.prune_members and not sharing:
+        parser.error('--prune-members requires --share-with or '
+                     '--share-with-all-tenants')
+    profile_definitions = None
+    try:
+        if args.property_profiles_file:
+            profile_definitions = load_profiles(args.property_profiles_file)
+        for imgfile in args.imagefile or ():
+            resolve_properties(args.property_profile or (), imgfile,
+                               profile_definitions)
+    except InvalidProfile as err:
+        parser.error(str(err))
+
+    def share(label, result):
+        if not sharing:
+            return True
+        return share_image(creds, result, args.share_with,
+                           args.prune_members, args.glance_api_version,
+                           label)
 
+    if args.token_cache:
+        enable_token_cache(os.path.join(
+            args.working_directory, '.f5-image-prep', 'tokens.json'))
     creds = get_creds()
-    ve_image_sync = VEImageSync(
-        creds,
-        args.imagefile,
-        args.startup_script_package,
+    profiles = None
+    if args.creds_file:
+        profiles = load_creds_profiles(args.creds_file)
+        if args.profile:
+            unknown = set(args.profile) - set(profiles)
+            if unknown:
+                parser.error('Unknown profiles: %s' %
+                             ', '.join(sorted(unknown)))
+            profiles = dict((name, profiles[name]) for name in args.profile)
+    elif args.profile:
+        parser.error('--profile requires --creds-file')
+    targets = upload_targets(creds, profiles, args.region)
+    if len(targets) == 1:
+        creds, targets = targets[0][1], None
+    cache = None
+    if args.cache_size > 0:
+        cache = PatchCache(cache_dir_for(args.working_directory),
+                           int(args.cache_size * 1024 ** 3))
+    sync_args = dict(
         public_image=args.public_image,
-        workdir=args.working_directory
+        workdir=args.working_directory,
+        userdata=args.userdata,
+        base_iso=args.base_iso,
+        hotfix_iso=args.hotfix_iso,
+        patch_engine=args.patch_engine,
+        cache=cache,
+        reuse_existing=args.reuse_existing,
+        targets=targets,
+        glance_api_version=args.glance_api_version,
+        upload_retries=args.upload_retries,
+        verify_inputs=args.verify_inputs,
+        target_format=args.target_format,
+        property_profiles=args.property_profile,
+        profile_definitions=profile_definitions
     )
-    ve_image_sync.sync_image()
+    if args.metrics_file:
+        sync_args['metrics'] = open_metrics(args.metrics_file)
+    if args.watch:
+        runner = VEImageJobRunner(
+            creds, args.startup_script_package, **sync_args)
+        runner.warm_up()
+        workers = args.workers or DEFAULT_WORKERS
+        if runner.nbd_pool is not None:
+            workers = min(workers, len(runner.nbd_pool))
+        ImagePrepService(
+            args.watch, runner,
+            JobQueue(os.path.join(args.working_directory, '.f5-image-prep',
+                                  'jobs.db')),
+            workers=workers,
+            status_port=args.status_port
+        ).serve_forever()
+    elif args.variants:
+        variant_sync = VEImageVariantSync(
+            creds,
+            args.imagefile[0],
+            args.startup_script_package,
+            load_variants(args.variants),
+            workers=args.workers,
+            **sync_args
+        )
+        failed = False
+        for name, img_model, error in variant_sync.sync_images():
+            if error:
+                failed = True
+                print('%s: FAILED: %s' % (name, error))
+                continue
+            if targets:
+                failed = not report_targets(name, img_model) or failed
+            else:
+                print('%s: %s' % (name, img_model.id))
+            failed = not share(name, img_model) or failed
+        if failed:
+            raise SystemExit(1)
+    elif len(args.imagefile) == 1:
+        ve_image_sync = VEImageSync(
+            creds,
+            args.imagefile[0],
+            args.startup_script_package,
+            **sync_args
+        )
+        result = ve_image_sync.sync_image()
+        failed = targets and not report_targets(args.imagefile[0], result)
+        if not share(args.imagefile[0], result) or failed:
+            raise SystemExit(1)
+    else:
+        batch = VEImageBatchSync(
+            creds,
+            args.imagefile,
+            args.startup_script_package,
+            workers=args.workers,
+            **sync_args
+        )
+        failed = False
+        for imgfile, img_model, error in batch.sync_images():
+            if error:
+                failed = True
+                print('%s: FAILED: %s' % (imgfile, error))
+                continue
+            if targets:
+                failed = not report_targets(imgfile, img_model) or failed
+            else:
+                print('%s: %s' % (imgfile, img_model.id))
+            failed = not share(imgfile, img_model) or failed
+        if failed:
+            raise SystemExit(1)
@@ -0,0 +1,202 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Verify downloaded images and ISOs against their checksum sidecars.
+
+F5 publishes ``NAME.md5`` and, for newer releases, ``NAME.sha256`` next to
+every download.  Each input is read once, in large blocks, and every digest
+needed is computed from that one read: the published checksums as well as
+the digest the patch cache keys on.  Every input is read in a background
+thread of its own, so verification overlaps with staging and patching
+rather than adding a full read of each file up front.
+"""
+
+import errno
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import re
+import threading
+
+from f5_image_prep.metrics import Metrics
+
+
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+READ_AHEAD_BLOCKS = 2
+SIDECARS = (('sha256', '.sha256'), ('md5', '.md5'))
+HEX_LENGTHS = {'md5': 32, 'sha256': 64}
+
+
+class InputVerificationFailed(Exception):
+    pass
+
+
+class ChecksumMismatch(InputVerificationFailed):
+    pass
+
+
+def read_sidecars(path):
+    '''Checksums published next to a file.
+
+    Both the ``md5sum`` format and the BSD ``MD5 (NAME) = ...`` format are
+    understood.
+
+    :param path: str -- downloaded file
+    :returns: dict -- algorithm to expected hex digest, empty without
+        sidecars
+    :raises: InputVerificationFailed -- when a sidecar holds no checksum
+    '''
+
+    expected = {}
+    for algorithm, suffix in SIDECARS:
+        sidecar = path + suffix
+        try:
+            with open(sidecar) as sidecar_file:
+                content = sidecar_file.read()
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                continue
+            raise
+        match = re.search(r'\b[0-9a-fA-F]{%d}\b' % HEX_LENGTHS[algorithm],
+                          content)
+        if match is None:
+            raise InputVerificationFailed(
+                '%s does not hold a %s checksum' % (sidecar, algorithm))
+        expected[algorithm] = match.group(0).lower()
+    return expected
+
+
+def digest_file(path, algorithms, block_size=READ_BLOCK_SIZE):
+    '''Hex digests of a file in several algorithms, from a single read.
+
+    The next blocks are read by a separate thread while the current one is
+    hashed; both release the GIL for blocks this large.
+
+    :returns: dict -- algorithm to hex digest
+    '''
+
+    digests = [(algorithm, hashlib.new(algorithm))
+               for algorithm in algorithms]
+    blocks = queue.Queue(maxsize=READ_AHEAD_BLOCKS)
+
+    def read():
+        try:
+            with open(path, 'rb') as input_file:
+                while True:
+                    block = input_file.read(block_size)
+                    blocks.put(block)
+                    if not block:
+                        return
+        except (IOError, OSError) as err:
+            blocks.put(err)
+
+    reader = threading.Thread(target=read, name='read-%s' %
+                              os.path.basename(path))
+    reader.daemon = True
+    reader.start()
+    while True:
+        block = blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            break
+        for _algorithm, digest in digests:
+            digest.update(block)
+    reader.join()
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in digests)
+
+
+class InputVerifier(object):
+    '''Verify input files in the background and share their digests.'''
+
+    def __init__(self, paths, algorithms=(), cache=None, metrics=None):
+        '''Initialize an InputVerifier object.
+
+        :param paths: list -- input files, None entries are ignored
+        :param algorithms: tuple -- digests wanted even without a sidecar
+        :param cache: PatchCache -- memoizes the digests across runs
+        :param metrics: Metrics -- receives a span per file read
+        '''
+
+        self.paths = []
+        for path in paths:
+            if path and path not in self.paths:
+                self.paths.append(path)
+        self.algorithms = algorithms
+        self.cache = cache
+        self.metrics = metrics or Metrics()
+        self._results = {}
+
+    def start(self):
+        '''Start reading every input, each in a thread of its own.'''
+
+        pool = ThreadPool(max(len(self.paths), 1))
+        for path in self.paths:
+            self._results[path] = pool.apply_async(self._verify, (path,))
+        pool.close()
+        return self
+
+    def _verify(self, path):
+        expected = read_sidecars(path)
+        wanted = sorted(set(expected) | set(self.algorithms))
+        digests = {}
+        if self.cache is not None:
+            for algorithm in wanted:
+                known = self.cache.known_digest(path, algorithm)
+                if known:
+                    digests[algorithm] = known
+        missing = [algorithm for algorithm in wanted
+                   if algorithm not in digests]
+        if missing:
+            with self.metrics.span('verify_input',
+                                   file=os.path.basename(path),
+                                   bytes=os.path.getsize(path)):
+                digests.update(digest_file(path, missing))
+            if self.cache is not None:
+                for algorithm in missing:
+                    self.cache.record_digest(path, algorithm,
+                                             digests[algorithm])
+        for algorithm, checksum in sorted(expected.items()):
+            if digests[algorithm] != checksum:
+                raise ChecksumMismatch(
+                    '%s is corrupt: its %s is %s, but %s%s says %s' % (
+                        path, algorithm, digests[algorithm], path,
+                        dict(SIDECARS)[algorithm], checksum))
+        return digests
+
+    def digest(self, path, algorithm):
+        '''Digest of an input once it was read, None if not computed.
+
+        :raises: ChecksumMismatch -- when the input is corrupt
+        '''
+
+        result = self._results.get(path)
+        if result is None:
+            return None
+        return result.get().get(algorithm)
+
+    def check(self):
+        '''Wait until every input was read.
+
+        :raises: InputVerificationFailed -- for the first corrupt input
+        '''
+
+        for path in self.paths:
+            self._results[path].get()
@@ -19,10 +19,18 @@ OS_CONFIG_DIR="/config"
 OS_USER_DATA_TMP_FILE="$OS_CONFIG_DIR/openstack-user-data.json"
 OS_META_DATA_TMP_FILE="$OS_CONFIG_DIR/openstack-meta-data.json"
 OS_USER_DATA_LOCAL_FILE="/config/user-data.json"
+# userdata compiled into shell variables, see f5_image_prep/userdata.py
+OS_USER_DATA_VARS_FILE="$OS_CONFIG_DIR/openstack-user-data.vars"
+OS_USER_DATA_LOCAL_VARS_FILE="${OS_USER_DATA_LOCAL_FILE%.json}.vars"
+# metadata service found by get_metadata_service_url, empty if none
+OS_METADATA_URL_FILE="$OS_CONFIG_DIR/openstack-metadata-url"
+# the config drive and metadata service write here while probed at once
+OS_DATASOURCE_PROBE_DIR="$OS_CONFIG_DIR/openstack-datasource"
 
 OS_USER_DATA_RETRIES=20
 OS_USER_DATA_RETRY_INTERVAL=10
 OS_USER_DATA_RETRY_MAX_TIME=300
+OS_METADATA_PROBE_TIMEOUT=2
 
 OS_USER_DATA_CLEANUP=true
 OS_META_DATA_CLEANUP=true
@@ -71,25 +79,87 @@ function get_json_value() {
     \$value =~ s/([^a-zA-Z0-9])/\$1/g; print \$value" $2)
 }
 
+# Read a userdata value loaded by load_user_data_values, e.g.
+# get_user_data_value {bigip}{license}{host} prints $OS_UD_bigip__license__host_
 function get_user_data_value() {
-  echo -n $(get_json_value $1 $OS_USER_DATA_TMP_FILE)
+  local name=OS_UD${1//[^A-Za-z0-9]/_}
+  echo -n ${!name}
 }
 
 function get_user_data_system_cmds() {
-  echo -n $(perl -MJSON -ne "print join(';;', \
-  @{decode_json(\$_)->{bigip}{system_cmds}})" $OS_USER_DATA_TMP_FILE)
+  echo -n $OS_UD_SYSTEM_CMDS
 }
 
 function get_user_data_firstboot_cmds() {
-  echo -n $(perl -MJSON -ne "print join(';;', \
-  @{decode_json(\$_)->{bigip}{firstboot_cmds}})" $OS_USER_DATA_TMP_FILE)
+  echo -n $OS_UD_FIRSTBOOT_CMDS
 }
 
 function get_user_data_network_routes() {
-  echo -n $(perl -MJSON -ne "\$data = decode_json(\$_); \
-  foreach \$route (@{\$data->{'bigip'}->{'network'}->{'routes'}}) { \
-    print \$route->{'destination'}.\";\".\$route->{'gateway'}.\"|\"; \
-  }" $OS_USER_DATA_TMP_FILE)
+  echo -n $OS_UD_NETWORK_ROUTES
+}
+
+# Compile the userdata into shell variables with a single perl run, for
+# userdata that was not compiled when the image was prepared.  The output
+# matches f5_image_prep/userdata.py.
+function compile_user_data() {
+  perl -MJSON -e '
+    binmode STDOUT, ":utf8";
+    my $data = eval { local $/; decode_json(<STDIN>) };
+    exit 1 unless ref $data eq "HASH";
+    sub quote {
+      my $value = shift;
+      $value = JSON::is_bool($value) ? ($value ? "true" : "false") : "$value";
+      $value =~ s/\x27/\x27\\\x27\x27/g;
+      return "\x27$value\x27";
+    }
+    sub walk {
+      my ($path, $value) = @_;
+      if (ref $value eq "HASH") {
+        walk($path . "{$_}", $value->{$_}) foreach sort keys %$value;
+      } elsif (defined $value && (!ref $value || JSON::is_bool($value))) {
+        (my $name = $path) =~ s/[^A-Za-z0-9]/_/g;
+        print "OS_UD$name=" . quote($value) . "\n";
+      }
+    }
+    print "# Compiled userdata, sourced by openstack-datasource.sh.\n";
+    walk("", $data);
+    my $bigip = ref $data->{bigip} eq "HASH" ? $data->{bigip} : {};
+    my $network = ref $bigip->{network} eq "HASH" ? $bigip->{network} : {};
+    my $routes = "";
+    foreach my $route (@{$network->{routes} || []}) {
+      $routes .= $route->{destination} . ";" . $route->{gateway} . "|";
+    }
+    print "OS_UD_SYSTEM_CMDS=" .
+      quote(join(";;", @{$bigip->{system_cmds} || []})) . "\n";
+    print "OS_UD_FIRSTBOOT_CMDS=" .
+      quote(join(";;", @{$bigip->{firstboot_cmds} || []})) . "\n";
+    print "OS_UD_NETWORK_ROUTES=" . quote($routes) . "\n";
+  ' < $OS_USER_DATA_TMP_FILE > $OS_USER_DATA_VARS_FILE
+  chmod 0600 $OS_USER_DATA_VARS_FILE
+}
+
+# Load the userdata into shell variables once, compiling it unless a
+# compiled file is already there.
+function load_user_data_values() {
+  if [[ ! -s $OS_USER_DATA_VARS_FILE ]]; then
+    compile_user_data || log "Could not compile user-data, it is not a JSON object..."
+  fi
+  source $OS_USER_DATA_VARS_FILE
+}
+
+# apply tmsh commands as one cli transaction, validated and applied
+# together, e.g. so mcpd reprovisions once
+# args: tmsh commands
+# return:
+# 0 -- success
+function submit_tmsh_transaction() {
+    local cmds="create cli transaction"
+    local cmd
+    for cmd in "$@"; do
+	cmds="$cmds; $cmd"
+    done
+    tmsh -c "$cmds; submit cli transaction" 2>&1 | eval $LOGGER_CMD
+    return ${PIPESTATUS[0]}
 }
 
 function get_dhcp_server_address() {
@@ -99,71 +169,104 @@ function get_dhcp_server_address() {
 
 # cleanup user-data, disable for debug purposes
 function cleanup_user_data() {
-	[[ $OS_USER_DATA_CLEANUP == true ]] && rm -f $OS_USER_DATA_TMP_FILE
-	[[ $OS_META_DATA_CLEANUP == true ]] && rm -f $OS_META_DATA_TMP_FILE
+	[[ $OS_USER_DATA_CLEANUP == true ]] && rm -f $OS_USER_DATA_TMP_FILE $OS_USER_DATA_VARS_FILE
+	[[ $OS_META_DATA_CLEANUP == true ]] && rm -f $OS_META_DATA_TMP_FILE $OS_METADATA_URL_FILE
 }
 
-# Check if the URL is available
-# arg1: url of metadata service to test
+# Copy a JSON file, removing newlines and repeated whitespace from it to
+# appease the Perl JSON module
+# arg1: source file
+# arg2: destination file, only readable by root
+function copy_json_data() {
+    tr -d '\n' < $1 | tr -d '\r' | tr -s ' ' > $2
+    chmod 0600 $2
+}
+
+# Find the first of several metadata service URLs that answers.  Each round
+# probes all of them at once, so a missing service costs one short timeout
+# per round instead of one per URL.
+# args: urls, most preferred first
+# output: url that answered, nothing on failure
 # return:
 # 0 -- success
-#
-function test_metadata_service() {
+function probe_metadata_services() {
     local retries=${OS_USER_DATA_RETRIES}
-    local url=$1
-    local retval=1
+    local url
+    local probe_dir=$(mktemp -d)
 
     while (( retries > 0 ))
     do
-	response_code=$(curl -s --head --output /dev/null -w "%{http_code}\n" $url)
-	if [[ ${response_code} == "200" ]]; then
-	    retval=0
-	    break;
-	fi
+	for url in "$@"; do
+	    curl -s --head --output /dev/null -w "%{http_code}\n" \
+		-m $OS_METADATA_PROBE_TIMEOUT "${url}/latest/meta-data" \
+		> $probe_dir/${url//[^A-Za-z0-9]/_} &
+	done
+	wait
+	for url in "$@"; do
+	    if [[ $(cat $probe_dir/${url//[^A-Za-z0-9]/_}) == "200" ]]; then
+		rm -rf $probe_dir
+		echo $url
+		return 0
+	    fi
+	done
 	sleep 1
 	(( retries-- ))
     done
-    return ${retval}
+    rm -rf $probe_dir
+    return 1
 }
 
-# Get the URL of a meta data service that provides user data
-# using the default EC2 datasouce:http://169.254.169.254/latest/user_data
-# If that fails, try the dhcp server as a possible srouce.
+# Get the URL of a meta data service that provides user data.  The default
+# EC2 datasource, http://169.254.169.254, and the dhcp server are probed at
+# the same time; the EC2 datasource is preferred when both answer.  The
+# result is cached in $OS_METADATA_URL_FILE so later phases do not probe
+# again.
 # args -- none
 # return:
 # url of user_data -- success
 # "" --failure
 function get_metadata_service_url() {
+    if [[ -f $OS_METADATA_URL_FILE ]]; then
+	cat $OS_METADATA_URL_FILE
+	return
+    fi
 
     # EC2 datasource location
-    local metadata_url="http://169.254.169.254"
-
-    test_metadata_service "${metadata_url}/latest/meta-data"
-    if [[ $? != 0 ]]; then
-	dhcp_server_address=$(get_dhcp_server_address)
-	log "Metadata server at ${metadata_url} is not available, trying ${dhcp_server_address} instead..."
-	metadata_url="http://${dhcp_server_address}"
-	test_metadata_service "${metadata_url}/latest/meta-data"
-	if [[ $? != 0 ]]; then
-	    log "Could not locate a viable metadata server, setting default policy..."
-	    metadata_url=""
-	fi
+    local metadata_urls="http://169.254.169.254"
+    local dhcp_server_address=$(get_dhcp_server_address)
+    if [[ -n $dhcp_server_address ]]; then
+	metadata_urls="$metadata_urls http://${dhcp_server_address}"
     fi
 
+    local metadata_url=$(probe_metadata_services $metadata_urls)
+    if [[ -n $metadata_url ]]; then
+	log "Found metadata server at ${metadata_url}..."
+    else
+	log "Could not locate a viable metadata server at ${metadata_urls}..."
+    fi
+
+    echo $metadata_url > $OS_METADATA_URL_FILE.tmp
+    mv -f $OS_METADATA_URL_FILE.tmp $OS_METADATA_URL_FILE
     echo $metadata_url
 }
 
-# Retrieve the user data from the metadata service using the passed in URL; otherwise
-# try to find the the metadata service at well-known IP's
-# args -- url of metadata service
+# Retrieve the user data, and the OpenStack meta data if available, from
+# the metadata service using the passed in URL; otherwise try to find the
+# the metadata service at well-known IP's
+# arg1: url of metadata service (optional)
+# arg2: directory to write the data to, $OS_CONFIG_DIR by default
 # return:
 # 0 -- success
 # 1 -- failure
 function get_metadata_service_userdata() {
-    if [[ $1 == "" ]]; then
-	metadata_url=$(get_metadata_service_url)
-    else
-	metadata_url=$1
+    local metadata_url=${1:-$(get_metadata_service_url)}
+    local data_dir=${2:-$OS_CONFIG_DIR}
+    local user_data_file=$data_dir/$(basename $OS_USER_DATA_TMP_FILE)
+    local meta_data_file=$data_dir/$(basename $OS_META_DATA_TMP_FILE)
+
+    if [[ -z $metadata_url ]]; then
+	log "No metadata service to retrieve user-data from..."
+	return 1
     fi
 
     log "Retrieving user-data from $metadata_url..."
@@ -172,20 +275,26 @@ function get_metadata_service_userdata() {
     curl -s -f --retry $OS_USER_DATA_RETRIES --retry-delay \
 	$OS_USER_DATA_RETRY_INTERVAL --retry-max-time $OS_USER_DATA_RETRY_MAX_TIME \
 	-m 10 \
-	-o $OS_USER_DATA_TMP_FILE "${metadata_url}/latest/user-data"
+	-o $user_data_file.raw "${metadata_url}/latest/user-data"
 
     if [[ $? == 0 ]]; then
-	# remove newlines and repeated whitespace from JSON to appease Perl JSON module
-	user_data=$(cat $OS_USER_DATA_TMP_FILE)
-	echo "$user_data" | tr -d '\n' | tr -d '\r' | tr -s ' ' > $OS_USER_DATA_TMP_FILE
-
-	chmod 0600 $OS_USER_DATA_TMP_FILE
+	copy_json_data $user_data_file.raw $user_data_file
+	rm -f $user_data_file.raw
 	log "Successfully retrieved user-data from instance metadata service..."
     else
+	rm -f $user_data_file.raw
 	log "Could not retrieve user-data after $OS_USER_DATA_RETRIES attempts, trying local policy..."
 	return 1
     fi
 
+    # The OpenStack meta data holds the SSH keys; saving it spares the
+    # SSH key phase another request.
+    if curl -s -f -m 10 -o $meta_data_file.raw \
+	"${metadata_url}/openstack/latest/meta_data.json"; then
+	copy_json_data $meta_data_file.raw $meta_data_file
+    fi
+    rm -f $meta_data_file.raw
+
     return 0
 }
 
@@ -199,58 +308,33 @@ function get_local_userdata() {
 
 	log "Found locally installed $OS_USER_DATA_LOCAL_FILE. Using local file for user data."
 
-	# remove newlines and repeated whitespace from JSON to appease Perl JSON module
-	cat $OS_USER_DATA_LOCAL_FILE | tr -d '\n' | tr -d '\r' | tr -s ' ' \
-	    > $OS_USER_DATA_TMP_FILE
-	chmod 0600 $OS_USER_DATA_TMP_FILE
+	copy_json_data $OS_USER_DATA_LOCAL_FILE $OS_USER_DATA_TMP_FILE
+
+	# Use the userdata compiled when the image was prepared, unless the
+	# JSON file changed since.
+	local md5=$(md5sum < $OS_USER_DATA_LOCAL_FILE | cut -d ' ' -f 1)
+	if grep -q "^OS_USER_DATA_SOURCE_MD5='$md5'$" $OS_USER_DATA_LOCAL_VARS_FILE 2> /dev/null; then
+	    log "Using user data compiled into $OS_USER_DATA_LOCAL_VARS_FILE."
+	    /bin/cp -f $OS_USER_DATA_LOCAL_VARS_FILE $OS_USER_DATA_VARS_FILE
+	    chmod 0600 $OS_USER_DATA_VARS_FILE
+	fi
 	return 0
     fi
     return 1
 }
 
-# This logic is taken from clound init.  To find a config drive:
-# 1. Try the device with label "config-2", this should be sufficient.
-# 2. If no device with config-2 label is found:
-#    a) try all iso9660 type block devices in reverse order
-#    b) try all vfat type block devices in reverse order
-#    c) try /dev/hdd if it exists as a block device
-# 3. For each device, make sure that it is not a disk partition.  The
-#    device should only be an unpartitioned disk.
+# Nova labels its config drives "config-2", or "CONFIG-2" when they are
+# vfat.  Only labelled devices are candidates, so finding a config drive
+# never waits on trial mounts of unrelated iso9660 or vfat devices.  The
+# blkid cache is bypassed, it may not know about the config drive yet.
 function get_candidate_config_drives() {
-    populate_cache=$(blkid /dev/hd* /dev/sr*)
-    config2_dev=$(blkid -t LABEL="config-2" -o device)
-    iso9660_devs=$(blkid -t TYPE="iso9660" -o device | sort -r)
-    vfat_devs=$(blkid -t TYPE="vfat" -o device | sort -r)
-
-    # If /dev/hdd exists, add it as a possible config drive too.
-    ide_dev=""
-    if [[ -b /dev/hdd ]]; then
-	ide_dev="/dev/hdd"
-    fi
-
-    devs_bytype=""
-    for dev in "$iso9660_devs $vfat_devs $ide_dev"
-    do
-	# If this device is a partion skip it
-	sfdisk -lq ${dev} >/dev/null 2>&1
-	if [[ $? == 0 ]]; then
-	    # Append to the list since this is not a partition of a blk device
-	    devs_bytype=${devs_bytype:+$devs_bytype }$dev
-	fi
-    done
-
-    if [[ ${config2_dev} != "" ]]; then
-	candidate_devs=$(tr ' ' '\n' <<<"${config2_dev} ${devs_bytype}" | uniq)
-    else
-	candidate_devs=$(tr ' ' '\n' <<<"${devs_bytype}" | uniq)
-    fi
-
-    echo $candidate_devs
+    echo $( (blkid -c /dev/null -t LABEL="config-2" -o device
+	     blkid -c /dev/null -t LABEL="CONFIG-2" -o device) | sort | uniq)
 }
 
-# Retrieve the user data from the config drive if present.  First, look for
-# a block device with label "config-2".  If not available, just try the default
-# "/dev/hdd".
+# Retrieve the user data from the config drive if present, a block device
+# with label "config-2".
+# arg1: directory to write the data to, $OS_CONFIG_DIR by default
 # return:
 # 0 -- success
 # 1 -- failure
@@ -259,14 +343,19 @@ function get_config_drive_data() {
     local OS_CONFIG_DRIVE_MOUNT_POINT="/config/OPENSTACK_CONFIG_DRIVE"
     local OS_CONFIG_DRIVE_META_DATA_FILE="/openstack/latest/meta_data.json"
     local OS_CONFIG_DRIVE_USER_DATA_FILE="/openstack/latest/user_data"
+    local data_dir=${1:-$OS_CONFIG_DIR}
 
     log "Retrieving user-data from config drive..."
     local config_drive=""
 
-    mkdir -p ${OS_CONFIG_DRIVE_MOUNT_POINT}
-
     # For each device in the config drive candidates list, look for the "openstack" directory.
     local config_drives=$(get_candidate_config_drives)
+    if [[ -z ${config_drives} ]]; then
+	log "No config drive found"
+	return 1
+    fi
+
+    mkdir -p ${OS_CONFIG_DRIVE_MOUNT_POINT}
     for dev in ${config_drives}
     do
 	log "Trying ${dev} as a config drive"
@@ -288,32 +377,22 @@ function get_config_drive_data() {
     if [[ ${config_drive} != "" ]]; then
 	log "Found openstack config drive $config_drive"
 	if [[ -f ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_META_DATA_FILE} ]]; then
-
-            /bin/cp -f ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_META_DATA_FILE} $OS_META_DATA_TMP_FILE
-
-	    # remove newlines and repeated whitespace from JSON to appease Perl JSON module
-            meta_data=$(cat $OS_META_DATA_TMP_FILE)
-            echo "$meta_data" | tr -d '\n' | tr -d '\r' | tr -s ' ' > $OS_META_DATA_TMP_FILE
-            chmod 0600 $OS_META_DATA_TMP_FILE
-        fi
-        if [[ -f ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_USER_DATA_FILE} ]]; then
-
-            /bin/cp -f ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_USER_DATA_FILE} $OS_USER_DATA_TMP_FILE
-
-            # remove newlines and repeated whitespace from JSON to appease Perl JSON module
-            user_data=$(cat $OS_USER_DATA_TMP_FILE)
-            echo "$user_data" | tr -d '\n' | tr -d '\r' | tr -s ' ' > $OS_USER_DATA_TMP_FILE
-            chmod 0600 $OS_USER_DATA_TMP_FILE
-        fi
+	    copy_json_data ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_META_DATA_FILE} \
+		$data_dir/$(basename $OS_META_DATA_TMP_FILE)
+	fi
+	if [[ -f ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_USER_DATA_FILE} ]]; then
+	    copy_json_data ${OS_CONFIG_DRIVE_MOUNT_POINT}${OS_CONFIG_DRIVE_USER_DATA_FILE} \
+		$data_dir/$(basename $OS_USER_DATA_TMP_FILE)
+	fi
 
 	# We are done, clean up and return success.
-        umount $OS_CONFIG_DRIVE_MOUNT_POINT
+	umount $OS_CONFIG_DRIVE_MOUNT_POINT
 	if [[ $? != 0 ]]; then
 	    log "ERROR: failed to unmount config drive on $OS_CONFIG_DRIVE_MOUNT_POINT"
 	fi
 
-        rmdir $OS_CONFIG_DRIVE_MOUNT_POINT 2>&1 | $LOGGER_CMD
-        return 0
+	rmdir $OS_CONFIG_DRIVE_MOUNT_POINT 2>&1 | $LOGGER_CMD
+	return 0
     else
 	log "No config drive found"
 	rmdir $OS_CONFIG_DRIVE_MOUNT_POINT 2>&1 | $LOGGER_CMD
@@ -321,6 +400,21 @@ function get_config_drive_data() {
     fi
 }
 
+# Move the data one source left in its probe directory into
+# $OS_CONFIG_DIR.
+# arg1: probe directory of the source
+# arg2: data file, $OS_USER_DATA_TMP_FILE or $OS_META_DATA_TMP_FILE
+# return:
+# 0 -- the source had that data
+function use_probed_data() {
+    local probed_file=$1/$(basename $2)
+    if [[ -s $probed_file ]]; then
+	mv -f $probed_file $2
+	return 0
+    fi
+    return 1
+}
+
 # Try to find user data from all data sources.  If successful, return
 # 0, else return 1.
 function get_user_data() {
@@ -330,26 +424,56 @@ function get_user_data() {
     # Just remove any previous files
     rm -f $OS_META_DATA_TMP_FILE
     rm -f $OS_USER_DATA_TMP_FILE
+    rm -f $OS_USER_DATA_VARS_FILE
+    rm -f $OS_METADATA_URL_FILE
+    rm -rf $OS_DATASOURCE_PROBE_DIR
 
     # If there is user data in the /config directory, use that.
     get_local_userdata
     if [[ $? == 0 ]]; then
+	load_user_data_values
 	return 0
     fi
 
-    # Next, attempt to retrieve user data from config drive
-    get_config_drive_data
-    if [[ $? == 0 ]]; then
-	return 0
+    # Next, probe the config drive and the OpenStack metadata service at
+    # the same time.  The config drive takes priority; the metadata
+    # service is only waited for when the config drive has no user data.
+    local config_drive_dir=$OS_DATASOURCE_PROBE_DIR/config-drive
+    local metadata_service_dir=$OS_DATASOURCE_PROBE_DIR/metadata-service
+    mkdir -p -m 0700 $config_drive_dir $metadata_service_dir
+
+    # Job control puts each probe into a process group of its own, so it
+    # can be stopped together with its curl processes.
+    set -m
+    get_config_drive_data $config_drive_dir &
+    local config_drive_pid=$!
+    get_metadata_service_userdata "" $metadata_service_dir &
+    local metadata_service_pid=$!
+    set +m
+
+    wait $config_drive_pid
+    local user_data_dir=$config_drive_dir
+    if [[ -s $config_drive_dir/$(basename $OS_USER_DATA_TMP_FILE) ]]; then
+	log "Using user-data from config drive..."
+	kill -TERM -- -$metadata_service_pid 2> /dev/null
+	wait $metadata_service_pid
+    else
+	wait $metadata_service_pid
+	user_data_dir=$metadata_service_dir
     fi
 
-    # Next, look for user data from the OpenStack metadata service
-    get_metadata_service_userdata
-    if [[ $? == 0 ]]; then
-	return 0
-    fi
+    # The meta data of the config drive is kept even when the user data
+    # came from the metadata service.
+    use_probed_data $config_drive_dir $OS_META_DATA_TMP_FILE || \
+	use_probed_data $metadata_service_dir $OS_META_DATA_TMP_FILE
+    use_probed_data $user_data_dir $OS_USER_DATA_TMP_FILE
+    local retval=$?
+    rm -rf $OS_DATASOURCE_PROBE_DIR
 
-    return 1
+    if [[ $retval == 0 ]]; then
+	load_user_data_values
+    fi
+    return $retval
 }
 
 function execute_system_cmd() {
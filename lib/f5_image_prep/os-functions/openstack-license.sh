@@ -117,20 +117,33 @@ function get_licensed_modules() {
     fi
 }
 
+# return the current provisioning level of every module, e.g. "ltm:nominal asm:none"
+function get_provisioned_levels() {
+    echo -n $(tmsh list sys provision one-line | awk '/^sys/ {
+	level = "none"
+	for (i = 4; i < NF; i++) if ($i == "level") level = $(i + 1)
+	print $3 ":" level
+    }')
+}
+
 # provision BIG-IP software modules
 function provision_modules() {
     # get list of licensed modules
     local licensed_modules=$(get_licensed_modules)
-    local provisionable_modules=$(get_supported_modules)
+    local provisioned_levels=" $(get_provisioned_levels) "
 
     # if auto-provisioning enabled, obtained enabled modules list from license file
     local auto_provision=$(get_user_data_value {bigip}{modules}{auto_provision})
     [[ $BIGIP_AUTO_PROVISIONING_ENABLED == false ]] && auto_provision=false
 
+    # collect the level of every module first, then reprovision once
+    local module level
+    local modules=""
+    local cmds=()
     for module in $licensed_modules; do
 	level=$(get_user_data_value {bigip}{modules}{$module})
 
-	if [[ "$provisionable_modules" == *"$module"* ]]; then
+	if [[ "$provisioned_levels" == *" $module:"* ]]; then
 	    if [[ ! $level =~ $LEVEL_REGEX ]]; then
 		if [[ $auto_provision == true ]]; then
 		    level=nominal
@@ -139,15 +152,39 @@ function provision_modules() {
 		fi
 	    fi
 
-	    tmsh modify sys provision $module level $level &> /dev/null
-
-	    if [[ $? == 0 ]]; then
-		log "Successfully provisioned $(upcase "$module") with level $level..."
+	    if [[ "$provisioned_levels" == *" $module:$level "* ]]; then
+		log "$(upcase "$module") is already provisioned with level $level..."
 	    else
-		log "Failed to provision $(upcase "$module"), examine /var/log/ltm for more information..."
+		modules="$modules $module:$level"
+		cmds[${#cmds[@]}]="modify sys provision $module level $level"
 	    fi
 	fi
     done
+
+    [[ ${#cmds[@]} == 0 ]] && return 0
+
+    log "Provisioning${modules//:/ at } in one transaction..."
+    if submit_tmsh_transaction "${cmds[@]}"; then
+	for module in $modules; do
+	    log "Successfully provisioned $(upcase "${module%:*}") with level ${module#*:}..."
+	done
+	return 0
+    fi
+
+    # the transaction is all or nothing; provision the modules one by one so
+    # one that cannot be provisioned does not hold back the others
+    log "Failed to provision modules in one transaction, provisioning them one by one..."
+    for module in $modules; do
+	level=${module#*:}
+	module=${module%:*}
+	tmsh modify sys provision $module level $level &> /dev/null
+
+	if [[ $? == 0 ]]; then
+	    log "Successfully provisioned $(upcase "$module") with level $level..."
+	else
+	    log "Failed to provision $(upcase "$module"), examine /var/log/ltm for more information..."
+	fi
+    done
 }
 
 function test() {
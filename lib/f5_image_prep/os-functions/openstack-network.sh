@@ -22,6 +22,7 @@ readonly OS_MGMT_LEASE_FILE="/var/lib/dhclient/dhclient.leases"
 readonly OS_MGMT_MTU=1400
 readonly OS_DHCP_ENABLED=true
 readonly OS_DHCP_LEASE_FILE="/tmp/openstack-dhcp.leases"
+readonly OS_DHCP_PID_FILE="/var/run/openstack-dhclient.pid"
 readonly OS_DHCP_REQ_TIMEOUT=30
 readonly OS_VLAN_PREFIX="openstack-network-"
 readonly OS_VLAN_DESCRIPTION="auto-added by openstack-init"
@@ -39,6 +40,9 @@ readonly TMM_IF_REGEX='^1\.[0-9]$'
 readonly IP_REGEX='^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$'
 readonly SELFIP_ALLOW_SERVICE_REGEX='^(all|default|none)$'
 
+# tmsh commands queued by queue_tmsh_cmd, applied together by apply_tmsh_cmds
+OS_TMSH_CMDS=()
+
 function get_bigip_version () {
     # query and slices to obtain the initial chars
     # in a BIGIP version string, e.g. 12 from BIGIP 12.1.x
@@ -67,6 +71,36 @@ function get_dns_suffix() {
     echo -n $(/bin/grep search /etc/resolv.conf | awk '{print $2}')
 }
 
+# queue a tmsh command, without the leading "tmsh"
+function queue_tmsh_cmd() {
+    log "  tmsh $1"
+    OS_TMSH_CMDS[${#OS_TMSH_CMDS[@]}]="$1"
+}
+
+# apply the queued tmsh commands in one transaction.  A transaction is all
+# or nothing; if it fails, the commands are run one by one instead, so one
+# that fails does not hold back the others.
+function apply_tmsh_cmds() {
+    (( ${#OS_TMSH_CMDS[@]} == 0 )) && return 0
+
+    log "Applying ${#OS_TMSH_CMDS[@]} network settings in one transaction..."
+    if ! submit_tmsh_transaction "${OS_TMSH_CMDS[@]}"; then
+	log "Failed to apply network settings in one transaction, applying them one by one..."
+	local cmd
+	for cmd in "${OS_TMSH_CMDS[@]}"; do
+	    eval "tmsh $cmd 2>&1 | $LOGGER_CMD"
+	done
+    fi
+    OS_TMSH_CMDS=()
+}
+
+# name of the local device, looked up once
+function get_local_device_name() {
+    if [[ $(is_false ${local_device_name}) ]]; then
+	local_device_name=`tmsh show /cm device all field-fmt|grep "cm device"|awk 'NR<2{print $3}'`
+    fi
+}
+
 function set_tmm_if_selfip() {
     local tmm_if=$1
     local address=$2
@@ -108,57 +142,33 @@ function set_tmm_if_selfip() {
 	fi
 
 	if [ -n "$mtu" ]; then
-	    vlan_mtu_cmd="tmsh modify net vlan $vlan_name { mtu $mtu }"
-	    log "  $vlan_mtu_cmd"
-	    eval "$vlan_mtu_cmd 2>&1 | $LOGGER_CMD"
+	    queue_tmsh_cmd "modify net vlan $vlan_name { mtu $mtu }"
 	fi
 
-	selfip_cmd="tmsh create net self $selfip_name address $address/$netmask allow-service $selfip_allow_service vlan $vlan_name description \"$selfip_description\""
-	log "  $selfip_cmd"
-	eval "$selfip_cmd 2>&1 | $LOGGER_CMD"
+	queue_tmsh_cmd "create net self $selfip_name address $address/$netmask allow-service $selfip_allow_service vlan $vlan_name description \"$selfip_description\""
 
 	if [[ $device_is_sync == true ]]; then
 	    log "Configuring self IP $selfip_name as the device config sync interface"
-	    if [[ $(is_false  ${local_device_name}) ]]; then
-		local_device_name=`tmsh show /cm device all field-fmt|grep "cm device"|awk 'NR<2{print $3}'`
-	    fi
-	    tmsh modify /cm device ${local_device_name} { configsync-ip ${address} }
+	    get_local_device_name
+	    queue_tmsh_cmd "modify /cm device ${local_device_name} { configsync-ip ${address} }"
 	fi
 
 	if [[ ${device_is_failover} == true ]]; then
+	    # configure_tmm_ifs sets every address as a unicast failover address
 	    log "Configuring self IP $selfip_name as a device unicast failover interface"
-	    if [[ $(is_false ${local_device_name}) ]]; then
-		local_device_name=`tmsh show /cm device all field-fmt|grep "cm device"|awk 'NR<2{print $3}'`
-	    fi
-	    if [[ $(is_false ${unicast_failover_addresses}) ]]; then
-		unicast_failover_address=($address)
-		tmsh modify /cm device ${local_device_name} unicast-address \
-		    { { effective-ip ${address} effective-port 1026 ip ${address} } }
-	    else
-		unicast_failover_addresses+=($address)
-		ua_list="{"
-		for i in ${unicast_failover_addresses[@]}; do
-		    ua_list="$ua_list { effective-ip ${i} effective-port 1026 ip ${i} }";
-		done
-		ua_list="${ua_list} }"
-		tmsh modify /cm device ${local_device_name} unicast-address ${ua_list}
-	    fi
+	    unicast_failover_addresses[${#unicast_failover_addresses[@]}]=$address
 	fi
 
 	if [[ ${device_is_mirror_primary} == true ]]; then
 	    log "Configuring self IP $selfip_name as the device primary mirroring interface"
-	    if [[ $(is_false ${local_device_name}) ]]; then
-		local_device_name=`tmsh show /cm device all field-fmt|grep "cm device"|awk 'NR<2{print $3}'`
-	    fi
-	    tmsh modify /cm device ${local_device_name} mirror-ip ${address}
+	    get_local_device_name
+	    queue_tmsh_cmd "modify /cm device ${local_device_name} mirror-ip ${address}"
 	fi
 
 	if [[ ${device_is_mirror_secondary} == true ]]; then
 	    log "Configuring self IP $selfip_name as the device secondary mirroring interface"
-	    if [[ $(is_false ${local_device_name}) ]]; then
-		local_device_name=`tmsh show /cm device all field-fmt|grep "cm device"|awk 'NR<2{print $3}'`
-	    fi
-	    tmsh modify /cm device ${local_device_name} mirror-secondary-ip ${address}
+	    get_local_device_name
+	    queue_tmsh_cmd "modify /cm device ${local_device_name} mirror-secondary-ip ${address}"
 	fi
 
     fi
@@ -192,15 +202,18 @@ function set_tmm_if_vlan() {
 	    log "Configuring VLAN $vlan_name on interface $tmm_if..."
 	fi
 
-	vlan_cmd="tmsh create net vlan $vlan_name interfaces add { $tmm_if $tagged_cmd}$vlan_tag_cmd description \"$vlan_description\" mtu $mtu"
-
-	log "  $vlan_cmd"
-	eval "$vlan_cmd 2>&1 | $LOGGER_CMD"
+	queue_tmsh_cmd "create net vlan $vlan_name interfaces add { $tmm_if $tagged_cmd}$vlan_tag_cmd description \"$vlan_description\" mtu $mtu"
     fi
 }
 
+# Request a DHCP lease on a TMM interface.  Every interface has a lease and
+# pid file of its own, so several requests can run at the same time.
+# arg1: interface, e.g. eth1
+# output: interface, address, netmask and MTU offered, e.g. "1.1 10.0.0.5 255.255.255.0 1450"
 function dhcp_tmm_if() {
-    [[ -f $OS_DHCP_LEASE_FILE ]] && rm -f $OS_DHCP_LEASE_FILE
+    local lease_file="${OS_DHCP_LEASE_FILE%.leases}-$1.leases"
+    local pid_file="${OS_DHCP_PID_FILE%.pid}-$1.pid"
+    rm -f $lease_file $pid_file
 
     log "Issuing DHCP request on interface 1.${1:3}..."
     to_arg="-T"
@@ -209,13 +222,15 @@ function dhcp_tmm_if() {
     then
 	to_arg="-timeout"
     fi
-    dhclient_cmd="dhclient -lf $OS_DHCP_LEASE_FILE -cf /dev/null -1 $to_arg \
+    dhclient_cmd="dhclient -lf $lease_file -pf $pid_file -cf /dev/null -1 $to_arg \
     $OS_DHCP_REQ_TIMEOUT -sf /bin/echo -R \
     subnet-mask,broadcast-address,interface-mtu,routers $1"
     eval "$dhclient_cmd 2>&1 | sed -e '/^$/d' -e 's/^/  /' | $LOGGER_CMD"
-    pkill dhclient
+    # stop only the dhclient holding this lease, the others are still running
+    [[ -s $pid_file ]] && kill $(cat $pid_file) &> /dev/null
+    rm -f $pid_file
 
-    if [[ -f $OS_DHCP_LEASE_FILE ]]; then
+    if [[ -f $lease_file ]]; then
 	dhcp_offer=`awk 'BEGIN {
     FS="\n"
     RS="}"
@@ -247,14 +262,17 @@ function dhcp_tmm_if() {
       }
 
       print interface " " address " " netmask " " interface_mtu
-    }' $OS_DHCP_LEASE_FILE`
+    }' $lease_file`
 
-    rm -f $OS_DHCP_LEASE_FILE
+    rm -f $lease_file
 
     echo $dhcp_offer
   fi
 }
 
+# Configure VLANs and self IPs on the TMM interfaces in two stages: first
+# DHCP leases are requested on all interfaces at the same time, then every
+# VLAN, self IP and global route is created in one tmsh transaction.
 function configure_tmm_ifs() {
     local tmm_ifs=$(ip link show | egrep '^[0-9]+: eth[1-9]' | cut -d ' ' -f2 |
 	tr -d  ':')
@@ -275,52 +293,85 @@ function configure_tmm_ifs() {
     [[ ${dhcp_enabled_global} == false ]] &&
     log "DHCP disabled globally, will not auto-configure any interfaces..."
 
+    local vlans=$(tmsh list net vlan one-line)
+    local selfips=$(tmsh list net self one-line)
+    local offers_dir=$(mktemp -d)
+    local interface tmm_if dhcp_enabled vlan_name
+    local dhcp_pids=()
+    local selfip_ifs=""
+    unicast_failover_addresses=()
+
+    # discovery: request DHCP leases for all interfaces without a self IP at once
     for interface in ${tmm_ifs}; do
-	local tmm_if="1.${interface:3}"
-	local dhcp_enabled=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{dhcp})
+	tmm_if="1.${interface:3}"
+	dhcp_enabled=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{dhcp})
+	vlan_name=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{vlan_name})
+	[[ $(is_false $vlan_name) ]] && vlan_name="${vlan_prefix}${tmm_if}"
 
-		# setup VLAN
-	tmsh list net vlan one-line | grep -q "interfaces { .*$1\.${interface:3}.* }"
+	if echo "$selfips" | grep -q "vlan $vlan_name"; then
+	    log "Self IP already configured for interface $tmm_if, skipping..."
+	    continue
+	fi
+	selfip_ifs="$selfip_ifs $interface"
+
+	if [[ $dhcp_enabled_global != false && $dhcp_enabled != false ]]; then
+	    dhcp_tmm_if $interface > $offers_dir/$interface &
+	    dhcp_pids[${#dhcp_pids[@]}]=$!
+	fi
+    done
+    local pid
+    for pid in ${dhcp_pids[@]}; do
+	wait $pid
+    done
+
+    # apply: queue all settings, then create them in one transaction
+    for interface in ${tmm_ifs}; do
+	tmm_if="1.${interface:3}"
 
-	if [[ $? != 0 ]]; then
+	# setup VLAN
+	if ! echo "$vlans" | grep -q "interfaces { .*1\.${interface:3}.* }"; then
 	    log "Setup VLAN on interface $tmm_if..."
 	    set_tmm_if_vlan $tmm_if
 	else
 	    log "VLAN already configured on interface $tmm_if, skipping..."
 	fi
 
-		# setup self-IP
-	vlan_name=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{vlan_name})
-	[[ $(is_false $vlan_name) ]] && vlan_name="${vlan_prefix}${tmm_if}"
-	tmsh list net self one-line | grep -q "vlan $vlan_name"
-
-	if [[ $? != 0 ]]; then
+	# setup self-IP
+	[[ " $selfip_ifs " == *" $interface "* ]] || continue
+	log "Configuring self IP for interface $tmm_if..."
 
-	    log "Configuring self IP for interface $tmm_if..."
-
-	    if [[ $dhcp_enabled_global == false || $dhcp_enabled == false ]]; then
-				# DHCP is disabled, look for static address and configure it
-		address=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{address})
-		netmask=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{netmask})
+	if [[ -f $offers_dir/$interface ]]; then
+	    set_tmm_if_selfip $(cat $offers_dir/$interface)
+	else
+	    # DHCP is disabled, look for static address and configure it
+	    address=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{address})
+	    netmask=$(get_user_data_value {bigip}{network}{interfaces}{$tmm_if}{netmask})
 
-		if [[ -n $address && -n $netmask ]]; then
-		    set_tmm_if_selfip $tmm_if $address $netmask
-		else
-		    log "DHCP is disabled and no static address could be located for $tmm_if, skipping..."
-		fi
+	    if [[ -n $address && -n $netmask ]]; then
+		set_tmm_if_selfip $tmm_if $address $netmask
 	    else
-		set_tmm_if_selfip $(dhcp_tmm_if $interface)
-		sleep 2
+		log "DHCP is disabled and no static address could be located for $tmm_if, skipping..."
 	    fi
-	else
-	    log "Self IP already configured for interface $tmm_if, skipping..."
 	fi
     done
+    rm -rf $offers_dir
+
+    if (( ${#unicast_failover_addresses[@]} > 0 )); then
+	local ua_list="{" address
+	for address in ${unicast_failover_addresses[@]}; do
+	    ua_list="$ua_list { effective-ip ${address} effective-port 1026 ip ${address} }"
+	done
+	get_local_device_name
+	queue_tmsh_cmd "modify /cm device ${local_device_name} unicast-address ${ua_list} }"
+    fi
+
+    configure_global_routes
 
 	# restart DHCP for management interface
 	#log "Restarting DHCP client for management interface..."
 	#service dhclient restart &> /dev/null
-    tmsh modify sys db dhclient.mgmt { value disable }
+    queue_tmsh_cmd "modify sys db dhclient.mgmt { value disable }"
+    apply_tmsh_cmds
     log "Saving after configuring interfaces"
     tmsh save sys config | eval $LOGGER_CMD
 }
@@ -359,13 +410,14 @@ function force_mgmt_mtu() {
 	    fi
 }
 
+# queue the global routes, configure_tmm_ifs creates them with the self IPs
 function configure_global_routes() {
     local routes=$(get_user_data_network_routes)
     for route in $(echo $routes | tr "|" "\n"); do
 	re=($(echo $route | tr ";" "\n"));
 	if [[ ! $(is_false ${re[1]}) ]]; then
 	    log "Adding global route destination ${re[0]} gateway ${re[1]}..."
-	    tmsh create /net route ${re[0]} gw ${re[1]}
+	    queue_tmsh_cmd "create /net route ${re[0]} gw ${re[1]}"
 	fi
     done
 }
@@ -31,6 +31,8 @@ function get_meta_data_public_key() {
 	echo -n $(perl -MJSON -ne "\$data = decode_json(\$_); print(values(%{\$data->{public_keys}}));" $metadata_file)
 }
 
+# arg1: url of the metadata service, looked up only if needed when empty
+# arg2: meta data file with the public keys, used instead if it exists
 function inject_openssh_key() {
 
     local metadata_url=$1
@@ -58,6 +60,7 @@ function inject_openssh_key() {
 		fi
 	    fi
 	else
+	    [[ -z $metadata_url ]] && metadata_url=$(get_metadata_service_url)
 	    log "Retrieving SSH public key from ${metadata_url}${OS_SSH_KEY_PATH}..."
 	    curl -s -f --retry $OS_SSH_KEY_RETRIES --retry-delay \
 		$OS_SSH_KEY_RETRY_INTERVAL --retry-max-time \
@@ -0,0 +1,246 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmark auth, lookups and uploads against local OpenStack stand-ins.
+
+Run from the top of the repository:
+
+    python -m test.benchmark.bench --sizes 16 64 256 --latency 20
+
+Keystone and Glance are served in-process by test.benchmark.standins, so
+no cloud is needed.  Every scenario reports latency percentiles or
+throughput, and the peak RSS of the process after it ran.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from f5_image_prep.openstack.client import clear_sessions
+from f5_image_prep.openstack.client import get_session
+from f5_image_prep.openstack.glance import GlanceLib
+from f5_image_prep.openstack.keystone import KeystoneLib
+from f5_image_prep.openstack.openstack import OpenStackCreds
+from f5_image_prep.qcow2 import create
+from f5_image_prep.qcow2 import Qcow2Image
+from f5_image_prep.upload import verify_checksum
+from f5_image_prep.ve_image_sync import VEImageSync
+
+from test.benchmark.standins import Conditions
+from test.benchmark.standins import GlanceStandIn
+from test.benchmark.standins import KeystoneStandIn
+
+
+MIB = 1024 * 1024
+PERCENTILES = (50, 90, 99)
+WRITE_CHUNK = MIB
+
+
+def synthetic_image(path, size, seed=0):
+    '''Create a qcow2 image with size bytes of incompressible data.'''
+
+    create(path, size)
+    block = random.Random(seed).getrandbits(WRITE_CHUNK * 8)
+    block = ('%x' % block).zfill(WRITE_CHUNK * 2)
+    block = bytearray.fromhex(block)
+    with Qcow2Image(path, writable=True) as disk:
+        for offset in range(0, size, WRITE_CHUNK):
+            disk.write(offset, bytes(block[:min(WRITE_CHUNK, size - offset)]))
+        disk.flush()
+    return path
+
+
+def percentiles(samples):
+    '''Nearest-rank percentiles of samples, in milliseconds.'''
+
+    ordered = sorted(samples)
+    result = {}
+    for percentile in PERCENTILES:
+        rank = max(0, int(round(percentile / 100.0 * len(ordered))) - 1)
+        result['p%d_ms' % percentile] = round(ordered[rank] * 1000, 3)
+    return result
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                 1)
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    '''Swallow the progress output of the code under test.'''
+
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = io.BytesIO() if str is bytes else io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+class Benchmark(object):
+    '''Drive f5_image_prep against a Keystone and a Glance stand-in.'''
+
+    def __init__(self, work_dir, conditions, glance_conditions, tenants=200,
+                 images=200, verbose=False):
+        self.work_dir = work_dir
+        self.glance = GlanceStandIn(conditions=glance_conditions).start()
+        self.keystone = KeystoneStandIn(
+            self.glance.url, conditions=conditions).start()
+        self.keystone.add_tenants(tenants)
+        self.glance.add_images(images)
+        self.creds = OpenStackCreds(self.keystone.url + '/v2.0', 'admin',
+                                    'admin', 'secret')
+        self.verbose = verbose
+        self.results = []
+
+    def close(self):
+        self.keystone.stop()
+        self.glance.stop()
+
+    def record(self, scenario, **values):
+        values.update(scenario=scenario, peak_rss_mb=peak_rss_mb())
+        self.results.append(values)
+        return values
+
+    def auth(self, repeat):
+        def authenticate():
+            clear_sessions()
+            get_session(self.creds).token
+
+        samples = timed(authenticate, repeat)
+        return self.record('keystone auth', requests=repeat,
+                           **percentiles(samples))
+
+    def keystone_lookups(self, repeat):
+        lib = KeystoneLib(self.creds)
+        names = ['tenant-%d' % random.randrange(len(self.keystone.tenants) -
+                                                1) for _ in range(repeat)]
+        before = self.keystone.requests
+        samples = timed(lambda: lib.get_tenant(names.pop()), repeat)
+        return self.record('keystone tenant lookup', requests=repeat,
+                           api_calls=self.keystone.requests - before,
+                           **percentiles(samples))
+
+    def glance_lookups(self, repeat, api_version):
+        lib = GlanceLib(self.creds, api_version=api_version)
+        count = len(self.glance.images)
+        before = self.glance.requests
+        samples = timed(lambda: lib.get_image(
+            'image-%d' % random.randrange(count)), repeat)
+        return self.record('glance v%d image lookup' % api_version,
+                           requests=repeat,
+                           api_calls=self.glance.requests - before,
+                           **percentiles(samples))
+
+    def upload(self, size_mb, api_version, retries):
+        path = os.path.join(self.work_dir, 'bench-%dM.qcow2' % size_mb)
+        if not os.path.exists(path):
+            synthetic_image(path, size_mb * MIB)
+        file_size = os.path.getsize(path)
+        image_sync = VEImageSync(
+            self.creds, path, os.devnull, workdir=self.work_dir,
+            patch_engine='inline', glance_api_version=api_version,
+            upload_retries=retries)
+        before = self.glance.requests
+        start = time.time()
+        with quiet(not self.verbose):
+            image = image_sync._upload(path)
+        elapsed = time.time() - start
+        verify_checksum(image, image_sync._file_digest(path, 'md5'))
+        return self.record(
+            'glance v%d upload %d MiB' % (api_version, size_mb),
+            bytes=file_size, seconds=round(elapsed, 3),
+            mb_per_s=round(file_size / float(MIB) / elapsed, 1),
+            api_calls=self.glance.requests - before)
+
+
+def report(results, out=sys.stdout):
+    for result in results:
+        values = ', '.join('%s=%s' % (key, result[key])
+                           for key in sorted(result) if key != 'scenario')
+        out.write('%-32s %s\n' % (result['scenario'], values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64],
+                        help='Synthetic image sizes in MiB.')
+    parser.add_argument('--api-versions', type=int, nargs='+',
+                        default=[1, 2], choices=[1, 2])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds added to every request.')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Upload bandwidth limit in MiB/s.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Share of Glance requests failed with a 503.')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Upload retries, see --upload-retries.')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='Requests per latency scenario.')
+    parser.add_argument('--json', help='Also write the results here.')
+    parser.add_argument('--work-dir', help='Keep synthetic images here.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    conditions = Conditions(latency=args.latency / 1000.0)
+    glance_conditions = Conditions(
+        latency=args.latency / 1000.0,
+        bandwidth=args.bandwidth and int(args.bandwidth * MIB),
+        failure_rate=args.failure_rate)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='f5-image-prep-bench-')
+    benchmark = Benchmark(work_dir, conditions, glance_conditions,
+                          verbose=args.verbose)
+    try:
+        benchmark.auth(args.repeat)
+        benchmark.keystone_lookups(args.repeat)
+        for api_version in args.api_versions:
+            benchmark.glance_lookups(args.repeat, api_version)
+        for size_mb in args.sizes:
+            for api_version in args.api_versions:
+                benchmark.upload(size_mb, api_version, args.retries)
+    finally:
+        benchmark.close()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report(benchmark.results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(benchmark.results, json_file, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process stand-ins for the Keystone v2 and Glance v1/v2 APIs.
+
+Only what f5_image_prep and the python clients it uses actually call is
+served: token requests with a service catalog, tenant, user and role
+listings, and image create, upload, show, list and delete.  Every request
+can be slowed down by a fixed latency, request bodies can be throttled to
+a bandwidth and a share of the image uploads can be failed with a 503.
+"""
+
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlparse
+
+
+READ_CHUNK = 64 * 1024
+TOKEN_LIFETIME = 3600
+
+IMAGE_SCHEMA = {
+    'name': 'image',
+    'properties': {
+        'id': {'type': 'string'},
+        'name': {'type': ['null', 'string']},
+        'status': {'type': 'string'},
+        'visibility': {'type': 'string'},
+        'checksum': {'type': ['null', 'string']},
+        'size': {'type': ['null', 'integer']},
+        'disk_format': {'type': ['null', 'string']},
+        'container_format': {'type': ['null', 'string']},
+        'tags': {'type': 'array', 'items': {'type': 'string'}},
+        'created_at': {'type': 'string'},
+        'updated_at': {'type': 'string'},
+        'self': {'type': 'string'},
+        'file': {'type': 'string'},
+        'schema': {'type': 'string'},
+    },
+    'additionalProperties': {'type': 'string'},
+}
+
+
+class Conditions(object):
+    '''Network conditions applied to every request of a stand-in.'''
+
+    def __init__(self, latency=0.0, bandwidth=None, failure_rate=0.0,
+                 seed=0):
+        '''Initialize a Conditions object.
+
+        :param latency: float -- seconds added to every request
+        :param bandwidth: int -- bytes per second for request bodies
+        :param failure_rate: float -- share of uploads answered with 503
+        '''
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        if not self.failure_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+
+def _now(offset=0):
+    moment = datetime.datetime.utcnow() + datetime.timedelta(seconds=offset)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _fault(code, message):
+    return {'error': {'code': code, 'message': message}}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        # Clients keep connections alive; end them so no handler outlives us.
+        for request in list(self.connections):
+            self.shutdown_request(request)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        '''Read the request body, throttled to the configured bandwidth.'''
+
+        conditions = self.server.standin.conditions
+        chunked = 'chunked' in self.headers.get('Transfer-Encoding', '')
+        remaining = int(self.headers.get('Content-Length') or 0)
+        started = time.time()
+        received = [0]
+
+        def throttle(count):
+            received[0] += count
+            if conditions.bandwidth:
+                ahead = received[0] / float(conditions.bandwidth) - \
+                    (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        def chunks():
+            if chunked:
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if not size:
+                        self.rfile.readline()
+                        return
+                    data = self.rfile.read(size)
+                    self.rfile.readline()
+                    throttle(len(data))
+                    yield data
+            else:
+                left = remaining
+                while left:
+                    data = self.rfile.read(min(READ_CHUNK, left))
+                    if not data:
+                        return
+                    left -= len(data)
+                    throttle(len(data))
+                    yield data
+
+        return chunks()
+
+    def _send(self, status, body=None, headers=None):
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def _dispatch(self):
+        standin = self.server.standin
+        conditions = standin.conditions
+        body = self._read_body()
+        if conditions.latency:
+            time.sleep(conditions.latency)
+        standin.count_request()
+        url = urlparse(self.path)
+        if standin.may_fail(self.command, url.path) and \
+                conditions.should_fail():
+            for _chunk in body:
+                pass
+            return self._send(503, _fault(503, 'Injected failure'))
+        query = dict(parse_qsl(url.query))
+        for method, pattern, func in standin.routes():
+            match = re.match(pattern + '$', url.path)
+            if method == self.command and match:
+                status, response, headers = func(
+                    body, query, self.headers, *match.groups())
+                for _chunk in body:
+                    pass
+                return self._send(status, response, headers)
+        for _chunk in body:
+            pass
+        return self._send(404, _fault(404, 'Not found'))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_PATCH = _dispatch
+
+
+class StandIn(object):
+    '''An HTTP API served on a local port from a background thread.'''
+
+    def __init__(self, conditions=None):
+        self.conditions = conditions or Conditions()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def routes(self):
+        return []
+
+    def may_fail(self, method, path):
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _read_json(body):
+    return json.loads(b''.join(body).decode('utf-8') or '{}')
+
+
+class KeystoneStandIn(StandIn):
+    '''Keystone v2.0: tokens, a service catalog and admin listings.'''
+
+    def __init__(self, glance_url=None, regions=('RegionOne',),
+                 conditions=None):
+        super(KeystoneStandIn, self).__init__(conditions)
+        self.glance_url = glance_url
+        self.regions = regions
+        self.tenants = [{'id': 't-admin', 'name': 'admin', 'enabled': True}]
+        self.users = [{'id': 'u-admin', 'name': 'admin', 'enabled': True,
+                       'tenantId': 't-admin'}]
+        self.roles = [{'id': 'r-member', 'name': '_member_'},
+                      {'id': 'r-admin', 'name': 'admin'}]
+        self.tokens_issued = 0
+
+    def add_tenants(self, count, prefix='tenant'):
+        for number in range(count):
+            self.tenants.append({'id': 't-%s-%d' % (prefix, number),
+                                 'name': '%s-%d' % (prefix, number),
+                                 'enabled': True})
+
+    def routes(self):
+        return [
+            ('POST', r'/v2.0/tokens', self.tokens),
+            ('GET', r'/v2.0/tenants', self.list_resources('tenants')),
+            ('GET', r'/v2.0/users', self.list_resources('users')),
+            ('GET', r'/v2.0/OS-KSADM/roles', self.list_resources('roles')),
+        ]
+
+    def tokens(self, body, query, headers):
+        request = _read_json(body)['auth']
+        tenant_name = request.get('tenantName', 'admin')
+        tenant = [t for t in self.tenants if t['name'] == tenant_name][0]
+        with self._lock:
+            self.tokens_issued += 1
+        identity = self.url + '/v2.0'
+        catalog = [
+            {'type': 'identity', 'name': 'keystone', 'endpoints': [
+                {'region': region, 'publicURL': identity,
+                 'adminURL': identity, 'internalURL': identity}
+                for region in self.regions]},
+        ]
+        if self.glance_url:
+            catalog.append(
+                {'type': 'image', 'name': 'glance', 'endpoints': [
+                    {'region': region, 'publicURL': self.glance_url,
+                     'adminURL': self.glance_url,
+                     'internalURL': self.glance_url}
+                    for region in self.regions]})
+        return 200, {'access': {
+            'token': {'id': uuid.uuid4().hex, 'issued_at': _now(),
+                      'expires': _now(TOKEN_LIFETIME), 'tenant': tenant},
+            'serviceCatalog': catalog,
+            'user': {'id': 'u-admin', 'name': 'admin', 'username': 'admin',
+                     'roles': [{'name': 'admin'}]},
+            'metadata': {'is_admin': 0, 'roles': ['r-admin']},
+        }}, None
+
+    def list_resources(self, kind):
+        def handler(body, query, headers):
+            if 'name' in query:
+                # The v2.0 admin API returns the one resource with the name.
+                for resource in getattr(self, kind):
+                    if resource['name'] == query['name']:
+                        return 200, {kind[:-1]: resource}, None
+                return 404, _fault(404, 'Not found'), None
+            return 200, {kind: list(getattr(self, kind))}, None
+        return handler
+
+
+class GlanceStandIn(StandIn):
+    '''Glance v1 and v2 image APIs, keeping image data as digests only.'''
+
+    def __init__(self, import_methods=(), conditions=None):
+        super(GlanceStandIn, self).__init__(conditions)
+        self.import_methods = list(import_methods)
+        self.images = {}
+        self.bytes_received = 0
+
+    def add_images(self, count, prefix='image'):
+        for number in range(count):
+            self._new_image({'name': '%s-%d' % (prefix, number),
+                             'disk_format': 'qcow2',
+                             'container_format': 'bare'}, status='active')
+
+    def _new_image(self, attrs, status='queued'):
+        image = dict(attrs, id=str(uuid.uuid4()), status=status,
+                     created_at=_now(), updated_at=_now())
+        with self._lock:
+            self.images[image['id']] = image
+        return image
+
+    def _store(self, image, body):
+        md5 = hashlib.md5()
+        size = 0
+        for chunk in body:
+            md5.update(chunk)
+            size += len(chunk)
+        with self._lock:
+            self.bytes_received += size
+        image.update(checksum=md5.hexdigest(), size=size, status='active',
+                     updated_at=_now())
+
+    def routes(self):
+        return [
+            ('POST', r'/v1/images', self.v1_create),
+            ('GET', r'/v1/images/detail', self.v1_list),
+            ('HEAD', r'/v1/images/([^/]+)', self.v1_show),
+            ('DELETE', r'/v[12]/images/([^/]+)', self.delete),
+            ('GET', r'/v2/schemas/image', self.v2_schema),
+            ('GET', r'/v2/info/import', self.v2_import_info),
+            ('POST', r'/v2/images', self.v2_create),
+            ('GET', r'/v2/images', self.v2_list),
+            ('GET', r'/v2/images/([^/]+)', self.v2_show),
+            ('PUT', r'/v2/images/([^/]+)/file', self.v2_upload),
+            ('PUT', r'/v2/images/([^/]+)/stage', self.v2_stage),
+            ('POST', r'/v2/images/([^/]+)/import', self.v2_import),
+        ]
+
+    def may_fail(self, method, path):
+        return (method, path) == ('POST', '/v1/images') or \
+            (method == 'PUT' and path.endswith(('/file', '/stage')))
+
+    # Glance v1
+
+    @staticmethod
+    def _v1_view(image):
+        view = dict((key, value) for key, value in image.items()
+                    if key != 'properties' and key != 'visibility')
+        view['is_public'] = image.get('visibility') == 'public'
+        view['properties'] = dict(image.get('properties', {}))
+        return view
+
+    def v1_create(self, body, query, headers):
+        attrs = {'properties': {}}
+        for key, value in headers.items():
+            key = key.lower()
+            if key.startswith('x-image-meta-property-'):
+                attrs['properties'][key[22:]] = value
+            elif key.startswith('x-image-meta-') and key != \
+                    'x-image-meta-size':
+                attrs[key[13:]] = value
+        is_public = attrs.pop('is_public', 'false').lower() == 'true'
+        attrs['visibility'] = 'public' if is_public else 'private'
+        image = self._new_image(attrs)
+        self._store(image, body)
+        return 201, {'image': self._v1_view(image)}, None
+
+    def v1_list(self, body, query, headers):
+        limit = int(query.pop('limit', 20))
+        marker = query.pop('marker', None)
+        images = sorted(self.images.values(), key=lambda i: i['id'])
+        if marker:
+            images = [image for image in images if image['id'] > marker]
+        matched = []
+        for image in images:
+            view = self._v1_view(image)
+            for key, value in query.items():
+                if key.startswith('property-'):
+                    if view['properties'].get(key[9:]) != value:
+                        break
+                elif str(view.get(key)) != value:
+                    break
+            else:
+                matched.append(view)
+        return 200, {'images': matched[:limit]}, None
+
+    def v1_show(self, body, query, headers, image_id):
+        image = self.images.get(image_id)
+        if image is None:
+            return 404, None, None
+        meta = {}
+        view = self._v1_view(image)
+        for key, value in view.pop('properties').items():
+            meta['x-image-meta-property-%s' % key] = str(value)
+        for key, value in view.items():
+            meta['x-image-meta-%s' % key] = str(value)
+        return 200, None, meta
+
+    def delete(self, body, query, headers, image_id):
+        with self._lock:
+            found = self.images.pop(image_id, None)
+        return (204 if found else 404), None, None
+
+    # Glance v2
+
+    def v2_schema(self, body, query, headers):
+        return 200, IMAGE_SCHEMA, None
+
+    def v2_import_info(self, body, query, headers):
+        return 200, {'import-methods': {
+            'type': 'array', 'value': self.import_methods}}, None
+
+    def v2_create(self, body, query, headers):
+        attrs = _read_json(body)
+        attrs.setdefault('visibility', 'shared')
+        image = self._new_image(attrs)
+        return 201, image, None
+
+    def v2_list(self, body, query, headers):
+        limit = int(query.pop('limit', 20))
+        marker = query.pop('marker', None)
+        images = sorted(self.images.values(), key=lambda i: i['id'])
+        if marker:
+            images = [image for image in images if image['id'] > marker]
+        matched = [image for image in images
+                   if all(str(image.get(key)) == value
+                          for key, value in query.items()
+                          if key not in ('sort_key', 'sort_dir'))]
+        response = {'images': matched[:limit]}
+        if len(matched) > limit:
+            response['next'] = '/v2/images?limit=%d&marker=%s' % (
+                limit, matched[limit - 1]['id'])
+        return 200, response, None
+
+    def v2_show(self, body, query, headers, image_id):
+        image = self.images.get(image_id)
+        if image is None:
+            return 404, _fault(404, 'Not found'), None
+        return 200, image, None
+
+    def v2_upload(self, body, query, headers, image_id):
+        image = self.images.get(image_id)
+        if image is None:
+            return 404, _fault(404, 'Not found'), None
+        self._store(image, body)
+        return 204, None, None
+
+    def v2_stage(self, body, query, headers, image_id):
+        image = self.images.get(image_id)
+        if image is None:
+            return 404, _fault(404, 'Not found'), None
+        self._store(image, body)
+        image['status'] = 'uploading'
+        return 204, None, None
+
+    def v2_import(self, body, query, headers, image_id):
+        image = self.images.get(image_id)
+        if image is None:
+            return 404, _fault(404, 'Not found'), None
+        image['status'] = 'active'
+        return 202, None, None
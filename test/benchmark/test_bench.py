@@ -0,0 +1,48 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+
+from f5_image_prep.openstack.client import clear_sessions
+from test.benchmark import bench
+from test.benchmark.standins import Conditions
+
+
+def test_bench_smoke(tmpdir):
+    '''One small run of every scenario, with failed uploads retried.'''
+
+    results = str(tmpdir.join('results.json'))
+    try:
+        bench.main(['--sizes', '1', '--repeat', '3', '--latency', '1',
+                    '--failure-rate', '0.5', '--retries', '10',
+                    '--work-dir', str(tmpdir), '--json', results])
+    finally:
+        clear_sessions()
+    with open(results) as results_file:
+        scenarios = dict((result['scenario'], result)
+                         for result in json.load(results_file))
+    # Each lookup asks Keystone for one tenant by name, never the listing.
+    assert scenarios['keystone tenant lookup']['api_calls'] == 3
+    assert scenarios['glance v1 image lookup']['p50_ms'] > 0
+    assert scenarios['glance v2 upload 1 MiB']['bytes'] > 1024 * 1024
+    assert all(result['peak_rss_mb'] > 0 for result in scenarios.values())
+
+
+def test_failure_rate_is_seeded():
+    first = Conditions(failure_rate=0.5, seed=3)
+    second = Conditions(failure_rate=0.5, seed=3)
+    assert [first.should_fail() for _ in range(20)] == \
+        [second.should_fail() for _ in range(20)]
+    assert not Conditions().should_fail()
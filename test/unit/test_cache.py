@@ -0,0 +1,116 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+import mock
+import pytest
+
+from f5_image_prep import cache
+from f5_image_prep import qcow2
+from f5_image_prep import staging
+
+
+@pytest.fixture
+def patch_cache(tmpdir):
+    return cache.PatchCache(str(tmpdir.join('cache')), max_bytes=150 * 1024)
+
+
+def _image(tmpdir, name, payload=b'data'):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as image_file:
+        image_file.write(payload * 1024)
+    return path
+
+
+def test_key_depends_on_contents(tmpdir, patch_cache):
+    base = _image(tmpdir, 'base.qcow2')
+    startup = _image(tmpdir, 'startup.tar', b'tar')
+    files = {'image': base, 'startup': startup, 'userdata': None}
+    key = patch_cache.key_for('inline-0.0.1', files)
+    assert key == patch_cache.key_for('inline-0.0.1', files)
+    assert key != patch_cache.key_for('inline-0.0.2', files)
+    assert key != patch_cache.key_for('inline-0.0.1', files,
+                                      {'firstboot': False})
+    with open(startup, 'ab') as startup_file:
+        startup_file.write(b'changed')
+    assert key != patch_cache.key_for('inline-0.0.1', files)
+
+
+def test_file_digest_memoized(tmpdir, patch_cache):
+    base = _image(tmpdir, 'base.qcow2')
+    digest = patch_cache.file_digest(base)
+    with mock.patch('f5_image_prep.cache.hash_file') as mock_hash:
+        assert patch_cache.file_digest(base) == digest
+    assert not mock_hash.called
+
+
+def test_store_and_lookup(tmpdir, patch_cache):
+    assert patch_cache.lookup('ab' * 32) is None
+    patched = _image(tmpdir, 'os_ready-base.qcow2')
+    cached = patch_cache.store('ab' * 32, patched)
+    assert not os.path.exists(patched)
+    assert os.path.basename(cached) == 'os_ready-base.qcow2'
+    assert patch_cache.lookup('ab' * 32) == cached
+
+
+def test_store_flattens_overlay(tmpdir, patch_cache):
+    base = str(tmpdir.join('base.qcow2'))
+    qcow2.create(base, 1024 * 1024)
+    overlay = str(tmpdir.join('os_ready-base.qcow2'))
+    staging.create_overlay(base, overlay)
+    cached = patch_cache.store('cd' * 32, overlay)
+    assert not staging.has_backing_file(cached)
+    assert not os.path.exists(overlay)
+
+
+def test_lru_eviction(tmpdir, patch_cache):
+    first = patch_cache.store('01' * 32, _image(tmpdir, 'a.qcow2', b'a' * 64))
+    second = patch_cache.store('02' * 32, _image(tmpdir, 'b.qcow2', b'b' * 64))
+    patch_cache.release(second)
+    patch_cache.release(first)
+    assert patch_cache.lookup('01' * 32) == first
+    patch_cache.release(first)
+    patch_cache.store('03' * 32, _image(tmpdir, 'c.qcow2', b'c' * 64))
+    assert patch_cache.lookup('02' * 32) is None
+    assert not os.path.exists(second)
+    assert patch_cache.lookup('01' * 32) == first
+
+
+def test_pinned_entries_survive_eviction(tmpdir, patch_cache):
+    # Still uploaded by this process while another one evicts.
+    first = patch_cache.store('01' * 32, _image(tmpdir, 'a.qcow2', b'a' * 64))
+    second = patch_cache.store('02' * 32, _image(tmpdir, 'b.qcow2', b'b' * 64))
+    patch_cache.release(second)
+    other = cache.PatchCache(patch_cache.cache_dir, patch_cache.max_bytes)
+    third = other.store('03' * 32, _image(tmpdir, 'c.qcow2', b'c' * 64))
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    patch_cache.release(first)
+    patch_cache.release('/not/cached.qcow2')
+    other.release(third)
+    other.store('04' * 32, _image(tmpdir, 'd.qcow2', b'd' * 64))
+    assert not os.path.exists(first)
+
+
+def test_file_digest_algorithms(tmpdir, patch_cache):
+    base = _image(tmpdir, 'base.qcow2')
+    assert patch_cache.file_digest(base, 'md5') == \
+        cache.hash_file(base, 'md5')
+    assert patch_cache.file_digest(base) == cache.hash_file(base)
+    with mock.patch('f5_image_prep.cache.hash_file') as mock_hash:
+        patch_cache.file_digest(base, 'md5')
+        patch_cache.file_digest(base)
+    assert not mock_hash.called
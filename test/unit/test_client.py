@@ -0,0 +1,120 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import os
+import stat
+
+from keystoneclient import access
+import mock
+import pytest
+
+from f5_image_prep.openstack import client
+from f5_image_prep.openstack.openstack import OpenStackCreds
+
+
+def auth_body(token, lifetime=3600):
+    expires = datetime.datetime.utcnow() + \
+        datetime.timedelta(seconds=lifetime)
+    return {'access': {
+        'token': {'id': token, 'expires': expires.strftime(
+            '%Y-%m-%dT%H:%M:%SZ'), 'tenant': {'id': 't1', 'name': 'admin'}},
+        'user': {'id': 'u1', 'name': 'admin', 'roles': []},
+        'serviceCatalog': [{
+            'type': 'image', 'name': 'glance',
+            'endpoints': [{'region': 'RegionOne',
+                           'publicURL': 'http://glance:9292/v2'}]}],
+    }}
+
+
+class FakeKeystone(object):
+    def __init__(self, auth_ref=None, **kwargs):
+        self.kwargs = kwargs
+        if auth_ref is None:
+            auth_ref = access.AccessInfo.factory(body=auth_body('fresh'))
+        else:
+            auth_ref = access.AccessInfo.factory(**auth_ref)
+        self.auth_ref = auth_ref
+        self.service_catalog = auth_ref.service_catalog
+
+    @property
+    def auth_token(self):
+        return self.auth_ref.auth_token
+
+
+@pytest.fixture
+def creds():
+    return OpenStackCreds('http://ks:5000/v2.0', 'admin', 'admin', 's3cret')
+
+
+@pytest.fixture
+def keystone(tmpdir):
+    client.clear_sessions()
+    client.enable_token_cache(None)
+    with mock.patch('f5_image_prep.openstack.client.ksclient.Client',
+                    side_effect=FakeKeystone) as mock_keystone:
+        with mock.patch('f5_image_prep.openstack.client.gclient.Client') \
+                as mock_glance:
+            yield mock_keystone, mock_glance
+    client.enable_token_cache(None)
+    client.clear_sessions()
+
+
+def test_authenticate_once(keystone, creds):
+    mock_keystone, mock_glance = keystone
+    first = client.get_glance_client(creds)
+    assert client.get_glance_client(creds) is first
+    assert client.get_keystone_client(creds) is \
+        client.get_keystone_client(creds)
+    assert mock_keystone.call_count == 1
+    assert mock_glance.call_count == 1
+    assert mock_glance.call_args == mock.call('http://glance:9292',
+                                              token='fresh')
+
+
+def test_refreshed_token_rebuilds_clients(keystone, creds):
+    mock_keystone, mock_glance = keystone
+    client.get_glance_client(creds)
+    session = client.get_session(creds)
+    session.keystone_client.auth_ref = access.AccessInfo.factory(
+        body=auth_body('renewed'))
+    client.get_glance_client(creds)
+    assert mock_glance.call_count == 2
+    assert mock_glance.call_args[1] == {'token': 'renewed'}
+
+
+def test_token_cache_on_disk(keystone, creds, tmpdir):
+    mock_keystone, _mock_glance = keystone
+    path = str(tmpdir.join('tokens.json'))
+    client.enable_token_cache(path)
+    client.get_glance_client(creds)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert 's3cret' not in open(path).read()
+
+    # A later run picks the token up without authenticating.
+    client._sessions.clear()
+    client.get_glance_client(creds)
+    assert 'auth_ref' in mock_keystone.call_args[1]
+    assert client.get_session(creds).token == 'fresh'
+
+
+def test_expired_token_cache_is_ignored(keystone, creds, tmpdir):
+    mock_keystone, _mock_glance = keystone
+    path = str(tmpdir.join('tokens.json'))
+    client.enable_token_cache(path)
+    client._save_auth_ref(client._creds_key(creds), access.AccessInfo.factory(
+        body=auth_body('stale', lifetime=60)))
+    assert client.get_session(creds).token == 'fresh'
+    assert mock_keystone.call_count == 2
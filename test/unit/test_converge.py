@@ -0,0 +1,96 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import mock
+import pytest
+
+from f5_image_prep.openstack import converge
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def obj_check(clock):
+    return converge.ObjectCheck(sleep=clock.sleep, clock=clock.time)
+
+
+def test_returns_as_soon_as_condition_holds(obj_check, clock):
+    func = mock.MagicMock(side_effect=[None, None, 'tenant'])
+    assert obj_check.openstack('tenant created', True, func, 'demo') == \
+        'tenant'
+    assert func.call_args == mock.call('demo')
+    assert len(clock.sleeps) == 2
+
+
+def test_backoff_with_jitter_is_bounded(obj_check, clock):
+    with pytest.raises(converge.ConvergenceTimeout) as ex:
+        obj_check.openstack('tenant deleted', False, lambda: 'still here')
+    assert 'after 60 seconds' in str(ex.value)
+    assert clock.now <= 60
+    delay = converge.INITIAL_DELAY
+    for slept in clock.sleeps[:-1]:
+        assert 0 <= slept <= delay
+        delay = min(delay * converge.BACKOFF_FACTOR, converge.MAX_DELAY)
+
+
+def test_per_resource_timeouts(clock):
+    obj_check = converge.ObjectCheck(timeouts={'tenant': 5},
+                                     sleep=clock.sleep, clock=clock.time)
+    assert obj_check.timeout_for('image created') == 900
+    assert obj_check.timeout_for('tenant created') == 5
+    assert obj_check.timeout_for('user role added') == 60
+    assert obj_check.timeout_for('port bound') == converge.DEFAULT_TIMEOUT
+    with pytest.raises(converge.ConvergenceTimeout):
+        obj_check.openstack('image active', True, lambda: None, timeout=1)
+    assert clock.now <= 1
+
+
+class Resource(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def test_wait_many_lists_once_per_poll(obj_check):
+    listings = [[Resource('a')], [Resource('a'), Resource('b')],
+                [Resource('a'), Resource('b'), Resource('c')]]
+    list_resources = mock.MagicMock(side_effect=listings)
+    found = obj_check.wait_many('tenant created', list_resources,
+                                ['a', 'b', 'c'])
+    assert sorted(found) == ['a', 'b', 'c']
+    assert list_resources.call_count == 3
+
+
+def test_wait_many_reports_pending(obj_check):
+    list_resources = mock.MagicMock(return_value=[Resource('a')])
+    with pytest.raises(converge.ConvergenceTimeout) as ex:
+        obj_check.wait_many('user deleted', list_resources, ['a', 'b'],
+                            expected=False)
+    assert ex.value.pending == ['a']
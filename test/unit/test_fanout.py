@@ -0,0 +1,134 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import threading
+
+import mock
+import pytest
+
+from f5_image_prep import fanout
+
+
+@pytest.fixture
+def payload(tmpdir):
+    path = tmpdir.join('os_ready-img.qcow2')
+    data = os.urandom(300000)
+    path.write(data, 'wb')
+    return str(path), data
+
+
+def make_targets(*names):
+    return [fanout.UploadTarget(name, mock.MagicMock()) for name in names]
+
+
+def test_fan_out_single_read(payload):
+    path, data = payload
+    received = {}
+    lock = threading.Lock()
+
+    def upload(target, stream, reader):
+        # glanceclient on Python 2 probes the size before reading.
+        assert not stream.seekable()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        chunks = []
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        with lock:
+            received[target.name] = (size, b''.join(chunks))
+        return mock.MagicMock(checksum=reader.hexdigest('md5'))
+
+    targets = make_targets('east', 'west', 'lab')
+    with mock.patch('f5_image_prep.fanout.UploadReader',
+                    wraps=fanout.UploadReader) as mock_reader:
+        fanout.FanOutUpload(path, targets, upload, chunk_size=32768,
+                            queue_chunks=2).run()
+    assert mock_reader.call_count == 1
+    assert sorted(received) == ['east', 'lab', 'west']
+    for size, body in received.values():
+        assert size == len(data)
+        assert body == data
+    for target in targets:
+        assert target.status == fanout.TARGET_UPLOADED
+        assert target.attempts == 1
+        assert target.image.checksum == hashlib.md5(data).hexdigest()
+
+
+def test_fan_out_bounded_workers(payload):
+    path, data = payload
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def upload(target, stream, reader):
+        with lock:
+            active.append(target.name)
+            peak.append(len(active))
+        body = b''.join(iter(lambda: stream.read(65536), b''))
+        with lock:
+            active.remove(target.name)
+        assert body == data
+        return mock.MagicMock(checksum=reader.hexdigest('md5'))
+
+    targets = make_targets(*('region%d' % i for i in range(5)))
+    with mock.patch('f5_image_prep.fanout.UploadReader',
+                    wraps=fanout.UploadReader) as mock_reader:
+        fanout.FanOutUpload(path, targets, upload, chunk_size=32768,
+                            queue_chunks=1, workers=2).run()
+    # Two targets share each read, the fifth gets one of its own.
+    assert mock_reader.call_count == 3
+    assert max(peak) <= 2
+    assert [t.status for t in targets] == [fanout.TARGET_UPLOADED] * 5
+
+
+def test_failed_target_is_retried_alone(payload):
+    path, data = payload
+    calls = []
+
+    def upload(target, stream, reader):
+        calls.append(target.name)
+        if target.name == 'flaky' and target.attempts == 1:
+            stream.read(1000)
+            raise IOError('connection reset')
+        body = b''.join(iter(lambda: stream.read(65536), b''))
+        assert body == data
+        return mock.MagicMock(checksum=reader.hexdigest('md5'))
+
+    targets = make_targets('steady', 'flaky')
+    fanout.FanOutUpload(path, targets, upload, chunk_size=32768,
+                        queue_chunks=1).run()
+    assert [t.status for t in targets] == [fanout.TARGET_UPLOADED] * 2
+    assert targets[1].attempts == 2
+    assert targets[1].error is None
+    assert sorted(calls) == ['flaky', 'flaky', 'steady']
+
+
+def test_target_failure_is_reported(payload):
+    path, _data = payload
+
+    def upload(target, stream, reader):
+        raise IOError('unreachable')
+
+    targets = make_targets('down')
+    fanout.FanOutUpload(path, targets, upload, retries=1).run()
+    assert targets[0].status == fanout.TARGET_FAILED
+    assert targets[0].attempts == 2
+    assert str(targets[0].error) == 'unreachable'
@@ -0,0 +1,138 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import mock
+import pytest
+
+from f5_image_prep.openstack.index import ResourceIndex
+from f5_image_prep.openstack.openstack import OpenStackCreds
+
+
+class Resource(object):
+    def __init__(self, resource_id, name):
+        self.id = resource_id
+        self.name = name
+
+
+@pytest.fixture
+def resources():
+    return [Resource('1', 'admin'), Resource('2', 'demo'),
+            Resource('3', 'demo')]
+
+
+def test_lookups_list_once(resources):
+    list_resources = mock.MagicMock(return_value=resources)
+    index = ResourceIndex(list_resources)
+    assert index.by_name('demo').id == '2'
+    assert index.by_id('3').name == 'demo'
+    assert index.by_name('missing') is None
+    assert len(index.all()) == 3
+    assert list_resources.call_count == 1
+
+
+def test_server_side_filter_until_loaded(resources):
+    list_resources = mock.MagicMock(return_value=resources)
+    find_by_name = mock.MagicMock(return_value=[resources[1]])
+    index = ResourceIndex(list_resources, find_by_name)
+    assert index.by_name('demo') is resources[1]
+    assert find_by_name.call_args == mock.call('demo')
+    assert not list_resources.called
+    index.load()
+    assert index.by_name('admin') is resources[0]
+    assert find_by_name.call_count == 1
+
+
+def test_updated_in_place(resources):
+    list_resources = mock.MagicMock(return_value=resources)
+    index = ResourceIndex(list_resources)
+    index.load()
+    created = Resource('4', 'new')
+    index.add(created)
+    assert index.by_name('new') is created
+    index.remove(resources[1])
+    assert index.by_id('2') is None
+    assert index.by_name('demo') is resources[2]
+    assert list_resources.call_count == 1
+
+
+def test_fetch_refreshes(resources):
+    list_resources = mock.MagicMock(return_value=resources)
+    index = ResourceIndex(list_resources)
+    index.load()
+    list_resources.return_value = resources[:1]
+    assert index.fetch('demo') is None
+    assert index.by_id('2') is None
+
+
+def test_fetch_queries_by_name(resources):
+    list_resources = mock.MagicMock(return_value=resources)
+    find_by_name = mock.MagicMock(return_value=[])
+    index = ResourceIndex(list_resources, find_by_name)
+    index.load()
+    assert index.fetch('demo') is None
+    assert index.by_name('demo') is None
+    assert index.by_id('2') is None
+    created = Resource('4', 'new')
+    find_by_name.return_value = [created]
+    assert index.fetch('new') is created
+    assert index.by_id('4') is created
+    assert find_by_name.call_args == mock.call('new')
+    assert list_resources.call_count == 1
+
+
+def test_keystone_fetch_not_found():
+    from keystoneclient import exceptions
+    from f5_image_prep.openstack.keystone import KeystoneLib
+    with mock.patch('f5_image_prep.openstack.keystone.get_keystone_client') \
+            as mock_client:
+        ks = mock_client.return_value
+        ks.users._get.side_effect = exceptions.NotFound()
+        lib = KeystoneLib(OpenStackCreds('url', 'admin', 'admin', 'pw'))
+        assert lib.users.fetch('gone') is None
+    assert ks.users._get.call_args == mock.call('/users?name=gone', 'user')
+    assert not ks.users.list.called
+
+
+def test_keystone_lookups(resources):
+    from f5_image_prep.openstack.keystone import KeystoneLib
+    with mock.patch('f5_image_prep.openstack.keystone.get_keystone_client') \
+            as mock_client:
+        ks = mock_client.return_value
+        ks.tenants.list.return_value = resources
+        ks.tenants._get.return_value = resources[1]
+        ks.roles.list.return_value = [Resource('r', '_member_')]
+        lib = KeystoneLib(OpenStackCreds('url', 'admin', 'admin', 'pw'))
+        assert lib.get_tenant('demo').id == '2'
+        assert ks.tenants._get.call_args == \
+            mock.call('/tenants?name=demo', 'tenant')
+        assert not ks.tenants.list.called
+        assert lib.get_tenant_by_id('1').name == 'admin'
+        assert [t.name for t in lib.get_all_non_admin_tenants()] == \
+            ['demo', 'demo']
+        assert lib.get_member_role().id == 'r'
+        assert lib.get_member_role().id == 'r'
+    assert ks.tenants.list.call_count == 1
+    assert ks.roles.list.call_count == 1
+
+
+def test_glance_get_image_filters_by_name(resources):
+    from f5_image_prep.openstack.glance import GlanceLib
+    with mock.patch('f5_image_prep.openstack.glance.get_glance_client') \
+            as mock_client:
+        images = mock_client.return_value.images
+        images.list.return_value = resources[1:]
+        lib = GlanceLib(OpenStackCreds('url', 'admin', 'admin', 'pw'))
+        assert lib.get_image('demo').id == '2'
+    assert images.list.call_args == mock.call(filters={'name': 'demo'})
@@ -0,0 +1,316 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import os
+import struct
+import subprocess
+import tarfile
+
+import pytest
+
+from f5_image_prep import injector
+from f5_image_prep import lvm
+from f5_image_prep import qcow2
+from f5_image_prep.userdata import InvalidUserData
+
+MB = 1024 * 1024
+PART_START = MB
+PE_START_SECTORS = 2048
+EXTENT = MB
+PV_UUID = 'Ab3dEf' + 'x' * 20 + 'Yz0123'
+
+METADATA = '''vg-db-vda {
+id = "vgid"
+seqno = 3
+status = ["RESIZEABLE", "READ", "WRITE"]
+extent_size = 2048
+max_lv = 0
+
+physical_volumes {
+
+pv0 {
+id = "%(pv_id)s"
+device = "/dev/vda2"
+status = ["ALLOCATABLE"]
+dev_size = 40960
+pe_start = %(pe_start)d
+pe_count = 18
+}
+}
+
+logical_volumes {
+
+set.1._config {
+id = "lv1"
+status = ["READ", "WRITE", "VISIBLE"]
+segment_count = 2
+
+segment1 {
+start_extent = 0
+extent_count = 4
+type = "striped"
+stripe_count = 1 # linear
+
+stripes = [
+"pv0", 0
+]
+}
+segment2 {
+start_extent = 4
+extent_count = 4
+type = "striped"
+stripe_count = 1
+
+stripes = [
+"pv0", 12
+]
+}
+}
+
+dat.share {
+id = "lv2"
+status = ["READ", "WRITE", "VISIBLE"]
+segment_count = 1
+
+segment1 {
+start_extent = 0
+extent_count = 8
+type = "striped"
+stripe_count = 1
+
+stripes = [
+"pv0", 4
+]
+}
+}
+}
+}
+# Generated by LVM2
+contents = "Text Format Volume Group"
+version = 1
+description = ""
+''' % {'pv_id': '-'.join([PV_UUID[:6], PV_UUID[6:10], PV_UUID[10:14],
+                          PV_UUID[14:18], PV_UUID[18:22], PV_UUID[22:26],
+                          PV_UUID[26:]]),
+       'pe_start': PE_START_SECTORS}
+
+
+def _have_e2fsprogs():
+    try:
+        injector.find_debugfs()
+    except injector.InjectionFailed:
+        return False
+    return True
+
+
+needs_e2fsprogs = pytest.mark.skipif(not _have_e2fsprogs(),
+                                     reason='e2fsprogs is not installed')
+
+
+def _mkfs(path, size):
+    with open(path, 'wb') as fs_file:
+        fs_file.truncate(size)
+    subprocess.check_call(['mkfs.ext3', '-q', '-F', path],
+                          env={'PATH': '/sbin:/usr/sbin:/bin:/usr/bin'})
+    with open(path, 'rb') as fs_file:
+        return fs_file.read()
+
+
+def build_ve_disk(tmpdir):
+    '''Build a small qcow2 disk laid out like a VE: MBR, PV, two LVs.'''
+
+    raw = bytearray(20 * MB)
+    # MBR with one LVM partition.
+    raw[446:462] = struct.pack('<B3sB3sII', 0, b'\0' * 3, 0x8e, b'\0' * 3,
+                               PART_START // 512, (19 * MB) // 512)
+    raw[510:512] = b'\x55\xaa'
+
+    # PV label in sector 1 of the partition.
+    mda_offset, mda_size = 4096, PE_START_SECTORS * 512 - 4096
+    label = struct.pack('<8sQII8s', b'LABELONE', 1, 0, 32, b'LVM2 001')
+    label += PV_UUID.encode('ascii') + struct.pack('<Q', 19 * MB)
+    label += struct.pack('<QQQQ', PE_START_SECTORS * 512, 0, 0, 0)
+    label += struct.pack('<QQQQ', mda_offset, mda_size, 0, 0)
+    start = PART_START + 512
+    raw[start:start + len(label)] = label
+
+    text = METADATA.encode('utf-8') + b'\0'
+    header = struct.pack('<I16sIQQQQII', 0, b' LVM2 x[5A%r0N*>', 1,
+                         mda_offset, mda_size, 512, len(text), 0, 0)
+    start = PART_START + mda_offset
+    raw[start:start + len(header)] = header
+    raw[start + 512:start + 512 + len(text)] = text
+
+    data_start = PART_START + PE_START_SECTORS * 512
+    config_fs = _mkfs(str(tmpdir.join('config.fs')), 8 * MB)
+    share_fs = _mkfs(str(tmpdir.join('share.fs')), 8 * MB)
+    # set.1._config is split over PV extents 0-3 and 12-15.
+    raw[data_start:data_start + 4 * MB] = config_fs[:4 * MB]
+    start = data_start + 12 * EXTENT
+    raw[start:start + 4 * MB] = config_fs[4 * MB:]
+    start = data_start + 4 * EXTENT
+    raw[start:start + 8 * MB] = share_fs
+
+    path = str(tmpdir.join('BIGIP-11.6.0.0.0.401.qcow2'))
+    qcow2.create(path, len(raw))
+    zeros = b'\0' * 65536
+    with qcow2.Qcow2Image(path, writable=True) as img:
+        for offset in range(0, len(raw), 65536):
+            chunk = bytes(raw[offset:offset + 65536])
+            if chunk != zeros:
+                img.write(offset, chunk)
+    return path
+
+
+def extract_volume(image, lv_name, path):
+    with qcow2.Qcow2Image(image) as disk:
+        volume = lvm.find_logical_volume(disk, lv_name)
+        with open(path, 'wb') as fs_file:
+            for lv_offset, disk_offset, length in volume.extents:
+                fs_file.seek(lv_offset)
+                fs_file.write(disk.read(disk_offset, length))
+    return path
+
+
+def debugfs(fs_image, request):
+    return subprocess.check_output(
+        [injector.find_debugfs(), '-R', request, fs_image],
+        stderr=open(os.devnull, 'w')).decode('utf-8')
+
+
+@pytest.fixture
+def startup_pkg(tmpdir):
+    path = str(tmpdir.join('startup.tar'))
+    archive = tarfile.open(path, 'w')
+    for name, payload in (('./startup', b'#!/bin/bash\necho start\n'),
+                          ('./os-functions/net.sh', b'x' * 70000)):
+        info = tarfile.TarInfo(name)
+        info.size = len(payload)
+        info.mode = 0o755
+        archive.addfile(info, io.BytesIO(payload))
+    info = tarfile.TarInfo('./os-functions')
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o775
+    archive.addfile(info)
+    archive.close()
+    return path
+
+
+def test_find_program(tmpdir, monkeypatch):
+    tool = tmpdir.join('udevadm')
+    tool.write('#!/bin/sh\n')
+    tool.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir))
+    assert injector.find_program('udevadm') == str(tool)
+    assert injector.find_program('no-such-tool') is None
+
+
+def test_find_logical_volume(tmpdir):
+    image = build_ve_disk(tmpdir)
+    with qcow2.Qcow2Image(image) as disk:
+        volume = lvm.find_logical_volume(disk, 'set.1._config')
+        assert volume.size == 8 * MB
+        data_start = PART_START + PE_START_SECTORS * 512
+        assert volume.extents == [
+            (0, data_start, 4 * MB),
+            (4 * MB, data_start + 12 * EXTENT, 4 * MB)]
+        assert list(volume.disk_ranges(4 * MB - 10, 20)) == [
+            (4 * MB - 10, data_start + 4 * MB - 10, 10),
+            (4 * MB, data_start + 12 * EXTENT, 10)]
+        with pytest.raises(lvm.LogicalVolumeNotFound):
+            lvm.find_logical_volume(disk, 'set.2._config')
+
+
+def test_parse_metadata():
+    metadata = lvm.parse_metadata(METADATA)
+    vg = metadata['vg-db-vda']
+    assert vg['extent_size'] == 2048
+    assert vg['status'] == ['RESIZEABLE', 'READ', 'WRITE']
+    assert vg['logical_volumes']['dat.share']['segment1']['stripes'] == \
+        ['pv0', 4]
+    assert metadata['contents'] == 'Text Format Volume Group'
+
+
+@needs_e2fsprogs
+def test_inject(tmpdir, startup_pkg):
+    image = build_ve_disk(tmpdir)
+    userdata = tmpdir.join('user-data.json')
+    userdata.write('{"bigip": {}}')
+    iso = tmpdir.join('BIGIP-11.6.0.0.0.401.iso')
+    iso.write('iso' * 50000)
+
+    injector.ImageInjector(image).inject(
+        startup_pkg=startup_pkg, userdata=str(userdata), firstboot=True,
+        base_iso=str(iso))
+
+    config = extract_volume(image, 'set.1._config',
+                            str(tmpdir.join('out-config.fs')))
+    subprocess.check_call(['e2fsck', '-fn', config],
+                          env={'PATH': '/sbin:/usr/sbin:/bin:/usr/bin'},
+                          stdout=open(os.devnull, 'w'))
+    assert debugfs(config, 'cat /startup') == '#!/bin/bash\necho start\n'
+    assert debugfs(config, 'cat /os-functions/net.sh') == 'x' * 70000
+    assert debugfs(config, 'cat /user-data.json') == '{"bigip": {}}'
+    assert 'OS_USER_DATA_SOURCE_MD5=' in debugfs(config, 'cat /user-data.vars')
+    assert 'firstboot' in debugfs(config, 'ls /')
+
+    share = extract_volume(image, 'dat.share',
+                           str(tmpdir.join('out-share.fs')))
+    assert debugfs(share, 'cat /images/BIGIP-11.6.0.0.0.401.iso') == \
+        'iso' * 50000
+
+
+@needs_e2fsprogs
+def test_inject_twice_overwrites(tmpdir, startup_pkg):
+    image = build_ve_disk(tmpdir)
+    userdata = tmpdir.join('user-data.json')
+    userdata.write('{"first": 1}')
+    injector.ImageInjector(image).inject(userdata=str(userdata))
+    size = os.path.getsize(image)
+    userdata.write('{"second": 2}')
+    injector.ImageInjector(image).inject(userdata=str(userdata))
+    assert os.path.getsize(image) - size <= 2 * 65536
+
+    config = extract_volume(image, 'set.1._config',
+                            str(tmpdir.join('out-config.fs')))
+    assert debugfs(config, 'cat /user-data.json') == '{"second": 2}'
+    assert "OS_UD_second_='2'" in debugfs(config, 'cat /user-data.vars')
+
+
+def test_inject_invalid_userdata(tmpdir):
+    image = str(tmpdir.join('empty.qcow2'))
+    qcow2.create(image, 4 * MB)
+    userdata = tmpdir.join('user-data.json')
+    userdata.write('{"bigip": {"network": {"dhcp": "yes"}}}')
+    with pytest.raises(InvalidUserData):
+        injector.ImageInjector(image).inject(userdata=str(userdata))
+
+
+def test_inject_no_lvm(tmpdir):
+    image = str(tmpdir.join('empty.qcow2'))
+    qcow2.create(image, 4 * MB)
+    with pytest.raises(lvm.LogicalVolumeNotFound):
+        injector.ImageInjector(image).inject(firstboot=True)
+
+
+def test_debugfs_error_filter():
+    script = injector.DebugFsScript
+    assert not script._is_error('debugfs:  mkdir /images')
+    assert not script._is_error('mkdir: Ext2 directory already exists ')
+    assert not script._is_error(
+        'rm: File not found by ext2_lookup while trying to resolve filename')
+    assert script._is_error('write: Could not allocate block in ext2 '
+                            'filesystem while writing file "startup"')
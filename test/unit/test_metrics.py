@@ -0,0 +1,105 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import json
+import threading
+
+import pytest
+
+from f5_image_prep.metrics import Metrics
+from f5_image_prep.metrics import open_metrics
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+def records(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+@pytest.fixture
+def out():
+    return io.BytesIO() if str is bytes else io.StringIO()
+
+
+def test_nested_spans(out):
+    metrics = Metrics(out, clock=FakeClock(), run='r1').bind(image='a.qcow2')
+    with metrics.span('sync_image'):
+        with metrics.span('upload', bytes=2000000) as span:
+            span.set(attempt=1)
+    upload, sync = records(out)
+    assert upload['span'] == 'sync_image/upload'
+    assert upload['elapsed'] == 0.5
+    assert upload['mb_per_s'] == 4.0
+    assert upload['attempt'] == 1
+    assert upload['status'] == 'ok'
+    assert sync['span'] == 'sync_image'
+    assert sync['elapsed'] == 1.5
+    assert sync['image'] == 'a.qcow2'
+    assert sync['run'] == 'r1'
+    assert 'mb_per_s' not in sync
+
+
+def test_failed_span(out):
+    metrics = Metrics(out)
+    with pytest.raises(ValueError):
+        with metrics.span('patch'):
+            raise ValueError('no LVM')
+    metrics.event('done', count=1)
+    failed, event = records(out)
+    assert failed['status'] == 'error'
+    assert failed['error'] == 'ValueError: no LVM'
+    assert event['event'] == 'done'
+    assert event['count'] == 1
+
+
+def test_threads_nest_separately(out):
+    metrics = Metrics(out)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def worker():
+        with metrics.span('worker'):
+            started.set()
+            finish.wait()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait()
+    with metrics.span('main'):
+        pass
+    finish.set()
+    thread.join()
+    assert [record['span'] for record in records(out)] == ['main', 'worker']
+
+
+def test_disabled_and_file(tmpdir):
+    with Metrics().span('patch') as span:
+        pass
+    assert span.elapsed >= 0
+    path = str(tmpdir.join('metrics.jsonl'))
+    for run in range(2):
+        metrics = open_metrics(path)
+        with metrics.span('sync_image'):
+            pass
+    with open(path) as metrics_file:
+        assert len(metrics_file.readlines()) == 2
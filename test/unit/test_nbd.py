@@ -0,0 +1,85 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+import pytest
+
+from f5_image_prep import nbd
+
+
+@pytest.fixture
+def sysfs(tmpdir):
+    for number, size in ((0, '8388608'), (1, '0'), (2, '0'), (10, '0')):
+        device = tmpdir.join('sysfs', 'nbd%d' % number)
+        device.ensure(dir=True)
+        device.join('size').write(size + '\n')
+    tmpdir.join('sysfs', 'sda').ensure(dir=True)
+    return str(tmpdir.join('sysfs'))
+
+
+@pytest.fixture
+def pool(tmpdir, sysfs):
+    return nbd.NbdDevicePool(lock_dir=str(tmpdir), mount_root=str(tmpdir),
+                             sysfs=sysfs)
+
+
+def test_list_nbd_devices(sysfs):
+    assert nbd.list_nbd_devices(sysfs) == \
+        ['/dev/nbd0', '/dev/nbd1', '/dev/nbd2', '/dev/nbd10']
+
+
+def test_list_nbd_devices_module_not_loaded(tmpdir):
+    assert nbd.list_nbd_devices(str(tmpdir.join('missing'))) == []
+    pool = nbd.NbdDevicePool(sysfs=str(tmpdir.join('missing')))
+    assert len(pool) == nbd.DEFAULT_NBDS_MAX
+
+
+def test_acquire_skips_busy_devices(pool):
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first.device == '/dev/nbd1'
+    assert second.device == '/dev/nbd2'
+    assert os.path.isdir(first.mount_dir)
+    assert first.mount_dir != second.mount_dir
+    pool.release(first)
+    assert not os.path.exists(first.mount_dir)
+    pool.release(second)
+
+
+def test_release_keeps_mounted_filesystems(pool):
+    slot = pool.acquire()
+    os.mkdir(os.path.join(slot.mount_dir, 'set.1._config'))
+    # A filesystem left mounted after a failed umount.
+    shared = os.path.join(slot.mount_dir, 'set.1._shared')
+    os.makedirs(os.path.join(shared, 'images'))
+    pool.release(slot)
+    assert not os.path.exists(os.path.join(slot.mount_dir, 'set.1._config'))
+    assert os.path.isdir(os.path.join(shared, 'images'))
+
+
+def test_slots_are_exclusive_across_pools(tmpdir, sysfs):
+    other = nbd.NbdDevicePool(lock_dir=str(tmpdir), sysfs=sysfs)
+    pool = nbd.NbdDevicePool(lock_dir=str(tmpdir), sysfs=sysfs)
+    with other.slot() as held:
+        with pool.slot() as slot:
+            assert slot.device != held.device
+
+
+def test_exhausted(tmpdir, sysfs):
+    pool = nbd.NbdDevicePool(devices=['/dev/nbd0'], lock_dir=str(tmpdir),
+                             sysfs=sysfs)
+    with pytest.raises(nbd.NbdPoolExhausted):
+        pool.acquire()
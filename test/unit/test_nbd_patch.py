@@ -0,0 +1,183 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+import mock
+import pytest
+
+from f5_image_prep.lvm import LogicalVolume
+from f5_image_prep import nbd_patch
+from f5_image_prep.userdata import InvalidUserData
+
+
+MIB = 1024 * 1024
+
+
+class FakeHost(object):
+    '''Plays the kernel and udev for the commands NbdPatcher runs.'''
+
+    def __init__(self, tmpdir, fail=None):
+        self.sysfs = tmpdir.join('sysfs')
+        self.sysfs.join('nbd1').ensure(dir=True)
+        self.sysfs.join('nbd1', 'size').write('0\n')
+        self.dev_mapper = tmpdir.join('mapper')
+        self.dev_mapper.ensure(dir=True)
+        self.commands = []
+        self.stdin = {}
+        self.fail = fail
+
+    def run(self, command, stdin=None):
+        self.commands.append(command)
+        if stdin is not None:
+            self.stdin[command[-1]] = stdin
+        if self.fail and command[0] == self.fail:
+            raise nbd_patch.NbdPatchFailed('%s failed' % self.fail)
+        if command[0] == 'qemu-nbd' and command[1].startswith('--connect'):
+            self.sysfs.join('nbd1', 'size').write('8388608\n')
+            self.sysfs.join('nbd1', 'nbd1p1').ensure(dir=True)
+        elif command[:2] == ['qemu-nbd', '-d']:
+            self.sysfs.join('nbd1', 'size').write('0\n')
+        elif command[:2] == ['dmsetup', 'create']:
+            self.dev_mapper.join(command[2]).ensure()
+        elif command[:2] == ['dmsetup', 'remove']:
+            self.dev_mapper.join(command[-1]).remove()
+        return ''
+
+
+@pytest.fixture
+def guest_disk(tmpdir, monkeypatch):
+    tmpdir.join('module', 'nbd').ensure(dir=True)
+    monkeypatch.setattr(nbd_patch, 'SYSFS_MODULE', str(tmpdir.join('module')))
+    volumes = {
+        'set.1._config': LogicalVolume('set.1._config', [
+            (0, 4 * MIB, 2 * MIB), (2 * MIB, 10 * MIB, 1 * MIB)]),
+        'dat.share': LogicalVolume('dat.share', [(0, 20 * MIB, 4 * MIB)]),
+    }
+    with mock.patch('f5_image_prep.nbd_patch.open_image'):
+        with mock.patch('f5_image_prep.nbd_patch.find_partitions') as \
+                mock_partitions:
+            mock_partitions.return_value = [(0, 32 * MIB), (MIB, 31 * MIB)]
+            with mock.patch('f5_image_prep.nbd_patch.find_logical_volume') \
+                    as mock_find:
+                mock_find.side_effect = lambda disk, name: volumes[name]
+                with mock.patch('f5_image_prep.nbd_patch.find_program') \
+                        as mock_find_program:
+                    mock_find_program.return_value = None
+                    yield volumes
+
+
+def patcher(tmpdir, host):
+    return nbd_patch.NbdPatcher(
+        '/dev/nbd1', str(tmpdir.join('mnt')), run=host.run, timeout=1,
+        sysfs=str(host.sysfs), dev_mapper=str(host.dev_mapper),
+        sleep=lambda seconds: None)
+
+
+def test_dm_table(guest_disk):
+    assert nbd_patch.dm_table('/dev/nbd1', guest_disk['set.1._config']) == \
+        '0 4096 linear /dev/nbd1 8192\n4096 2048 linear /dev/nbd1 20480\n'
+    assert nbd_patch.dm_name('/dev/nbd1', 'set.1._config') == \
+        'f5-image-prep-nbd1-set-1-_config'
+
+
+def test_device_readiness(tmpdir):
+    host = FakeHost(tmpdir)
+    assert nbd_patch.device_size('/dev/nbd1', str(host.sysfs)) == 0
+    assert nbd_patch.device_size('/dev/nbd9', str(host.sysfs)) == 0
+    host.run(['qemu-nbd', '--connect=/dev/nbd1', 'img.qcow2'])
+    assert nbd_patch.device_size('/dev/nbd1', str(host.sysfs)) == \
+        8388608 * 512
+    assert nbd_patch.device_partitions('/dev/nbd1', str(host.sysfs)) == \
+        ['nbd1p1']
+
+
+def test_patch(tmpdir, guest_disk):
+    host = FakeHost(tmpdir)
+    mnt = str(tmpdir.join('mnt'))
+    userdata = tmpdir.join('user-data.json')
+    userdata.write('{"bigip": {}}')
+    patcher(tmpdir, host).patch(
+        'img.qcow2', startup_pkg='startup.tar', userdata=str(userdata),
+        firstboot=True, base_iso='base.iso')
+    compiled = host.commands[10][1]
+    assert os.path.basename(compiled) == 'user-data.vars'
+    assert not os.path.exists(compiled)
+    config = 'f5-image-prep-nbd1-set-1-_config'
+    share = 'f5-image-prep-nbd1-dat-share'
+    assert host.commands == [
+        ['qemu-nbd', '--connect=/dev/nbd1', 'img.qcow2'],
+        ['dmsetup', 'create', config],
+        ['dmsetup', 'mknodes', config],
+        ['mount', str(host.dev_mapper.join(config)), mnt + '/set.1._config'],
+        ['dmsetup', 'create', share],
+        ['dmsetup', 'mknodes', share],
+        ['mount', str(host.dev_mapper.join(share)), mnt + '/dat.share'],
+        ['tar', '-xf', 'startup.tar', '-C', mnt + '/set.1._config'],
+        ['touch', mnt + '/set.1._config/firstboot'],
+        ['cp', str(userdata), mnt + '/set.1._config'],
+        ['cp', compiled, mnt + '/set.1._config'],
+        ['cp', 'base.iso', mnt + '/dat.share/images'],
+        ['umount', mnt + '/dat.share'],
+        ['dmsetup', 'remove', '--retry', share],
+        ['umount', mnt + '/set.1._config'],
+        ['dmsetup', 'remove', '--retry', config],
+        ['qemu-nbd', '-d', '/dev/nbd1'],
+    ]
+    assert host.stdin[config].startswith('0 4096 linear /dev/nbd1 ')
+    assert not os.listdir(str(host.dev_mapper))
+
+
+def test_patch_invalid_userdata(tmpdir, guest_disk):
+    host = FakeHost(tmpdir)
+    userdata = tmpdir.join('user-data.json')
+    userdata.write('{"bigip": ')
+    with pytest.raises(InvalidUserData):
+        patcher(tmpdir, host).patch('img.qcow2', userdata=str(userdata))
+    assert host.commands == []
+
+
+def test_patch_cleans_up_after_failure(tmpdir, guest_disk):
+    host = FakeHost(tmpdir, fail='tar')
+    with pytest.raises(nbd_patch.NbdPatchFailed) as ex:
+        patcher(tmpdir, host).patch('img.qcow2', startup_pkg='startup.tar')
+    assert 'tar failed' in str(ex.value)
+    assert [command[0] for command in host.commands[-3:]] == \
+        ['umount', 'dmsetup', 'qemu-nbd']
+    assert nbd_patch.device_size('/dev/nbd1', str(host.sysfs)) == 0
+
+
+def test_patch_device_never_ready(tmpdir, guest_disk):
+    host = FakeHost(tmpdir)
+    host.run = mock.MagicMock(return_value='')
+    with pytest.raises(nbd_patch.DeviceNotReady) as ex:
+        patcher(tmpdir, host).patch('img.qcow2')
+    assert 'waiting for /dev/nbd1 to report its size' in str(ex.value)
+    assert host.run.call_args == mock.call(['qemu-nbd', '-d', '/dev/nbd1'])
+
+
+def test_wait_until_backs_off():
+    clock = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    with pytest.raises(nbd_patch.DeviceNotReady):
+        nbd_patch.wait_until('nothing', lambda: False, timeout=2,
+                             sleep=sleep, clock=lambda: clock[0])
+    assert sleeps[:3] == [0.01, 0.02, 0.04]
+    assert max(sleeps) == nbd_patch.POLL_MAX
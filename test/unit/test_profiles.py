@@ -0,0 +1,88 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from f5_image_prep import profiles
+
+
+def test_bigip_version():
+    assert profiles.bigip_version(
+        '/images/BIGIP-13.1.0.2-0.0.6.qcow2') == (13, 1, 0)
+    assert profiles.bigip_version('/images/ve.qcow2') is None
+
+
+def test_resolve_properties_merges_in_order():
+    properties = profiles.resolve_properties(
+        ['virtio-multiqueue', 'dedicated'], 'BIGIP-13.1.0.0.0.1868.qcow2')
+    assert properties == {
+        'hw_disk_bus': 'virtio',
+        'hw_vif_model': 'virtio',
+        'hw_vif_multiqueue_enabled': 'true',
+        'hw_cpu_policy': 'dedicated',
+        'hw_cpu_thread_policy': 'prefer',
+        'hw_mem_page_size': 'large',
+        'hw_numa_nodes': '1',
+    }
+    assert profiles.resolve_properties([], 'BIGIP-11.6.0.qcow2') == {}
+
+
+def test_resolve_properties_unknown_profile():
+    with pytest.raises(profiles.InvalidProfile) as ex:
+        profiles.resolve_properties(['fast'], 'BIGIP-13.1.0.qcow2')
+    assert 'high-performance' in str(ex.value)
+
+
+def test_resolve_properties_too_old():
+    with pytest.raises(profiles.InvalidProfile) as ex:
+        profiles.resolve_properties(['virtio-multiqueue'],
+                                    'BIGIP-12.1.2.0.0.249.qcow2')
+    assert str(ex.value) == ('hw_vif_multiqueue_enabled=true needs BIG-IP '
+                             '13.0 or later, the image is 12.1.2')
+    # Without a version in the file name only the values are checked.
+    assert profiles.resolve_properties(['virtio-multiqueue'], 've.qcow2')
+
+
+def test_validate_properties():
+    profiles.validate_properties({'hw_mem_page_size': '2MB',
+                                  'os_distro': 'bigip'})
+    with pytest.raises(profiles.InvalidProfile):
+        profiles.validate_properties({'hw_disk_bus': 'floppy'})
+    with pytest.raises(profiles.InvalidProfile):
+        profiles.validate_properties({'hw_vif_multique_enabled': 'true'})
+
+
+def test_load_profiles(tmpdir):
+    profiles_file = tmpdir.join('profiles.ini')
+    profiles_file.write('[sriov-host]\n'
+                        'hw_vif_model = e1000\n'
+                        'hw_numa_nodes = 2\n'
+                        '[virtio]\n'
+                        'hw_disk_bus = sata\n')
+    loaded = profiles.load_profiles(str(profiles_file))
+    assert loaded['sriov-host'] == {'hw_vif_model': 'e1000',
+                                    'hw_numa_nodes': '2'}
+    assert loaded['virtio'] == {'hw_disk_bus': 'sata'}
+    assert loaded['dedicated'] == profiles.PROFILES['dedicated']
+    assert profiles.PROFILES['virtio']['hw_disk_bus'] == 'virtio'
+
+
+def test_load_profiles_invalid(tmpdir):
+    profiles_file = tmpdir.join('profiles.ini')
+    profiles_file.write('[bad]\nhw_numa_nodes = zero\n')
+    with pytest.raises(profiles.InvalidProfile):
+        profiles.load_profiles(str(profiles_file))
+    with pytest.raises(IOError):
+        profiles.load_profiles(str(tmpdir.join('missing.ini')))
@@ -0,0 +1,132 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+
+import mock
+import pytest
+
+from f5_image_prep.openstack.keystone import KeystoneLib
+from f5_image_prep.openstack.openstack import OpenStackCreds
+from f5_image_prep.openstack import provision
+
+
+class Resource(object):
+    def __init__(self, resource_id, name, **attrs):
+        self.id = resource_id
+        self.name = name
+        self.__dict__.update(attrs)
+
+
+class FakeKeystoneClient(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tenants = mock.MagicMock()
+        self.users = mock.MagicMock()
+        self.roles = mock.MagicMock()
+        self.tenant_list = [Resource('t0', 'admin'), Resource('t1', 'old')]
+        self.user_list = [Resource('u1', 'olduser', tenantId='t1')]
+        self.grants = set([('u1', 't1', 'r1')])
+        self.tenants.list.side_effect = lambda: list(self.tenant_list)
+        self.users.list.side_effect = lambda: list(self.user_list)
+        self.roles.list.return_value = [Resource('r1', '_member_')]
+        self.tenants.create.side_effect = self.create_tenant
+        self.users.create.side_effect = self.create_user
+        self.roles.roles_for_user.side_effect = self.roles_for_user
+        self.roles.add_user_role.side_effect = self.add_user_role
+
+    def create_tenant(self, name, description, enabled):
+        if name == 'broken':
+            raise Exception('quota exceeded')
+        with self.lock:
+            tenant = Resource('t-' + name, name)
+            self.tenant_list.append(tenant)
+        return tenant
+
+    def create_user(self, name, password, tenant_id, email):
+        with self.lock:
+            user = Resource('u-' + name, name, tenantId=tenant_id)
+            self.user_list.append(user)
+        return user
+
+    def roles_for_user(self, user, tenant):
+        return [Resource(role, '_member_') for u, t, role in self.grants
+                if u == user and t == tenant]
+
+    def add_user_role(self, role, user, tenant):
+        with self.lock:
+            self.grants.add((user, tenant, role.id))
+
+
+@pytest.fixture
+def keystone():
+    fake = FakeKeystoneClient()
+    with mock.patch('f5_image_prep.openstack.keystone.get_keystone_client') \
+            as mock_client:
+        mock_client.return_value = fake
+        yield KeystoneLib(OpenStackCreds('url', 'admin', 'admin', 'pw'))
+
+
+def test_provision_applies_only_differences(keystone):
+    fake = keystone.keystone_client
+    new = range(20)
+    spec = {
+        'tenants': [{'name': 'old'}] + [{'name': 'new%d' % n} for n in new],
+        'users': [{'name': 'olduser', 'password': 'pw', 'tenant': 'old'}] + [
+            {'name': 'user%d' % n, 'password': 'pw', 'tenant': 'new%d' % n}
+            for n in new],
+        'roles': [{'user': 'olduser', 'tenant': 'old'}] + [
+            {'user': 'user%d' % n, 'tenant': 'new%d' % n} for n in new],
+    }
+    results = provision.Provisioner(keystone, workers=4).provision(spec)
+    assert all(result.ok for result in results)
+    assert [(r.kind, r.name, r.action) for r in results[:2]] == [
+        ('tenant', 'old', 'exists'), ('tenant', 'new0', 'created')]
+    assert results[21].action == 'exists'
+    assert results[42].action == 'exists'
+    assert results[43].name == 'new0/user0/_member_'
+    assert results[43].action == 'granted'
+    assert fake.tenants.create.call_count == 20
+    assert fake.users.create.call_count == 20
+    assert len(fake.grants) == 21
+    # One snapshot, then one listing confirms every new tenant and user.
+    assert fake.tenants.list.call_count == 2
+    assert fake.users.list.call_count == 2
+
+
+def test_provision_reports_failures(keystone):
+    spec = {
+        'tenants': [{'name': 'broken'}],
+        'users': [{'name': 'orphan', 'password': 'pw', 'tenant': 'broken'}],
+        'roles': [{'user': 'orphan', 'tenant': 'broken'},
+                  {'user': 'olduser', 'tenant': 'old', 'role': 'admin'}],
+    }
+    results = provision.Provisioner(keystone).provision(spec)
+    assert [r.action for r in results] == ['failed'] * 4
+    assert str(results[0].error) == 'quota exceeded'
+    assert 'broken is not available' in results[1].error
+
+
+def test_provision_fails_tenants_never_listed(keystone):
+    from f5_image_prep.openstack.converge import ObjectCheck
+    fake = keystone.keystone_client
+    fake.tenants.create.side_effect = \
+        lambda name, description, enabled: Resource('t-' + name, name)
+    keystone.obj_check = ObjectCheck(timeouts={'tenant': 0},
+                                     sleep=lambda seconds: None)
+    results = provision.Provisioner(keystone).provision(
+        {'tenants': [{'name': 'ghost'}, {'name': 'old'}]})
+    assert [r.action for r in results] == ['failed', 'exists']
+    assert 'tenant created' in str(results[0].error)
@@ -0,0 +1,182 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import os
+import struct
+
+import pytest
+
+from f5_image_prep import qcow2
+
+MB = 1024 * 1024
+
+
+def check_refcounts(path):
+    '''Verify every host cluster is counted once per reference to it.
+
+    Compressed clusters share host clusters, which count one reference per
+    compressed cluster they hold; everything else is referenced once.
+    '''
+
+    img = qcow2.Qcow2Image(path, writable=True)
+    try:
+        cs = img.cluster_size
+        used = collections.Counter([0])
+        for index in range(qcow2._div_round_up(img.l1_size * 8, cs)):
+            used[img.l1_table_offset // cs + index] += 1
+        for index in range(img.refcount_table_clusters):
+            used[img.refcount_table_offset // cs + index] += 1
+        for block in img.refcount_table:
+            if block:
+                used[block // cs] += 1
+        for l1_entry in img.l1_table:
+            l2_offset = l1_entry & qcow2.L1E_OFFSET_MASK
+            if not l2_offset:
+                continue
+            used[l2_offset // cs] += 1
+            for entry in img._l2_table(l2_offset):
+                if entry & qcow2.QCOW_OFLAG_COMPRESSED:
+                    used[(entry & img._coffset_mask) // cs] += 1
+                elif entry & qcow2.L2E_OFFSET_MASK:
+                    used[(entry & qcow2.L2E_OFFSET_MASK) // cs] += 1
+
+        counted = collections.Counter()
+        for table_index, block in enumerate(img.refcount_table):
+            if not block:
+                continue
+            raw = img._pread(block, cs)
+            counts = struct.unpack('>%dH' % img.refblock_entries, raw)
+            for index, count in enumerate(counts):
+                if count:
+                    counted[table_index * img.refblock_entries + index] = \
+                        count
+        assert used == counted
+    finally:
+        img.close()
+
+
+@pytest.fixture
+def image(tmpdir):
+    path = str(tmpdir.join('disk.qcow2'))
+    qcow2.create(path, 8 * MB)
+    return path
+
+
+def test_create(image):
+    with qcow2.Qcow2Image(image) as img:
+        assert img.size == 8 * MB
+        assert img.version == 3
+        assert img.cluster_size == 64 * 1024
+        assert img.read(0, 4096) == b'\0' * 4096
+        assert not img.is_allocated(0, img.size)
+    check_refcounts(image)
+
+
+def test_write_read_roundtrip(image):
+    payload = os.urandom(200 * 1024)
+    with qcow2.Qcow2Image(image, writable=True) as img:
+        img.write(100000, payload)
+        img.write(7 * MB, b'tail')
+    with qcow2.Qcow2Image(image) as img:
+        assert img.read(100000, len(payload)) == payload
+        assert img.read(99999, 1) == b'\0'
+        assert img.read(7 * MB, 4) == b'tail'
+        assert img.is_allocated(7 * MB, 1)
+        assert not img.is_allocated(4 * MB, MB)
+    check_refcounts(image)
+
+
+def test_rewrite_in_place(image):
+    with qcow2.Qcow2Image(image, writable=True) as img:
+        img.write(0, b'a' * 1024)
+    size = os.path.getsize(image)
+    with qcow2.Qcow2Image(image, writable=True) as img:
+        img.write(512, b'b' * 16)
+    assert os.path.getsize(image) == size
+    with qcow2.Qcow2Image(image) as img:
+        assert img.read(0, 1024) == b'a' * 512 + b'b' * 16 + b'a' * 496
+
+
+def test_backing_file(tmpdir, image):
+    with qcow2.Qcow2Image(image, writable=True) as img:
+        img.write(0, b'base' * 1024)
+        img.write(MB, b'keep')
+    overlay = str(tmpdir.join('overlay.qcow2'))
+    qcow2.create(overlay, 8 * MB, backing_file='disk.qcow2',
+                 backing_format='qcow2')
+    with qcow2.Qcow2Image(overlay, writable=True) as img:
+        assert img.backing_file == 'disk.qcow2'
+        assert img.read(MB, 4) == b'keep'
+        img.write(2, b'XX')
+    with qcow2.Qcow2Image(overlay) as img:
+        assert img.read(0, 8) == b'baXXbase'
+        assert img.read(MB, 4) == b'keep'
+    with qcow2.Qcow2Image(image) as img:
+        assert img.read(0, 8) == b'basebase'
+    check_refcounts(overlay)
+
+
+def test_raw_backing_file(tmpdir):
+    raw = str(tmpdir.join('disk.raw'))
+    with open(raw, 'wb') as raw_file:
+        raw_file.write(b'raw!' + b'\0' * (MB - 4))
+    overlay = str(tmpdir.join('overlay.qcow2'))
+    qcow2.create(overlay, MB, backing_file=raw, backing_format='raw')
+    with qcow2.open_image(overlay) as img:
+        assert img.read(0, 4) == b'raw!'
+
+
+def test_read_beyond_end(image):
+    with qcow2.Qcow2Image(image) as img:
+        with pytest.raises(qcow2.Qcow2Error):
+            img.read(8 * MB - 1, 2)
+
+
+def test_write_read_only(image):
+    with qcow2.Qcow2Image(image) as img:
+        with pytest.raises(qcow2.Qcow2Error):
+            img.write(0, b'x')
+
+
+def test_not_qcow2(tmpdir):
+    path = str(tmpdir.join('disk.raw'))
+    with open(path, 'wb') as raw_file:
+        raw_file.write(b'\0' * 4096)
+    with pytest.raises(qcow2.Qcow2Error):
+        qcow2.Qcow2Image(path)
+    with pytest.raises(qcow2.Qcow2Unsupported):
+        qcow2.open_image(path, writable=True)
+
+
+def test_write_compressed(image):
+    text = (b'compressible cluster ' * 3200)[:64 * 1024]
+    noise = os.urandom(64 * 1024)
+    with qcow2.Qcow2Image(image, writable=True) as img:
+        assert qcow2.compress_cluster(noise) is None
+        for cluster in range(3):
+            img.write_compressed(cluster, qcow2.compress_cluster(
+                text[cluster:] + text[:cluster]))
+        img.write(MB, noise)
+        img.write_compressed(100, qcow2.compress_cluster(text))
+        with pytest.raises(qcow2.Qcow2Error):
+            img.write_compressed(100, qcow2.compress_cluster(text))
+    with qcow2.Qcow2Image(image) as img:
+        assert img.read(0, 64 * 1024) == text
+        assert img.read(64 * 1024, 64 * 1024) == text[1:] + text[:1]
+        assert img.read(2 * 64 * 1024, 64 * 1024) == text[2:] + text[:2]
+        assert img.read(MB, 64 * 1024) == noise
+        assert img.read(100 * 64 * 1024, 64 * 1024) == text
+    check_refcounts(image)
@@ -0,0 +1,147 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+
+from glanceclient import exc
+import mock
+import pytest
+
+from f5_image_prep import resumable
+
+
+class FakeImages(object):
+    '''Just enough of the Glance v2 images API, with injectable failures.'''
+
+    def __init__(self, import_methods=('glance-direct',)):
+        self.import_methods = list(import_methods)
+        self.images = {}
+        self.created = 0
+        self.fail_stage = False
+        self.calls = []
+
+    def _image(self, image_id):
+        if image_id not in self.images:
+            raise exc.HTTPNotFound()
+        return mock.MagicMock(id=image_id, **self.images[image_id])
+
+    def get_import_info(self):
+        return {'import-methods': {'value': self.import_methods}}
+
+    def create(self, **kwargs):
+        self.created += 1
+        image_id = 'img%d' % self.created
+        self.images[image_id] = {'status': 'queued'}
+        self.calls.append(('create', image_id))
+        return self._image(image_id)
+
+    def get(self, image_id):
+        return self._image(image_id)
+
+    def stage(self, image_id, data, size):
+        self.calls.append(('stage', image_id))
+        if self.fail_stage:
+            raise IOError('connection reset')
+        data.read()
+        self.images[image_id]['status'] = 'uploading'
+
+    def image_import(self, image_id, method):
+        self.calls.append(('import', image_id))
+        self.images[image_id]['status'] = 'active'
+
+    def upload(self, image_id, data, size):
+        self.calls.append(('upload', image_id))
+        data.read()
+        self.images[image_id]['status'] = 'active'
+
+
+@pytest.fixture
+def glance():
+    client = mock.MagicMock()
+    client.images = FakeImages()
+    return client
+
+
+def make_upload(glance, tmpdir, **kwargs):
+    return resumable.ResumableUpload(
+        glance, str(tmpdir.join('uploads', 'state.json')),
+        {'name': 'img'}, poll_interval=0, **kwargs)
+
+
+def test_stage_and_import(glance, tmpdir):
+    data = mock.MagicMock()
+    upload = make_upload(glance, tmpdir)
+    image = upload.run(data, 10)
+    assert image.status == 'active'
+    assert upload.sent
+    assert glance.images.calls == [
+        ('create', 'img1'), ('stage', 'img1'), ('import', 'img1')]
+    state = json.load(open(upload.state.path))
+    assert state == {'image_id': 'img1', 'step': 'importing'}
+    upload.finish()
+    assert not tmpdir.join('uploads', 'state.json').check()
+
+
+def test_retry_reuses_queued_image(glance, tmpdir):
+    glance.images.fail_stage = True
+    with pytest.raises(IOError):
+        make_upload(glance, tmpdir).run(mock.MagicMock(), 10)
+    glance.images.fail_stage = False
+    image = make_upload(glance, tmpdir).run(mock.MagicMock(), 10)
+    assert image.id == 'img1'
+    assert glance.images.calls.count(('create', 'img1')) == 1
+    assert ('create', 'img2') not in glance.images.calls
+
+
+def test_staged_data_is_not_sent_again(glance, tmpdir):
+    upload = make_upload(glance, tmpdir)
+    with mock.patch.object(glance.images, 'image_import') as mock_import:
+        mock_import.side_effect = IOError('gateway timeout')
+        with pytest.raises(IOError):
+            upload.run(mock.MagicMock(), 10)
+    upload = make_upload(glance, tmpdir)
+    image = upload.run(mock.MagicMock(), 10)
+    assert image.status == 'active'
+    assert not upload.sent
+    assert glance.images.calls.count(('stage', 'img1')) == 1
+
+
+def test_vanished_image_is_recreated(glance, tmpdir):
+    glance.images.fail_stage = True
+    with pytest.raises(IOError):
+        make_upload(glance, tmpdir).run(mock.MagicMock(), 10)
+    del glance.images.images['img1']
+    glance.images.fail_stage = False
+    image = make_upload(glance, tmpdir).run(mock.MagicMock(), 10)
+    assert image.id == 'img2'
+
+
+def test_direct_upload_without_import(tmpdir):
+    glance = mock.MagicMock()
+    glance.images = FakeImages(import_methods=())
+    image = make_upload(glance, tmpdir).run(mock.MagicMock(), 10)
+    assert image.status == 'active'
+    assert glance.images.calls == [('create', 'img1'), ('upload', 'img1')]
+
+
+def test_failed_import(glance, tmpdir):
+    def kill(image_id, method):
+        glance.images.images[image_id]['status'] = 'killed'
+
+    upload = make_upload(glance, tmpdir)
+    with mock.patch.object(glance.images, 'image_import', side_effect=kill):
+        with pytest.raises(resumable.ResumableUploadFailed):
+            upload.run(mock.MagicMock(), 10)
+    assert not tmpdir.join('uploads', 'state.json').check()
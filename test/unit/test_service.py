@@ -0,0 +1,159 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from f5_image_prep import service
+
+try:
+    from urllib2 import Request
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import Request
+    from urllib.request import urlopen
+
+
+@pytest.fixture
+def queue(tmpdir):
+    queue = service.JobQueue(str(tmpdir.join('state', 'jobs.db')))
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def inbox(tmpdir):
+    return tmpdir.mkdir('inbox')
+
+
+def test_queue_priority_and_dedup(queue, inbox):
+    low = str(inbox.join('a.qcow2').write('a') or inbox.join('a.qcow2'))
+    high = str(inbox.join('b.qcow2').write('b') or inbox.join('b.qcow2'))
+    first = queue.add(low)
+    assert queue.add(low) is None
+    second = queue.add(high, priority=5)
+    assert queue.take()['id'] == second
+    job = queue.take()
+    assert job['id'] == first
+    assert job['status'] == 'running'
+    assert job['attempts'] == 1
+    assert queue.take() is None
+    queue.finish(second, result='image-id')
+    assert queue.requeue_running() == 1
+    assert queue.counts() == {'queued': 1, 'done': 1}
+    assert queue.get(second)['result'] == 'image-id'
+    os.utime(low, (0, 0))
+    assert queue.add(low) is not None
+
+
+def test_queue_survives_restart(tmpdir, inbox):
+    path = str(inbox.join('a.qcow2').write('a') or inbox.join('a.qcow2'))
+    db = str(tmpdir.join('jobs.db'))
+    queue = service.JobQueue(db)
+    job_id = queue.add(path)
+    queue.take()
+    queue.close()
+    queue = service.JobQueue(db)
+    assert queue.requeue_running() == 1
+    assert queue.take()['id'] == job_id
+    queue.close()
+
+
+def test_image_for_and_inputs(inbox):
+    image = str(inbox.join('BIGIP.qcow2'))
+    assert service.image_for(image) == image
+    assert service.image_for(str(inbox.join('BIGIP.hotfix.iso'))) == image
+    assert service.image_for(str(inbox.join('notes.txt'))) is None
+    inbox.join('BIGIP.base.iso').write('iso')
+    assert service.image_inputs(image) == {
+        'base_iso': str(inbox.join('BIGIP.base.iso')), 'hotfix_iso': None}
+
+
+def test_polling_watcher_waits_for_stable_files(inbox):
+    watcher = service.PollingWatcher(str(inbox), interval=0)
+    inbox.join('a.qcow2').write('partial')
+    assert watcher.poll(0) == []
+    assert watcher.poll(0) == [str(inbox.join('a.qcow2'))]
+    assert watcher.poll(0) == []
+    inbox.join('a.qcow2').write('complete now')
+    assert watcher.poll(0) == []
+    assert watcher.poll(0) == [str(inbox.join('a.qcow2'))]
+
+
+def test_inotify_watcher(inbox):
+    try:
+        watcher = service.InotifyWatcher(str(inbox))
+    except (AttributeError, OSError):
+        pytest.skip('inotify is not available')
+    try:
+        inbox.join('a.qcow2').write('data')
+        assert watcher.poll(5) == [str(inbox.join('a.qcow2'))]
+        assert watcher.poll(0) == []
+    finally:
+        watcher.close()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_service(queue, inbox):
+    ran = []
+    release = threading.Event()
+
+    def run_job(path, base_iso, hotfix_iso):
+        release.wait(10)
+        ran.append((os.path.basename(path), base_iso and
+                    os.path.basename(base_iso), hotfix_iso))
+        if 'broken' in path:
+            raise ValueError('no LVM')
+        return 'image-' + os.path.basename(path)
+
+    inbox.join('early.qcow2').write('early')
+    prep = service.ImagePrepService(
+        str(inbox), run_job, queue, workers=1, status_port=0,
+        watcher=service.PollingWatcher(str(inbox), interval=0.01)).start()
+    try:
+        wait_for(lambda: prep.busy == 1)
+        status = json.loads(urlopen(prep.status_url + '/status').read()
+                            .decode('utf-8'))
+        assert status['busy'] == 1
+        inbox.join('late.base.iso').write('iso')
+        inbox.join('late.qcow2').write('late')
+        request = Request(prep.status_url + '/jobs', json.dumps(
+            {'path': str(inbox.join('broken.qcow2').write('x') or
+                         inbox.join('broken.qcow2')), 'priority': 9}
+        ).encode('utf-8'), {'Content-Type': 'application/json'})
+        broken_id = json.loads(urlopen(request).read().decode('utf-8'))['id']
+        wait_for(lambda: queue.counts().get('queued') == 2)
+        release.set()
+        wait_for(lambda: queue.counts().get('queued') is None and
+                 prep.busy == 0)
+        jobs = json.loads(urlopen(prep.status_url + '/jobs').read()
+                          .decode('utf-8'))
+    finally:
+        prep.stop()
+    assert ran == [('early.qcow2', None, None),
+                   ('broken.qcow2', None, None),
+                   ('late.qcow2', 'late.base.iso', None)]
+    assert queue.get(broken_id)['error'] == 'no LVM'
+    assert sorted(job['status'] for job in jobs) == ['done', 'done', 'failed']
@@ -0,0 +1,174 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+
+from glanceclient import exc
+import mock
+import pytest
+
+from f5_image_prep.openstack.glance import GlanceLib
+from f5_image_prep.openstack.keystone import KeystoneLib
+from f5_image_prep.openstack.openstack import OpenStackCreds
+from f5_image_prep.openstack.share import ImageSharer
+
+
+CREDS = OpenStackCreds('url', 'admin', 'admin', 'pw')
+
+
+class Resource(object):
+    def __init__(self, resource_id, name=None, **attrs):
+        self.id = resource_id
+        self.name = name
+        self.__dict__.update(attrs)
+
+
+class FakeGlanceClient(object):
+    def __init__(self, members=(), statuses=None):
+        self.lock = threading.Lock()
+        self.members = set(members)
+        self.statuses = dict((member, 'accepted') for member in members)
+        self.statuses.update(statuses or {})
+        self.images = mock.MagicMock()
+        self.image_members = mock.MagicMock()
+        self.image_members.list.side_effect = self.list_members
+        self.image_members.create.side_effect = self.create_member
+        self.image_members.delete.side_effect = self.delete_member
+        self.image_members.update.side_effect = self.update_member
+
+    def list_members(self, image_id=None, image=None):
+        assert (image_id or image) == 'img'
+        return [Resource(None, member_id=member, status=self.statuses[member])
+                for member in self.members]
+
+    def create_member(self, image_id, member_id):
+        if member_id == 't-quota':
+            raise Exception('member limit exceeded')
+        with self.lock:
+            self.members.add(member_id)
+            self.statuses[member_id] = 'pending'
+
+    def update_member(self, image_id, member_id, status):
+        if member_id == 't-locked':
+            raise Exception('403 Forbidden')
+        with self.lock:
+            self.statuses[member_id] = status
+
+    def delete_member(self, image_id, member_id):
+        with self.lock:
+            self.members.discard(member_id)
+
+
+@pytest.fixture
+def keystone():
+    client = mock.MagicMock()
+    client.tenants.list.return_value = [
+        Resource('t-admin', 'admin'), Resource('t-service', 'service'),
+        Resource('t-quota', 'quota')] + [
+        Resource('t%d' % n, 'tenant%d' % n) for n in range(10)]
+    with mock.patch('f5_image_prep.openstack.keystone.get_keystone_client') \
+            as mock_client:
+        mock_client.return_value = client
+        yield KeystoneLib(CREDS)
+
+
+def glance(members=(), api_version=1, statuses=None):
+    with mock.patch('f5_image_prep.openstack.glance.get_glance_client') \
+            as mock_client:
+        mock_client.return_value = FakeGlanceClient(members, statuses)
+        return GlanceLib(CREDS, api_version=api_version)
+
+
+def test_share_adds_missing_members(keystone):
+    lib = glance(['t0', 't1'])
+    results = ImageSharer(lib, keystone, workers=4).share(
+        Resource('img'), ['tenant%d' % n for n in range(10)] + ['gone'])
+    assert [(r.name, r.action) for r in results[:3]] == [
+        ('gone', 'failed'), ('tenant0', 'exists'), ('tenant1', 'exists')]
+    assert all(r.action == 'granted' for r in results[3:])
+    assert lib.glance_client.members == set('t%d' % n for n in range(10))
+    assert lib.glance_client.image_members.create.call_count == 8
+    assert keystone.keystone_client.tenants.list.call_count == 1
+
+
+def test_share_rerun_is_incremental(keystone):
+    lib = glance()
+    sharer = ImageSharer(lib, keystone)
+    sharer.share(Resource('img'), ['tenant0', 'tenant1'])
+    results = sharer.share(Resource('img'), ['tenant0', 'tenant1'])
+    assert [r.action for r in results] == ['exists', 'exists']
+    assert lib.glance_client.image_members.create.call_count == 2
+
+
+def test_share_all_tenants_and_prune(keystone):
+    lib = glance(['t0', 't-admin', 'someone-else'])
+    results = ImageSharer(lib, keystone).share(Resource('img'), prune=True)
+    actions = dict((r.name, r.action) for r in results)
+    assert actions['tenant0'] == 'exists'
+    assert actions['tenant5'] == 'granted'
+    assert actions['quota'] == 'failed'
+    assert actions['admin'] == 'revoked'
+    assert actions['someone-else'] == 'revoked'
+    assert lib.glance_client.members == set('t%d' % n for n in range(10))
+
+
+def test_enable_sharing_v2():
+    lib = glance(api_version=2)
+    lib.enable_sharing(Resource('img', visibility='private'))
+    assert lib.glance_client.images.update.call_args == \
+        mock.call('img', visibility='shared')
+    lib.glance_client.images.update.side_effect = exc.HTTPBadRequest()
+    lib.enable_sharing(Resource('img', visibility='private'))
+    lib.glance_client.images.update.reset_mock()
+    lib.enable_sharing(Resource('img', visibility='shared'))
+    glance().enable_sharing(Resource('img', is_public=False))
+    assert not lib.glance_client.images.update.called
+
+
+def test_list_member_ids_v2():
+    lib = glance(['t0'], api_version=2)
+    assert lib.list_member_ids('img') == set(['t0'])
+    assert lib.glance_client.image_members.list.call_args == mock.call('img')
+
+
+def test_share_v2_accepts_members(keystone):
+    keystone.keystone_client.tenants.list.return_value.append(
+        Resource('t-locked', 'locked'))
+    lib = glance(['t0', 't1', 't2', 't-locked'], api_version=2,
+                 statuses={'t1': 'pending', 't2': 'rejected',
+                           't-locked': 'pending'})
+    sharer = ImageSharer(lib, keystone)
+    results = sharer.share(
+        Resource('img', visibility='shared'),
+        ['tenant0', 'tenant1', 'tenant2', 'tenant3', 'locked'])
+    actions = dict((r.name, r.action) for r in results)
+    assert actions == {'tenant0': 'exists', 'tenant1': 'accepted',
+                       'tenant2': 'accepted', 'tenant3': 'granted',
+                       'locked': 'failed'}
+    assert lib.glance_client.statuses == {
+        't0': 'accepted', 't1': 'accepted', 't2': 'accepted',
+        't3': 'accepted', 't-locked': 'pending'}
+    assert lib.glance_client.image_members.update.call_args_list[-1] == \
+        mock.call('img', 't3', 'accepted')
+    results = sharer.share(Resource('img', visibility='shared'),
+                           ['tenant3'])
+    assert [r.action for r in results] == ['exists']
+
+
+def test_add_member_v1_skips_accept():
+    lib = glance()
+    lib.add_member('img', 't0')
+    assert lib.list_members('img') == {'t0': 'accepted'}
+    assert not lib.glance_client.image_members.update.called
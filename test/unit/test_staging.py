@@ -0,0 +1,104 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+import mock
+import pytest
+
+from f5_image_prep import qcow2
+from f5_image_prep import staging
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def base(tmpdir):
+    path = str(tmpdir.join('BIGIP-11.6.0.0.0.401.qcow2'))
+    qcow2.create(path, 16 * MB)
+    with qcow2.Qcow2Image(path, writable=True) as img:
+        img.write(0, b'boot' * 1024)
+        img.write(9 * MB, b'config')
+    return path
+
+
+def test_stage_image_reflink(tmpdir, base):
+    dst = str(tmpdir.join('os_ready.qcow2'))
+    with mock.patch('f5_image_prep.staging.fcntl.ioctl') as mock_ioctl:
+        assert staging.stage_image(base, dst) == staging.STAGE_REFLINK
+    assert mock_ioctl.call_args[0][1] == staging.FICLONE
+
+
+def test_stage_image_overlay(tmpdir, base):
+    dst = str(tmpdir.join('os_ready.qcow2'))
+    with mock.patch('f5_image_prep.staging.fcntl.ioctl') as mock_ioctl:
+        mock_ioctl.side_effect = IOError(95, 'Operation not supported')
+        assert staging.stage_image(base, dst) == staging.STAGE_OVERLAY
+    assert staging.has_backing_file(dst)
+    assert not staging.has_backing_file(base)
+    assert os.path.getsize(dst) < 1 * MB
+    with qcow2.Qcow2Image(dst) as img:
+        assert img.read(9 * MB, 6) == b'config'
+
+
+def test_stage_image_copy(tmpdir, base):
+    dst = str(tmpdir.join('os_ready.qcow2'))
+    with mock.patch('f5_image_prep.staging.fcntl.ioctl') as mock_ioctl:
+        mock_ioctl.side_effect = IOError(18, 'Invalid cross-device link')
+        assert staging.stage_image(base, dst, allow_overlay=False) == \
+            staging.STAGE_COPY
+    assert not staging.has_backing_file(dst)
+    with open(base, 'rb') as src, open(dst, 'rb') as copy:
+        assert src.read() == copy.read()
+
+
+def test_flatten_image(tmpdir, base):
+    overlay = str(tmpdir.join('os_ready.qcow2'))
+    staging.create_overlay(base, overlay)
+    with qcow2.Qcow2Image(overlay, writable=True) as img:
+        img.write(9 * MB, b'CONFIG')
+        img.write(12 * MB, b'\0' * 65536)
+    flat = str(tmpdir.join('flat.qcow2'))
+    staging.flatten_image(overlay, flat)
+    assert not staging.has_backing_file(flat)
+    with qcow2.Qcow2Image(flat) as img:
+        assert img.size == 16 * MB
+        assert img.read(0, 8) == b'bootboot'
+        assert img.read(9 * MB, 6) == b'CONFIG'
+        assert not img.is_allocated(12 * MB, 65536)
+    # header, L1, refcount table and block, one L2, two data clusters
+    assert os.path.getsize(flat) == 7 * 65536
+
+
+def test_flatten_image_compressed(tmpdir, base):
+    overlay = str(tmpdir.join('os_ready.qcow2'))
+    staging.create_overlay(base, overlay)
+    noise = os.urandom(65536)
+    with qcow2.Qcow2Image(overlay, writable=True) as img:
+        img.write(9 * MB, b'CONFIG')
+        img.write(10 * MB, noise)
+    flat = str(tmpdir.join('flat.qcow2'))
+    plain = str(tmpdir.join('plain.qcow2'))
+    staging.flatten_image(overlay, flat, compress=True)
+    staging.flatten_image(overlay, plain)
+    assert os.path.getsize(flat) < os.path.getsize(plain)
+    with qcow2.Qcow2Image(flat) as img:
+        assert img._cluster_state(img._l2_entry(0)) == 'compressed'
+        # Incompressible clusters are stored as they are.
+        assert img._cluster_state(img._l2_entry(160)) == 'data'
+        assert img.read(0, 8) == b'bootboot'
+        assert img.read(9 * MB, 6) == b'CONFIG'
+        assert img.read(10 * MB, 65536) == noise
+        assert not img.is_allocated(12 * MB, 65536)
@@ -0,0 +1,120 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import io
+import os
+
+import mock
+import pytest
+
+from f5_image_prep import qcow2
+from f5_image_prep import upload
+
+
+@pytest.fixture
+def payload(tmpdir):
+    path = tmpdir.join('os_ready-img.qcow2')
+    data = os.urandom(100000)
+    path.write(data, 'wb')
+    return str(path), data
+
+
+def test_read_in_small_pieces(payload):
+    path, data = payload
+    progress = mock.MagicMock()
+    with upload.UploadReader(path, chunk_size=4096,
+                             progress=progress) as reader:
+        assert len(reader) == len(data)
+        pieces = []
+        while True:
+            piece = reader.read(1000)
+            if not piece:
+                break
+            assert len(piece) <= 1000
+            pieces.append(piece)
+        assert len(reader._buffer) <= 4096
+    assert b''.join(pieces) == data
+    assert reader.hexdigest('md5') == hashlib.md5(data).hexdigest()
+    assert reader.hexdigest('sha256') == hashlib.sha256(data).hexdigest()
+    assert progress.call_args == mock.call(len(data), len(data))
+
+
+def test_size_probe_then_iterate(payload):
+    path, data = payload
+    with upload.UploadReader(path, chunk_size=8192) as reader:
+        # glanceclient measures file objects with seek/tell.
+        assert reader.seekable()
+        reader.seek(0, os.SEEK_END)
+        assert reader.tell() == len(data)
+        reader.seek(0)
+        assert b''.join(reader) == data
+    assert reader.hexdigest('md5') == hashlib.md5(data).hexdigest()
+
+
+def test_rewind_restarts_digest(payload):
+    path, data = payload
+    with upload.UploadReader(path, chunk_size=8192) as reader:
+        reader.read(20000)
+        reader.seek(0)
+        assert b''.join(reader) == data
+    assert reader.hexdigest('sha256') == hashlib.sha256(data).hexdigest()
+
+
+def test_incomplete_read_has_no_digest(payload):
+    path, data = payload
+    with upload.UploadReader(path, chunk_size=8192) as reader:
+        reader.seek(50000)
+        assert reader.read(10) == data[50000:50010]
+        b''.join(reader)
+        with pytest.raises(ValueError):
+            reader.hexdigest('md5')
+
+
+def test_raw_reader(tmpdir):
+    path = str(tmpdir.join('os_ready-img.qcow2'))
+    qcow2.create(path, 4 * 1024 * 1024)
+    with qcow2.Qcow2Image(path, writable=True) as img:
+        img.write(1024 * 1024 + 10, b'config')
+    disk = bytearray(4 * 1024 * 1024)
+    disk[1024 * 1024 + 10:1024 * 1024 + 16] = b'config'
+    with upload.UploadReader(path, chunk_size=1024 * 1024,
+                             raw=True) as reader:
+        assert len(reader) == len(disk)
+        assert b''.join(reader) == bytes(disk)
+    assert reader.hexdigest('md5') == hashlib.md5(disk).hexdigest()
+
+
+def test_verify_upload(payload):
+    path, data = payload
+    with upload.UploadReader(path) as reader:
+        b''.join(reader)
+    image = mock.MagicMock(id='img', checksum=hashlib.md5(data).hexdigest())
+    upload.verify_upload(image, reader)
+    image.checksum = 'bad'
+    with pytest.raises(upload.UploadVerificationFailed) as ex:
+        upload.verify_upload(image, reader)
+    assert 'checksum bad' in str(ex.value)
+
+
+def test_progress_report():
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+    progress = upload.UploadProgress('img', interval=3600, out=out)
+    progress(1024 * 1024, 4 * 1024 * 1024)
+    progress(2 * 1024 * 1024, 4 * 1024 * 1024)
+    progress(4 * 1024 * 1024, 4 * 1024 * 1024)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith('img: 4.0 of 4.0 MiB (100%)')
@@ -0,0 +1,128 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import stat
+
+import pytest
+
+from f5_image_prep import userdata
+
+USERDATA = {
+    'bigip': {
+        'license': {'basekey': 'ABCDE-FGHIJ'},
+        'modules': {'auto_provision': False, 'ltm': 'nominal'},
+        'network': {
+            'dhcp': True,
+            'interfaces': {'1.1': {'vlan_tag': 4094, 'mtu': '9000'}},
+            'routes': [{'destination': '0.0.0.0/0', 'gateway': '10.0.0.1'},
+                       {'destination': '10.1.0.0/16',
+                        'gateway': '10.0.0.254'}],
+        },
+        'system_cmds': ['tmsh save sys config', "echo 'done'"],
+    },
+    'custom': {'ratio': 0.5},
+}
+
+
+def test_validate_userdata():
+    userdata.validate_userdata(USERDATA)
+    userdata.validate_userdata({'other': [1, 2]})
+    with pytest.raises(userdata.InvalidUserData) as ex:
+        userdata.validate_userdata({'bigip': {
+            'modules': {'ltm': 'full'},
+            'network': {'interfaces': {'1.1': {'vlan_tag': 'ten'}}},
+            'system_cmds': 'reboot',
+        }})
+    assert str(ex.value).split('\n') == [
+        'bigip.modules.ltm: expected dedicated, minimum, nominal or none, '
+        'not "full"',
+        'bigip.network.interfaces.1.1.vlan_tag: expected an integer, '
+        'not "ten"',
+        'bigip.system_cmds: expected a list',
+    ]
+    with pytest.raises(userdata.InvalidUserData):
+        userdata.validate_userdata([])
+
+
+def test_variable_name():
+    assert userdata.variable_name(['bigip', 'license', 'host']) == \
+        'OS_UD_bigip__license__host_'
+    assert userdata.variable_name(['bigip', 'network', 'interfaces', '1.1',
+                                   'mtu']) == \
+        'OS_UD_bigip__network__interfaces__1_1__mtu_'
+
+
+def test_compile_userdata():
+    compiled = userdata.compile_userdata(USERDATA, 'abc')
+    assert compiled.split('\n')[1:] == [
+        "OS_USER_DATA_SOURCE_MD5='abc'",
+        "OS_UD_bigip__license__basekey_='ABCDE-FGHIJ'",
+        "OS_UD_bigip__modules__auto_provision_='false'",
+        "OS_UD_bigip__modules__ltm_='nominal'",
+        "OS_UD_bigip__network__dhcp_='true'",
+        "OS_UD_bigip__network__interfaces__1_1__mtu_='9000'",
+        "OS_UD_bigip__network__interfaces__1_1__vlan_tag_='4094'",
+        "OS_UD_custom__ratio_='0.5'",
+        "OS_UD_SYSTEM_CMDS='tmsh save sys config;;echo '\\''done'\\'''",
+        "OS_UD_FIRSTBOOT_CMDS=''",
+        "OS_UD_NETWORK_ROUTES='0.0.0.0/0;10.0.0.1|10.1.0.0/16;10.0.0.254|'",
+        '',
+    ]
+
+
+def test_compile_userdata_collision():
+    with pytest.raises(userdata.InvalidUserData) as ex:
+        userdata.compile_userdata({'a': {'b.c': 1, 'b-c': 2}})
+    assert 'a.b-c and a.b.c' in str(ex.value)
+
+
+def test_compiled_name():
+    assert userdata.compiled_name('/tmp/user-data.json') == 'user-data.vars'
+    assert userdata.compiled_name('userdata') == 'userdata.vars'
+
+
+def test_compile_userdata_file(tmpdir):
+    source = tmpdir.join('user-data.json')
+    source.write('{"bigip": {"admin_password": "s3cr\\u00e9t"}}')
+    output = str(tmpdir.join('user-data.vars'))
+    userdata.compile_userdata_file(str(source), output)
+    with open(output, 'rb') as compiled:
+        content = compiled.read().decode('utf-8')
+    md5 = hashlib.md5(source.read_binary()).hexdigest()
+    assert "OS_USER_DATA_SOURCE_MD5='%s'" % md5 in content
+    assert u"OS_UD_bigip__admin_password_='s3cr\u00e9t'" in content
+    assert stat.S_IMODE(os.stat(output).st_mode) == 0o600
+
+
+def test_main(tmpdir, capsys):
+    source = tmpdir.join('user-data.json')
+    source.write('{"bigip": {"ssh_key_inject": "yes"}}')
+    output = tmpdir.join('user-data.vars')
+    assert userdata.main([str(source), '-o', str(output)]) == 1
+    assert 'bigip.ssh_key_inject: expected true or false' in \
+        capsys.readouterr()[1]
+    assert not output.check()
+
+    source.write('{"bigip": {"ssh_key_inject": "true"}}')
+    assert userdata.main([str(source)]) == 0
+    assert not output.check()
+    assert userdata.main([str(source), '-o', str(output)]) == 0
+    assert "OS_UD_bigip__ssh_key_inject_='true'" in output.read()
+
+    source.write('{"bigip": ')
+    assert userdata.main([str(source)]) == 1
+    assert 'is not valid JSON' in capsys.readouterr()[1]
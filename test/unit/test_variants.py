@@ -0,0 +1,52 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from f5_image_prep.variants import ImageVariant
+from f5_image_prep.variants import InvalidVariant
+from f5_image_prep.variants import load_variants
+
+
+def test_load_variants(tmpdir):
+    tmpdir.mkdir('tenants').join('a.json').write('{}')
+    tmpdir.join('overrides.tar').write('tar')
+    variants_file = tmpdir.join('variants.ini')
+    variants_file.write('[tenant-a]\n'
+                        'userdata = tenants/a.json\n'
+                        'startup_script_package = %s\n'
+                        '[plain]\n' % tmpdir.join('overrides.tar'))
+    variants = load_variants(str(variants_file))
+    assert [v.name for v in variants] == ['tenant-a', 'plain']
+    assert variants[0].userdata == str(tmpdir.join('tenants', 'a.json'))
+    assert variants[0].startup_pkg == str(tmpdir.join('overrides.tar'))
+    assert variants[1].userdata is None
+    assert variants[1].startup_pkg is None
+
+
+def test_load_variants_missing_file(tmpdir):
+    with pytest.raises(IOError):
+        load_variants(str(tmpdir.join('missing.ini')))
+
+
+@pytest.mark.parametrize('name', ['', 'a/b', '-a', 'tenant a'])
+def test_variant_name(name):
+    with pytest.raises(InvalidVariant):
+        ImageVariant(name)
+
+
+def test_variant_missing_userdata(tmpdir):
+    with pytest.raises(InvalidVariant):
+        ImageVariant('a', userdata=str(tmpdir.join('a.json')))
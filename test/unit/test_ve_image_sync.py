@@ -16,6 +16,8 @@
 import mock
 import pytest
 
+from f5_image_prep.openstack.openstack import OpenStackCreds
+from f5_image_prep.profiles import InvalidProfile
 from f5_image_prep.ve_image_sync import ImageFileNotQcow2
 from f5_image_prep.ve_image_sync import LocalFileNonExtant
 from f5_image_prep.ve_image_sync import VEImageSync as veis
@@ -26,6 +28,17 @@ HOMEDIR = '/home/imageprep/f5-openstack-image-prep/'
 
 class FakeImageModel(object):
     id = 'test'
+    checksum = 'test-md5'
+
+
+@pytest.fixture
+def mock_reader():
+    with mock.patch('f5_image_prep.ve_image_sync.UploadReader') as \
+            mock_upload_reader:
+        reader = mock_upload_reader.return_value.__enter__.return_value
+        reader.hexdigest.return_value = 'test-md5'
+        reader.algorithms = ('md5', 'sha256')
+        yield mock_upload_reader
 
 
 @pytest.fixture
@@ -34,7 +47,7 @@ def VEImageSync():
         mock_file.return_value = True
         return veis(
             mock.MagicMock(), '/test/img.qcow2',
-            '/test.tar', False, '/test/'
+            '/test.tar', False, '/test/', patch_engine='script'
         )
 
 
@@ -111,41 +124,39 @@ def test__patch_image_subprocess_failed(VEImageSync):
         assert ex.value.message == 'System related error'
 
 
-def test__upload_image_to_glance(VEImageSync):
+def test__upload_image_to_glance(VEImageSync, mock_reader):
+    mock_reader().__enter__().__len__.return_value = 1024
     with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
         mock_glance().glance_client.images.create.return_value = \
             FakeImageModel()
-        mock_glance().glance_client.images.list.return_value = \
-            [FakeImageModel()]
-        with mock.patch('__builtin__.open') as mock_file_open:
-            mock_file_open.return_value = 'file_content'
-            VEImageSync._upload_image_to_glance('img.qcow2')
+        VEImageSync._upload_image_to_glance('img.qcow2')
+        assert mock_reader.call_args[0] == ('img.qcow2',)
         assert mock_glance().glance_client.images.create.call_args == \
             mock.call(
                 name='img',
                 disk_format='qcow2',
                 container_format='bare',
                 is_public='false',
-                data='file_content'
+                size=1024,
+                data=mock_reader().__enter__()
             )
 
 
-def test__upload_image_to_glance_public_image(VEImageSyncPublicImage):
+def test__upload_image_to_glance_public_image(VEImageSyncPublicImage,
+                                              mock_reader):
     with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
         mock_glance().glance_client.images.create.return_value = \
             FakeImageModel()
-        mock_glance().glance_client.images.list.return_value = \
-            [FakeImageModel()]
-        with mock.patch('__builtin__.open') as mock_file_open:
-            mock_file_open.return_value = 'file_content'
-            VEImageSyncPublicImage._upload_image_to_glance('img.qcow2')
+        VEImageSyncPublicImage._upload_image_to_glance('img.qcow2')
+        assert mock_reader.call_args[0] == ('img.qcow2',)
         assert mock_glance().glance_client.images.create.call_args == \
             mock.call(
                 name='img',
                 disk_format='qcow2',
                 container_format='bare',
                 is_public='true',
-                data='file_content'
+                size=0,
+                data=mock_reader().__enter__()
             )
 
 
@@ -164,3 +175,693 @@ def test_sync_image(VEImageSync):
             VEImageSync.sync_image()
     assert mock_patch.call_args == mock.call()
     assert mock_glance.call_args == mock.call('prepped_image')
+
+
+def test_sync_image_releases_cached_image(VEImageSync):
+    VEImageSync.cache = mock.MagicMock()
+    with mock.patch(VEPATH + '._patch_image') as mock_patch:
+        with mock.patch(VEPATH + '._upload_image_to_glance') as mock_glance:
+            mock_patch.return_value = 'cached_image'
+            mock_glance.side_effect = Exception('upload failed')
+            with pytest.raises(Exception):
+                VEImageSync.sync_image()
+    assert VEImageSync.cache.release.call_args == mock.call('cached_image')
+
+
+def test__patch_image_script_options():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        ve = veis(
+            mock.MagicMock(), '/test/img.qcow2', '/test.tar', False,
+            '/test/', userdata='/test/user-data.json',
+            base_iso='/test/base.iso', hotfix_iso='/test/hotfix.iso',
+            patch_engine='script'
+        )
+        with mock.patch('f5_image_prep.ve_image_sync.subprocess.'
+                        'check_output') as mock_subproc:
+            ve._patch_image()
+    assert mock_subproc.call_args == mock.call(
+        ['sudo', '/bin/bash',
+         '/home/imageprep/f5-openstack-image-prep/bin/patch-image.sh',
+         '-f', '-s', '/test.tar', '-t', '/test', '-o', 'os_ready-img.qcow2',
+         '-u', '/test/user-data.json', '-b', '/test/base.iso',
+         '-h', '/test/hotfix.iso', '/test/img.qcow2'],
+    )
+
+
+def test__patch_image_inline():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        ve = veis(
+            mock.MagicMock(), '/test/img.qcow2', '/test.tar', False,
+            '/test/', userdata='/test/user-data.json',
+            patch_engine='inline'
+        )
+        with mock.patch('f5_image_prep.ve_image_sync.stage_image') as \
+                mock_stage:
+            mock_stage.return_value = 'reflink'
+            with mock.patch('f5_image_prep.ve_image_sync.ImageInjector') as \
+                    mock_injector:
+                patch_path = ve._patch_image()
+    assert patch_path == '/test/os_ready-img.qcow2'
+    assert mock_stage.call_args == \
+        mock.call('/test/img.qcow2', '/test/os_ready-img.qcow2')
+    assert ve.staging == 'reflink'
+    assert mock_injector.call_args == \
+        mock.call('/test/os_ready-img.qcow2', '/test/')
+    assert mock_injector().inject.call_args == mock.call(
+        startup_pkg='/test.tar', userdata='/test/user-data.json',
+        firstboot=True, base_iso=None, hotfix_iso=None
+    )
+
+
+def test__patch_image_nbd():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        ve = veis(
+            mock.MagicMock(), '/test/img.qcow2', '/test.tar', False,
+            '/test/', hotfix_iso='/test/hotfix.iso', patch_engine='nbd'
+        )
+        with mock.patch('f5_image_prep.ve_image_sync.stage_image') as \
+                mock_stage:
+            mock_stage.return_value = 'overlay'
+            with mock.patch('f5_image_prep.ve_image_sync.NbdPatcher') as \
+                    mock_patcher:
+                patch_path = ve._patch_image(nbd_device='/dev/nbd2',
+                                             mount_dir='/tmp/slot')
+    assert patch_path == '/test/os_ready-img.qcow2'
+    assert ve.staging == 'overlay'
+    assert mock_patcher.call_args == \
+        mock.call('/dev/nbd2', '/tmp/slot', metrics=ve.metrics)
+    assert mock_patcher().patch.call_args == mock.call(
+        '/test/os_ready-img.qcow2', startup_pkg='/test.tar', userdata=None,
+        firstboot=True, base_iso=None, hotfix_iso='/test/hotfix.iso'
+    )
+
+
+def test__patch_image_default_engine():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        ve = veis(mock.MagicMock(), '/test/img.qcow2', '/test.tar')
+        assert ve.patch_engine == 'nbd'
+        with mock.patch('f5_image_prep.ve_image_sync.stage_image'):
+            with mock.patch('f5_image_prep.ve_image_sync.NbdPatcher') as \
+                    mock_patcher:
+                with mock.patch('f5_image_prep.ve_image_sync.subprocess.'
+                                'check_output') as mock_subproc:
+                    ve._patch_image(nbd_device='/dev/nbd2',
+                                    mount_dir='/tmp/slot')
+    assert mock_patcher().patch.called
+    assert not mock_subproc.called
+
+
+def test_sync_image_metrics():
+    import io
+    import json
+    from f5_image_prep.metrics import Metrics
+    out = io.BytesIO() if str is bytes else io.StringIO()
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        ve = veis(
+            mock.MagicMock(), '/test/img.qcow2', '/test.tar', False,
+            '/test/', patch_engine='inline', metrics=Metrics(out)
+        )
+        with mock.patch('f5_image_prep.ve_image_sync.stage_image') as \
+                mock_stage:
+            mock_stage.return_value = 'copy'
+            with mock.patch('f5_image_prep.ve_image_sync.ImageInjector'):
+                with mock.patch(VEPATH + '._upload') as mock_upload:
+                    mock_upload.return_value = FakeImageModel()
+                    ve.sync_image()
+    spans = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [span['span'] for span in spans] == [
+        'sync_image/patch/stage', 'sync_image/patch/inject',
+        'sync_image/patch', 'sync_image/verify_inputs', 'sync_image']
+    assert spans[0]['method'] == 'copy'
+    assert spans[2]['engine'] == 'inline'
+    assert all(span['image'] == 'img.qcow2' for span in spans)
+
+
+def test__init__unknown_patch_engine():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        with pytest.raises(ValueError):
+            veis(mock.MagicMock(), '/test/img.qcow2', '/test.tar',
+                 patch_engine='guestfish')
+
+
+@pytest.fixture
+def VEImageBatchSync():
+    from f5_image_prep.ve_image_sync import VEImageBatchSync as veibs
+    nbd_pool = mock.MagicMock()
+    nbd_pool.__len__.return_value = 2
+    nbd_pool.slot().__enter__.return_value = mock.MagicMock(
+        device='/dev/nbd1', mount_dir='/tmp/mnt')
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        return veibs(
+            mock.MagicMock(), ['/test/a.qcow2', '/test/b.qcow2',
+                               '/test/c.qcow2'],
+            '/test.tar', workers=8, nbd_pool=nbd_pool, workdir='/test/'
+        )
+
+
+def test_batch_workers_bounded_by_nbd_pool(VEImageBatchSync):
+    assert VEImageBatchSync.workers == 2
+    assert len(VEImageBatchSync.image_syncs) == 3
+
+
+def test_batch_sync_images(VEImageBatchSync):
+    with mock.patch(VEPATH + '._patch_image') as mock_patch:
+        with mock.patch(VEPATH + '._upload_image_to_glance') as mock_upload:
+            mock_patch.return_value = 'prepped_image'
+            mock_upload.side_effect = [
+                FakeImageModel(), Exception('upload failed'),
+                FakeImageModel()]
+            results = VEImageBatchSync.sync_images()
+    assert mock_patch.call_args == \
+        mock.call(nbd_device='/dev/nbd1', mount_dir='/tmp/mnt')
+    assert mock_patch.call_count == 3
+    assert [r[0] for r in results] == \
+        ['/test/a.qcow2', '/test/b.qcow2', '/test/c.qcow2']
+    errors = [r[2] for r in results if r[2]]
+    assert len(errors) == 1
+    assert str(errors[0]) == 'upload failed'
+
+
+def test__patch_image_nbd_slot(VEImageSync):
+    with mock.patch('f5_image_prep.ve_image_sync.subprocess.check_output') as \
+            mock_subproc:
+        with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as \
+                mock_isfile:
+            mock_isfile.return_value = True
+            VEImageSync._patch_image(nbd_device='/dev/nbd3',
+                                     mount_dir='/tmp/slot')
+    assert mock_subproc.call_args[0][0][-5:] == \
+        ['-d', '/dev/nbd3', '-m', '/tmp/slot', '/test/img.qcow2']
+
+
+def test__upload_image_to_glance_flattens_overlay(VEImageSync,
+                                                  mock_reader):
+    VEImageSync.staging = 'overlay'
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        with mock.patch('f5_image_prep.ve_image_sync.flatten_image') as \
+                mock_flatten:
+            with mock.patch('f5_image_prep.ve_image_sync.os.unlink') as \
+                    mock_unlink:
+                VEImageSync._upload_image_to_glance(
+                    '/test/os_ready-img.qcow2')
+    assert mock_flatten.call_args == mock.call(
+        '/test/os_ready-img.qcow2', '/test/flat-os_ready-img.qcow2')
+    assert mock_reader.call_args[0] == ('/test/flat-os_ready-img.qcow2',)
+    assert mock_unlink.call_args == \
+        mock.call('/test/flat-os_ready-img.qcow2')
+
+
+def test__upload_image_to_glance_raw(VEImageSync, mock_reader):
+    VEImageSync.staging = 'overlay'
+    VEImageSync.target_format = 'raw'
+    VEImageSync.raw = True
+    VEImageSync.disk_format = 'raw'
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        with mock.patch('f5_image_prep.ve_image_sync.flatten_image') as \
+                mock_flatten:
+            VEImageSync._upload_image_to_glance('/test/os_ready-img.qcow2')
+    # The overlay is converted while it is read, without a flat copy.
+    assert not mock_flatten.called
+    assert mock_reader.call_args[0] == ('/test/os_ready-img.qcow2',)
+    assert mock_reader.call_args[1]['raw'] is True
+    assert mock_glance().glance_client.images.create.call_args[1][
+        'disk_format'] == 'raw'
+
+
+def test__upload_image_to_glance_compressed(VEImageSync, mock_reader):
+    VEImageSync.target_format = 'qcow2-compressed'
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        with mock.patch('f5_image_prep.ve_image_sync.flatten_image') as \
+                mock_flatten:
+            with mock.patch('f5_image_prep.ve_image_sync.os.unlink') as \
+                    mock_unlink:
+                VEImageSync._upload_image_to_glance(
+                    '/test/os_ready-img.qcow2')
+    assert mock_flatten.call_args == mock.call(
+        '/test/os_ready-img.qcow2', '/test/compressed-os_ready-img.qcow2',
+        compress=True)
+    assert mock_reader.call_args[0] == ('/test/compressed-os_ready-img.qcow2',)
+    assert mock_reader.call_args[1]['raw'] is False
+    assert mock_unlink.call_args == \
+        mock.call('/test/compressed-os_ready-img.qcow2')
+    assert mock_glance().glance_client.images.create.call_args[1][
+        'disk_format'] == 'qcow2'
+
+
+def test__init__unknown_target_format():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        with pytest.raises(ValueError):
+            veis(mock.MagicMock(), '/test/img.qcow2', '/test.tar',
+                 target_format='vmdk')
+
+
+def _digest(path, algorithm='sha256'):
+    return '%s-%s' % (algorithm, path)
+
+
+def test__patch_image_cache_hit(VEImageSync):
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    VEImageSync.cache.known_digest.side_effect = _digest
+    VEImageSync.cache.lookup.return_value = '/cache/os_ready-img.qcow2'
+    with mock.patch('f5_image_prep.ve_image_sync.subprocess.check_output') as \
+            mock_subproc:
+        patch_path = VEImageSync._patch_image()
+    assert patch_path == '/cache/os_ready-img.qcow2'
+    assert not mock_subproc.called
+    # The image digest comes from the verifier, the other inputs' from the
+    # cache.
+    assert VEImageSync.cache.known_digest.call_args == \
+        mock.call('/test/img.qcow2', 'sha256')
+    digested = [c[0][0] for c in VEImageSync.cache.file_digest.call_args_list]
+    assert '/test/img.qcow2' not in digested
+    assert '/test.tar' in digested
+
+
+def test__patch_image_cache_miss(VEImageSync):
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    VEImageSync.cache.known_digest.side_effect = _digest
+    VEImageSync.cache.lookup.return_value = None
+    VEImageSync.cache.store.return_value = '/cache/os_ready-img.qcow2'
+    with mock.patch('f5_image_prep.ve_image_sync.subprocess.check_output'):
+        with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as \
+                mock_isfile:
+            mock_isfile.return_value = True
+            patch_path = VEImageSync._patch_image()
+            fingerprint = VEImageSync._prep_fingerprint()
+    assert patch_path == '/cache/os_ready-img.qcow2'
+    assert VEImageSync.cache.store.call_args == mock.call(
+        fingerprint, '/test/os_ready-img.qcow2')
+
+
+def test__prep_fingerprint_input_names(tmpdir):
+    image = tmpdir.join('BIGIP.qcow2')
+    image.write('qcow2')
+    for name in ('user-data.json', 'tenant.json'):
+        tmpdir.join(name).write('{"bigip": {}}')
+    for name in ('base.iso', 'other.iso'):
+        tmpdir.join(name).write('iso')
+
+    def fingerprint(userdata, base_iso):
+        return veis(mock.MagicMock(), str(image), str(image),
+                    workdir=str(tmpdir), userdata=str(tmpdir.join(userdata)),
+                    base_iso=str(tmpdir.join(base_iso)))._prep_fingerprint()
+
+    # The files are copied into the image under their own names, so the
+    # same content under another name is another image.
+    first = fingerprint('user-data.json', 'base.iso')
+    assert fingerprint('user-data.json', 'base.iso') == first
+    assert fingerprint('tenant.json', 'base.iso') != first
+    assert fingerprint('user-data.json', 'other.iso') != first
+
+
+def test__upload_image_to_glance_reuses_identical_image(VEImageSync):
+    VEImageSync.reuse_existing = True
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    other = mock.MagicMock(is_public=False, checksum='other')
+    existing = mock.MagicMock(is_public=False,
+                              checksum='md5-/test/os_ready-img.qcow2')
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().find_images.return_value = [other, existing]
+        img_model = VEImageSync._upload_image_to_glance(
+            '/test/os_ready-img.qcow2')
+    assert img_model is existing
+    assert not mock_glance().glance_client.images.create.called
+    assert mock_glance().find_images.call_args == mock.call(
+        'qcow2',
+        {'f5_image_prep_fingerprint': VEImageSync._prep_fingerprint()})
+
+
+def test__upload_image_to_glance_records_fingerprint(VEImageSync,
+                                                     mock_reader):
+    VEImageSync.reuse_existing = True
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().find_images.return_value = []
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        VEImageSync._upload_image_to_glance('/test/os_ready-img.qcow2')
+    assert mock_glance().glance_client.images.create.call_args[1][
+        'properties'] == {
+            'f5_image_prep_fingerprint': VEImageSync._prep_fingerprint()}
+    digested = [c[0][0] for c in VEImageSync.cache.file_digest.call_args_list]
+    assert '/test/os_ready-img.qcow2' not in digested
+    assert VEImageSync.cache.record_digest.call_args_list == [
+        mock.call('/test/os_ready-img.qcow2', 'md5', 'test-md5'),
+        mock.call('/test/os_ready-img.qcow2', 'sha256', 'test-md5')]
+
+
+def test__upload_image_to_glance_checksum_mismatch(VEImageSync, mock_reader):
+    from f5_image_prep.upload import UploadVerificationFailed
+    mock_reader().__enter__().hexdigest.return_value = 'corrupt'
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        with pytest.raises(UploadVerificationFailed):
+            VEImageSync._upload_image_to_glance('img.qcow2')
+    gc = mock_glance().glance_client
+    assert gc.images.delete.call_args == mock.call('test')
+    assert gc.images.create.call_count == 1
+
+
+def test__upload_image_to_glance_v2_checksum_mismatch(VEImageSync,
+                                                      mock_reader):
+    from f5_image_prep.upload import UploadVerificationFailed
+    VEImageSync.glance_api_version = 2
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    mock_reader().__enter__().hexdigest.return_value = 'corrupt'
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().api_version = 2
+        mock_glance().creds = OpenStackCreds(
+            'http://ks:5000/v2.0', 'admin', 'admin', 'pw')
+        with mock.patch('f5_image_prep.ve_image_sync.ResumableUpload') as \
+                mock_upload:
+            mock_upload().run.return_value = FakeImageModel()
+            mock_upload().sent = True
+            with pytest.raises(UploadVerificationFailed):
+                VEImageSync._upload_image_to_glance('img.qcow2')
+    assert mock_glance().glance_client.images.delete.call_args == \
+        mock.call('test')
+    assert mock_upload().finish.called
+
+
+def test__upload_image_to_glance_refetches_checksum(VEImageSync, mock_reader):
+    queued = FakeImageModel()
+    queued.checksum = None
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        gc = mock_glance().glance_client
+        gc.images.create.return_value = queued
+        gc.images.get.return_value = FakeImageModel()
+        img_model = VEImageSync._upload_image_to_glance('img.qcow2')
+    assert gc.images.get.call_args == mock.call('test')
+    assert img_model.checksum == 'test-md5'
+
+
+def test_upload_targets():
+    from f5_image_prep.ve_image_sync import upload_targets
+    creds = OpenStackCreds('http://ks:5000/v2.0', 'admin', 'admin', 'pw')
+    assert upload_targets(creds) == [('default', creds)]
+    targets = upload_targets(creds, regions=['east', 'west'])
+    assert [name for name, _creds in targets] == ['east', 'west']
+    assert targets[1][1].region_name == 'west'
+    assert targets[1][1].auth_url == creds.auth_url
+    assert creds.region_name is None
+    other = OpenStackCreds('http://other:5000/v2.0', 'demo', 'demo', 'pw')
+    targets = upload_targets(creds, {'lab': other, 'prod': creds}, ['r1'])
+    assert [name for name, _creds in targets] == ['lab/r1', 'prod/r1']
+
+
+def test__upload_image_to_targets(VEImageSync):
+    VEImageSync.reuse_existing = True
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    creds = [mock.MagicMock(name='east'), mock.MagicMock(name='west')]
+    VEImageSync.targets = [('east', creds[0]), ('west', creds[1])]
+    VEImageSync.upload_workers = 1
+    existing = mock.MagicMock(is_public=False,
+                              checksum='md5-/test/os_ready-img.qcow2')
+
+    def find_images(disk_format, properties):
+        return [existing] if glance_creds[-1] is creds[0] else []
+
+    glance_creds = []
+
+    def glance_lib(lib_creds, api_version=1):
+        glance_creds.append(lib_creds)
+        lib = mock.MagicMock()
+        lib.find_images.side_effect = find_images
+        return lib
+
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance.side_effect = glance_lib
+        with mock.patch('f5_image_prep.ve_image_sync.FanOutUpload') as \
+                mock_fan_out:
+            with mock.patch('f5_image_prep.ve_image_sync.ThreadPool') as \
+                    mock_pool:
+                mock_pool().map.side_effect = \
+                    lambda func, items: list(map(func, items))
+                targets = VEImageSync._upload(
+                    '/test/os_ready-img.qcow2')
+    assert mock_pool.call_args == mock.call(1)
+    assert [t.status for t in targets] == ['reused', 'pending']
+    assert targets[0].image is existing
+    assert [t.name for t in mock_fan_out.call_args[0][1]] == ['west']
+    assert mock_fan_out.call_args[1]['workers'] == 1
+    assert mock_fan_out().run.called
+
+
+def test_report_targets(capsys):
+    from f5_image_prep.fanout import UploadTarget
+    from f5_image_prep.ve_image_sync import report_targets
+    ok, down = UploadTarget('east', None), UploadTarget('west', None)
+    ok.status, ok.image = 'uploaded', FakeImageModel()
+    down.status, down.attempts, down.error = 'failed', 3, 'timed out'
+    assert report_targets('img.qcow2', [ok])
+    assert not report_targets('img.qcow2', [ok, down])
+    out = capsys.readouterr()[0]
+    assert 'img.qcow2: east: uploaded test' in out
+    assert 'img.qcow2: west: FAILED after 3 attempts: timed out' in out
+
+
+def test__upload_image_to_glance_v2(VEImageSync, mock_reader):
+    VEImageSync.glance_api_version = 2
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().api_version = 2
+        mock_glance().creds = OpenStackCreds(
+            'http://ks:5000/v2.0', 'admin', 'admin', 'pw')
+        with mock.patch('f5_image_prep.ve_image_sync.ResumableUpload') as \
+                mock_upload:
+            mock_upload().run.return_value = FakeImageModel()
+            mock_upload().sent = True
+            img_model = VEImageSync._upload_image_to_glance('img.qcow2')
+    assert img_model.id == 'test'
+    assert mock_glance.call_args[1] == {'api_version': 2}
+    assert mock_upload.call_args[0][1].startswith(
+        '/test/.f5-image-prep/uploads/')
+    assert mock_upload.call_args[0][2] == {
+        'name': 'img', 'disk_format': 'qcow2', 'container_format': 'bare',
+        'visibility': 'private'}
+    assert mock_upload().finish.called
+
+
+def test__upload_image_to_glance_property_profiles(VEImageSync, mock_reader):
+    VEImageSync.image_properties = {'hw_vif_model': 'virtio'}
+    VEImageSync.cache = mock.MagicMock()
+    VEImageSync.cache.file_digest.side_effect = _digest
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.return_value = \
+            FakeImageModel()
+        VEImageSync._upload_image_to_glance('img.qcow2')
+        mock_glance().api_version = 2
+        mock_glance().creds = OpenStackCreds(
+            'http://ks:5000/v2.0', 'admin', 'admin', 'pw')
+        with mock.patch('f5_image_prep.ve_image_sync.ResumableUpload') as \
+                mock_upload:
+            mock_upload().run.return_value = FakeImageModel()
+            mock_upload().sent = True
+            VEImageSync._upload_image_to_glance('img.qcow2')
+    # Both APIs set the properties in the call that creates the image.
+    assert mock_glance().glance_client.images.create.call_args[1][
+        'properties'] == {'hw_vif_model': 'virtio'}
+    assert mock_upload.call_args[0][2]['hw_vif_model'] == 'virtio'
+
+
+def test__init__property_profiles():
+    with mock.patch('f5_image_prep.ve_image_sync.os.path.isfile') as mock_file:
+        mock_file.return_value = True
+        image_sync = veis(mock.MagicMock(), '/test/BIGIP-13.1.0.qcow2',
+                          '/test.tar', property_profiles=['virtio'])
+        assert image_sync.image_properties == {
+            'hw_disk_bus': 'virtio', 'hw_vif_model': 'virtio'}
+        with pytest.raises(InvalidProfile):
+            veis(mock.MagicMock(), '/test/BIGIP-12.1.0.qcow2', '/test.tar',
+                 property_profiles=['virtio-scsi'])
+
+
+def test__upload_image_to_glance_retries(VEImageSync, mock_reader):
+    VEImageSync.upload_retries = 1
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        mock_glance().glance_client.images.create.side_effect = [
+            IOError('connection reset'), FakeImageModel()]
+        img_model = VEImageSync._upload_image_to_glance('img.qcow2')
+    assert img_model.id == 'test'
+    assert mock_reader.call_count == 2
+
+
+def test_job_runner():
+    from f5_image_prep.fanout import UploadTarget
+    from f5_image_prep.ve_image_sync import ImageUploadFailed
+    from f5_image_prep.ve_image_sync import VEImageJobRunner
+    runner = VEImageJobRunner(mock.MagicMock(), '/test.tar',
+                              patch_engine='inline', base_iso='/base.iso')
+    with mock.patch('f5_image_prep.ve_image_sync.VEImageSync') as mock_sync:
+        image_sync = mock_sync.return_value
+        image_sync.targets = None
+        image_sync._upload.return_value = mock.MagicMock(id='image-id')
+        assert runner('/in/img.qcow2', hotfix_iso='/in/img.hotfix.iso') == \
+            'image-id'
+        assert mock_sync.call_args[1]['base_iso'] == '/base.iso'
+        assert mock_sync.call_args[1]['hotfix_iso'] == '/in/img.hotfix.iso'
+
+        image_sync.targets = [('east', None), ('west', None)]
+        east = UploadTarget('east', None)
+        east.status, east.image = 'uploaded', mock.MagicMock(id='e1')
+        west = UploadTarget('west', None)
+        west.status, west.error = 'failed', 'HTTP 503'
+        image_sync._upload.return_value = [east, west]
+        with pytest.raises(ImageUploadFailed) as err:
+            runner('/in/img.qcow2')
+    assert 'west (HTTP 503)' in str(err.value)
+
+
+@pytest.mark.parametrize('engine,loads', [
+    ('nbd', True), ('script', True), ('inline', False)])
+def test_job_runner_warm_up(engine, loads):
+    from f5_image_prep.ve_image_sync import VEImageJobRunner
+    runner = VEImageJobRunner(mock.MagicMock(), '/test.tar',
+                              patch_engine=engine)
+    with mock.patch('f5_image_prep.ve_image_sync.get_session') as \
+            mock_session:
+        with mock.patch('f5_image_prep.ve_image_sync.load_nbd_module') as \
+                mock_load:
+            runner.warm_up()
+    assert mock_session().endpoint.call_args == mock.call('image')
+    assert mock_load.called == loads
+
+
+def test__patch_image_corrupt_input(tmpdir):
+    from f5_image_prep.verify import ChecksumMismatch
+    image = tmpdir.join('img.qcow2')
+    image.write('truncated')
+    tmpdir.join('img.qcow2.md5').write('0' * 32)
+    ve = veis(mock.MagicMock(), str(image), '/test.tar',
+              workdir=str(tmpdir), patch_engine='inline')
+    with mock.patch('f5_image_prep.ve_image_sync.stage_image'):
+        with mock.patch('f5_image_prep.ve_image_sync.ImageInjector') as \
+                mock_injector:
+            mock_injector().inject.side_effect = ValueError('no LVM')
+            with pytest.raises(ChecksumMismatch):
+                ve._patch_image()
+            ve.verify_inputs = False
+            with pytest.raises(ValueError):
+                ve._patch_image()
+
+
+def test_variant_sync(tmpdir):
+    from f5_image_prep.variants import ImageVariant
+    from f5_image_prep.ve_image_sync import VEImageVariantSync
+    image = tmpdir.join('BIGIP.qcow2')
+    image.write('qcow2')
+    tmpdir.join('a.json').write('{}')
+    tmpdir.join('default.json').write('{}')
+    variants = [ImageVariant('a', userdata=str(tmpdir.join('a.json'))),
+                ImageVariant('b')]
+    variant_sync = VEImageVariantSync(
+        mock.MagicMock(), str(image), '/test.tar', variants,
+        workdir=str(tmpdir), patch_engine='inline',
+        userdata=str(tmpdir.join('default.json')), reuse_existing=False)
+    assert variant_sync.base.userdata is None
+    built = []
+
+    def overlay(base, path):
+        built.append((base, path))
+        open(path, 'w').close()
+
+    def upload(self, path):
+        assert self.staging == 'overlay'
+        if self.variant.name == 'b':
+            raise ValueError('HTTP 503')
+        return mock.MagicMock(id=self.filename)
+
+    with mock.patch('f5_image_prep.ve_image_sync._patch_in_slot') as \
+            mock_patch:
+        mock_patch.return_value = '/cache/os_ready-BIGIP.qcow2'
+        with mock.patch('f5_image_prep.ve_image_sync.create_overlay') as \
+                mock_overlay:
+            mock_overlay.side_effect = overlay
+            with mock.patch('f5_image_prep.ve_image_sync.ImageInjector') as \
+                    mock_injector:
+                with mock.patch(VEPATH + '._upload', autospec=True) as \
+                        mock_upload:
+                    mock_upload.side_effect = upload
+                    with mock.patch.object(variant_sync.base,
+                                           '_prep_fingerprint') as mock_fp:
+                        mock_fp.return_value = 'base-1'
+                        results = variant_sync.sync_images()
+    assert mock_patch.call_count == 1
+    # Resumable upload state follows the base even without reuse_existing.
+    assert [v.base_fingerprint for v in variant_sync.variant_syncs] == \
+        ['base-1', 'base-1']
+    assert mock_patch.call_args[0][0] is variant_sync.base
+    assert sorted(built) == [
+        ('/cache/os_ready-BIGIP.qcow2', str(tmpdir.join(name)))
+        for name in ('os_ready-BIGIP-a.qcow2', 'os_ready-BIGIP-b.qcow2')]
+    assert sorted(c[1]['userdata'] for c in
+                  mock_injector().inject.call_args_list) == \
+        [str(tmpdir.join('a.json')), str(tmpdir.join('default.json'))]
+    assert results[0][0] == 'a'
+    assert results[0][1].id == 'BIGIP-a.qcow2'
+    assert results[1][0] == 'b'
+    assert str(results[1][2]) == 'HTTP 503'
+    assert not tmpdir.join('os_ready-BIGIP-a.qcow2').exists()
+
+
+def test_variant_fingerprint(tmpdir):
+    from f5_image_prep.variants import ImageVariant
+    from f5_image_prep.ve_image_sync import VEImageVariant
+    image = tmpdir.join('BIGIP.qcow2')
+    image.write('qcow2')
+    tmpdir.join('a.json').write('{}')
+    variant = VEImageVariant(
+        mock.MagicMock(), str(image), '/test.tar',
+        ImageVariant('a', userdata=str(tmpdir.join('a.json'))),
+        workdir=str(tmpdir))
+    variant.base_fingerprint = 'base-1'
+    first = variant._prep_fingerprint()
+    variant.base_fingerprint = 'base-2'
+    assert variant._prep_fingerprint() != first
+
+
+def test_share_image(capsys):
+    from f5_image_prep.fanout import UploadTarget
+    from f5_image_prep.openstack.provision import ProvisionResult
+    from f5_image_prep.ve_image_sync import share_image
+    east = UploadTarget('east', mock.MagicMock(name='east'))
+    east.image = mock.MagicMock(id='e1')
+    west = UploadTarget('west', mock.MagicMock(name='west'))
+    with mock.patch('f5_image_prep.ve_image_sync.GlanceLib') as mock_glance:
+        with mock.patch('f5_image_prep.ve_image_sync.KeystoneLib'):
+            with mock.patch('f5_image_prep.ve_image_sync.ImageSharer') as \
+                    mock_sharer:
+                mock_sharer().share.return_value = [
+                    ProvisionResult('member', 'tenant0', 'granted'),
+                    ProvisionResult('member', 'tenant1', 'failed', 'quota')]
+                assert not share_image(None, [east, west], ['tenant0'],
+                                       label='img.qcow2')
+    assert mock_glance.call_args == mock.call(east.creds, api_version=1)
+    assert mock_sharer().share.call_args == \
+        mock.call(east.image, ['tenant0'], False)
+    out = capsys.readouterr()[0]
+    assert 'img.qcow2: east: member tenant0: granted' in out
+    assert 'img.qcow2: east: member tenant1: FAILED: quota' in out
+    assert 'west' not in out
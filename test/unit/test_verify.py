@@ -0,0 +1,104 @@
+# Copyright 2016 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+
+import mock
+import pytest
+
+from f5_image_prep.cache import PatchCache
+from f5_image_prep import verify
+
+
+PAYLOAD = b'BIG-IP' * 10000
+
+
+@pytest.fixture
+def download(tmpdir):
+    path = tmpdir.join('BIGIP.qcow2')
+    path.write(PAYLOAD, mode='wb')
+    return str(path)
+
+
+def test_read_sidecars(download):
+    assert verify.read_sidecars(download) == {}
+    md5 = hashlib.md5(PAYLOAD).hexdigest()
+    sha256 = hashlib.sha256(PAYLOAD).hexdigest()
+    with open(download + '.md5', 'w') as sidecar:
+        sidecar.write('%s  BIGIP.qcow2\n' % md5.upper())
+    with open(download + '.sha256', 'w') as sidecar:
+        sidecar.write('SHA256 (BIGIP.qcow2) = %s\n' % sha256)
+    assert verify.read_sidecars(download) == {'md5': md5, 'sha256': sha256}
+
+
+def test_read_sidecars_without_checksum(download):
+    with open(download + '.md5', 'w') as sidecar:
+        sidecar.write('Not Found\n')
+    with pytest.raises(verify.InputVerificationFailed):
+        verify.read_sidecars(download)
+
+
+def test_digest_file(download):
+    assert verify.digest_file(download, ['md5', 'sha256'],
+                              block_size=4096) == {
+        'md5': hashlib.md5(PAYLOAD).hexdigest(),
+        'sha256': hashlib.sha256(PAYLOAD).hexdigest()}
+
+
+def test_digest_file_missing(tmpdir):
+    with pytest.raises(IOError):
+        verify.digest_file(str(tmpdir.join('missing')), ['md5'])
+
+
+def test_verifier(download, tmpdir):
+    with open(download + '.md5', 'w') as sidecar:
+        sidecar.write(hashlib.md5(PAYLOAD).hexdigest())
+    iso = tmpdir.join('hotfix.iso')
+    iso.write('iso')
+    verifier = verify.InputVerifier([download, None, str(iso)],
+                                    algorithms=('sha256',)).start()
+    verifier.check()
+    assert verifier.digest(download, 'sha256') == \
+        hashlib.sha256(PAYLOAD).hexdigest()
+    assert verifier.digest(str(iso), 'md5') is None
+    assert verifier.digest('/elsewhere.iso', 'sha256') is None
+
+
+def test_verifier_corrupt_input(download):
+    with open(download + '.md5', 'w') as sidecar:
+        sidecar.write(hashlib.md5(b'other').hexdigest())
+    verifier = verify.InputVerifier([download]).start()
+    with pytest.raises(verify.ChecksumMismatch) as err:
+        verifier.check()
+    assert download + '.md5' in str(err.value)
+    with pytest.raises(verify.ChecksumMismatch):
+        verifier.digest(download, 'md5')
+
+
+def test_verifier_reads_each_input_once(download, tmpdir):
+    with open(download + '.md5', 'w') as sidecar:
+        sidecar.write(hashlib.md5(PAYLOAD).hexdigest())
+    patch_cache = PatchCache(str(tmpdir.join('cache')))
+    with mock.patch('f5_image_prep.verify.digest_file',
+                    wraps=verify.digest_file) as mock_digest:
+        verify.InputVerifier([download], ('sha256',), patch_cache).start() \
+            .check()
+        assert mock_digest.call_args == mock.call(download,
+                                                  ['md5', 'sha256'])
+        verify.InputVerifier([download], ('sha256',), patch_cache).start() \
+            .check()
+    assert mock_digest.call_count == 1
+    assert patch_cache.file_digest(download) == \
+        hashlib.sha256(PAYLOAD).hexdigest()